@@ -13,6 +13,11 @@ config.read(sql_path+'/queries.properties')
 
 from awscostusageprocessor.sql import athena as ath
 from awscostusageprocessor import consts as consts
+from awscostusageprocessor import rollups as rollups
+from awscostusageprocessor import localengine as localengine
+from awscostusageprocessor import clients as clients
+from awscostusageprocessor import resultstore as resultstore
+from awscostusageprocessor.errors import ValidationError
 
 
 log = logging.getLogger()
@@ -23,47 +28,165 @@ log.setLevel(logging.INFO)
 This class takes care of API operations. It doesn't integrate with Athena directly
 and it doesn't act as a request handler. It serves as a middle layer between an
 API request handler (a Lambda function) and the Athena data access class.
+Queries run in Athena by default. The local backend answers them in memory instead, see localengine.LocalQueryEngine.
 """
 
 class ApiProcessor():
 
-    def __init__(self, accountid, year, month):
+    def __init__(self, accountid, year, month, backend=consts.API_BACKEND):
+        if backend not in consts.VALID_API_BACKENDS:
+            raise ValidationError("Invalid backend [{}], valid options are: {}".format(backend, consts.VALID_API_BACKENDS))
         self.accountid = accountid
         self.year = year
         self.month = month
+        self.backend = backend
         self.athena = ath.AthenaQueryMgr(consts.ATHENA_BASE_OUTPUT_S3_BUCKET, accountid, year, month)
+        self.rollups = None
+        self.localEngine = None
 
-    def getResultSet(self, action, **kargs):
-        response= {"executionId":"", "queryState":"", "results":[]}
-        sqlstatement = self.athena.replace_params(config.get('queries',action),**kargs)
+
+    """
+    Rollups are calculated when Cost and Usage reports are processed (see rollups.RollupAccumulator). They're loaded once
+    and used for every API call they can answer.
+    """
+    def getRollups(self):
+        if self.rollups is None:
+            self.rollups = False
+            if consts.CUR_PROCESSOR_ROLLUPS and consts.CUR_PROCESSOR_DEST_S3_BUCKET:
+                key = rollups.get_rollups_prefix(consts.CUR_PROCESSOR_DEST_S3_PREFIX, self.accountid, self.year, self.month) + rollups.ROLLUPS_FILE_NAME
+                self.rollups = rollups.get_rollups(clients.get_client('s3'), consts.CUR_PROCESSOR_DEST_S3_BUCKET, key) or False
+        return self.rollups
+
+    def getLocalEngine(self):
+        if self.localEngine is None:
+            self.localEngine = localengine.load_engine(clients.get_client('s3'), consts.CUR_PROCESSOR_DEST_S3_BUCKET, consts.CUR_PROCESSOR_DEST_S3_PREFIX,
+                                                       self.accountid, self.year, self.month)
+        return self.localEngine
+
+    """
+    startDate and endDate (YYYY-MM-DD, inclusive) are optional. When the table is partitioned by usage date,
+    Athena only scans the files for the days in the range.
+    """
+    def getResultSet(self, action, startDate='', endDate='', **kargs):
+        response = self.getPrecalculatedResultSet(action, startDate, endDate, **kargs)
+        if response: return response
+
+        sqlstatement = self.athena.replace_params(config.get('queries',action), startDate=startDate, endDate=endDate, **kargs)
         log.info("\nQuery type: {}".format(action))
-        queryexecutionid, querystate = self.athena.execute_query(action, sqlstatement)
+        queryexecutionid, querystate = self.athena.execute_query(self.getQueryId(action, startDate, endDate), sqlstatement)
+        return self.getAthenaResultSet(queryexecutionid, querystate)
+
+    """
+    Runs several queries at the same time and returns their results keyed by action, in the same format as getResultSet.
+    All Athena queries are submitted first and then polled together, so it takes as long as the slowest query
+    (instead of the sum of all of them). Failed queries are returned with queryState FAILED instead of raising an exception.
+    """
+    def getResultSets(self, actions, startDate='', endDate=''):
+        result = {}
+        submitted = {}
+        for action in actions:
+            response = self.getPrecalculatedResultSet(action, startDate, endDate)
+            if response:
+                result[action] = response
+                continue
+            sqlstatement = self.athena.replace_params(config.get('queries',action), startDate=startDate, endDate=endDate)
+            log.info("\nQuery type: {}".format(action))
+            submitted[action] = self.athena.submit_query(self.getQueryId(action, startDate, endDate), sqlstatement)
+
+        if submitted:
+            queryexecutions = self.athena.poll_query_executions([q for q, runfresh in submitted.values()],
+                                                                initialDelay=any([runfresh for q, runfresh in submitted.values()]))
+            for action, (queryexecutionid, runfresh) in submitted.items():
+                result[action] = self.getAthenaResultSet(queryexecutionid, queryexecutions[queryexecutionid]['Status']['State'])
+        return result
+
+    """
+    Results that don't need Athena: rollups calculated when reports were processed, result sets stored by init-athena-queries,
+    or the local backend. Returns None otherwise.
+    """
+    def getPrecalculatedResultSet(self, action, startDate='', endDate='', **kargs):
+        response= {"executionId":"", "queryState":"", "results":[]}
+        if self.getRollups() and not kargs:
+            results = self.rollups.get_results(action, startDate, endDate, typed=self.athena.typedSchema)
+            if results is not None:
+                log.info("\nQuery type: {} - results from rollups".format(action))
+                response.update({'queryState':consts.ATHENA_QUERY_STATE_SUCCEEDED, 'results':results})
+                return response
+
+        results = self.getStoredResultSet(action, startDate, endDate, **kargs)
+        if results is not None: return results
+
+        if self.backend == consts.API_BACKEND_LOCAL:
+            log.info("\nQuery type: {} - local engine".format(action))
+            response.update({'queryState':consts.ATHENA_QUERY_STATE_SUCCEEDED,
+                             'results':self.getLocalEngine().execute(action, startDate, endDate, **kargs)})
+            return response
+
+        return None
+
+    """
+    Dashboard result sets for the whole month are stored by init-athena-queries (see resultstore.py) and served with a single S3 GET,
+    as long as they were calculated from the latest processed report.
+    """
+    def getStoredResultSet(self, action, startDate='', endDate='', **kargs):
+        if not self.isResultStoreEnabled() or action not in resultstore.STORED_ACTIONS or startDate or endDate or kargs: return None
+        dataVersion = self.athena.get_data_version()
+        if not dataVersion: return None
+        document = resultstore.get_result_set(clients.get_client('s3'), consts.CUR_PROCESSOR_DEST_S3_BUCKET, self.getResultKey(action), dataVersion)
+        if document is None: return None
+        log.info("\nQuery type: {} - stored results".format(action))
+        return {"executionId":document.get('executionId',''), "queryState":consts.ATHENA_QUERY_STATE_SUCCEEDED, "results":document['results']}
+
+    """
+    Stores the dashboard result sets in responses (a dictionary of action and response, see getResultSets) for the current data version.
+    Failed queries are not stored.
+    """
+    def putResultSets(self, responses):
+        dataVersion = self.athena.get_data_version()
+        if not self.isResultStoreEnabled() or not dataVersion: return
+        for action, response in responses.items():
+            if action not in resultstore.STORED_ACTIONS or response['queryState'] != consts.ATHENA_QUERY_STATE_SUCCEEDED: continue
+            resultstore.put_result_set(clients.get_client('s3'), consts.CUR_PROCESSOR_DEST_S3_BUCKET, self.getResultKey(action), action, dataVersion, response)
+
+    def isResultStoreEnabled(self):
+        return consts.API_RESULT_STORE and bool(consts.CUR_PROCESSOR_DEST_S3_BUCKET)
+
+    def getResultKey(self, action):
+        prefix = resultstore.get_results_prefix(consts.CUR_PROCESSOR_DEST_S3_PREFIX, self.accountid, self.year, self.month)
+        return resultstore.get_result_key(prefix, action)
+
+    """
+    Results for a date range are stored separately from results for the whole month
+    """
+    def getQueryId(self, action, startDate='', endDate=''):
+        if startDate or endDate: return "{}_{}_{}".format(action, startDate, endDate)
+        return action
+
+    def getAthenaResultSet(self, queryexecutionid, querystate):
+        response= {"executionId":queryexecutionid, "queryState":querystate, "results":[]}
         if querystate == consts.ATHENA_QUERY_STATE_SUCCEEDED:
             response['results'] = self.athena.get_query_execution_results(queryexecutionid)
-
-        response['executionId']=queryexecutionid
-        response['queryState']=querystate
         return response
 
-    def getTotalCost(self):
+    def getTotalCost(self, startDate='', endDate=''):
         #TODO: do mapping between SQL columns and API field names that will be returned
-        return self.getResultSet(consts.ACTION_GET_TOTAL_COST)
+        return self.getResultSet(consts.ACTION_GET_TOTAL_COST, startDate, endDate)
 
-    def getHourlyCost(self):
-        return self.getResultSet(consts.ACTION_GET_HOURLY_COST)
+    def getHourlyCost(self, startDate='', endDate=''):
+        return self.getResultSet(consts.ACTION_GET_HOURLY_COST, startDate, endDate)
 
-    def getCostByService(self):
-        return self.getResultSet(consts.ACTION_GET_COST_BY_SERVICE)
+    def getCostByService(self, startDate='', endDate=''):
+        return self.getResultSet(consts.ACTION_GET_COST_BY_SERVICE, startDate, endDate)
 
-    def getCostByUsageType(self):
-        return self.getResultSet(consts.ACTION_GET_COST_BY_USAGE_TYPE)
+    def getCostByUsageType(self, startDate='', endDate=''):
+        return self.getResultSet(consts.ACTION_GET_COST_BY_USAGE_TYPE, startDate, endDate)
 
-    def getCostByResource(self):
-        return self.getResultSet(consts.ACTION_GET_COST_BY_RESOURCE)
+    def getCostByResource(self, startDate='', endDate=''):
+        return self.getResultSet(consts.ACTION_GET_COST_BY_RESOURCE, startDate, endDate)
 
     #TODO:Implement for all resources, when resourceid is empty
-    def getUsageByResourceId(self, resourceid):
-        return self.getResultSet(consts.ACTION_GET_USAGE_BY_RESOURCE_ID, resourceid=resourceid)
+    def getUsageByResourceId(self, resourceid, startDate='', endDate=''):
+        return self.getResultSet(consts.ACTION_GET_USAGE_BY_RESOURCE_ID, startDate, endDate, resourceid=resourceid)
 
     """
         sqlstatement = athena.adjustsql(config.get('resources',consts.ACTION_GET_ACTIVE_RESOURCES))
@@ -0,0 +1,132 @@
+import os
+import logging
+import datetime
+import threading
+
+import pytz
+import boto3
+from botocore.config import Config
+
+import awscostusageprocessor.consts as consts
+
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+
+
+ROLE_SESSION_NAME = 'costAnalysis'
+CREDENTIALS_REFRESH_MARGIN_SECONDS = 300 #credentials are renewed when they expire in less than this
+
+
+"""
+Credentials and boto3 clients are cached at module level, so they're reused by every CostUsageProcessor created in the same
+process, including warm Lambda invocations: an account that is processed again doesn't assume its role again until the temporary
+credentials are about to expire, and clients (and their connection pools) are shared instead of being created for every instance.
+boto3 clients are thread-safe; resources are not, so they're cached per thread (in thread-local storage, which is released
+when the thread ends) and must only be used from the thread that created the processor.
+
+Entries are keyed by roleArn ('' for the credentials in the environment). Clients remember the access key they were created with,
+so they're replaced when the role's credentials are renewed.
+"""
+
+_lock = threading.RLock() #boto3 clients are created one at a time, the default boto3 session is not thread-safe
+_roleLocks = {} #one lock per role, so roles for different accounts can be assumed in parallel
+_credentials = {}
+_clients = {}
+_threadResources = threading.local()
+
+
+def get_role_lock(cacheKey):
+    with _lock:
+        return _roleLocks.setdefault(cacheKey, threading.Lock())
+
+
+"""
+Returns temporary credentials for roleArn, as keyword arguments for boto3.client, or {} when roleArn is empty.
+"""
+def get_role_credentials(roleArn):
+    if not roleArn: return {}
+    with get_role_lock(roleArn):
+        entry = _credentials.get(roleArn)
+        if not entry or is_expiring(entry['expiration']):
+            print ("Assuming role [{}]".format(roleArn))
+            response = get_sts_client().assume_role(RoleArn=roleArn, RoleSessionName=ROLE_SESSION_NAME)
+            entry = to_entry(response['Credentials'])
+            _credentials[roleArn] = entry
+        return entry['credentials']
+
+
+"""
+If running from inside a Lambda function, roles are assumed using the function's owner's credentials (and not the temp credentials
+given to the function). Instead of using the owner's credentials directly, we get a session token, otherwise we run into AccessDenied
+exceptions when using the same master credentials for assuming roles for multiple customer accounts. The session token is cached too.
+"""
+def get_sts_client():
+    ownerAccessKeyId = os.environ.get(consts.LAMBDA_OWNER_AWS_ACCESS_KEY_ID_VAR_KEY,'')
+    ownerSecretAccessKey = os.environ.get(consts.LAMBDA_OWNER_AWS_SECRET_ACCESS_KEY_VAR_KEY,'')
+    if not (ownerAccessKeyId and ownerSecretAccessKey):
+        #Assume role using the AWS credentials configured in the environment
+        return get_client('sts')
+
+    cacheKey = 'owner:' + ownerAccessKeyId
+    with get_role_lock(cacheKey):
+        entry = _credentials.get(cacheKey)
+        if not entry or is_expiring(entry['expiration']):
+            masterstsclient = boto3.client('sts', aws_access_key_id=ownerAccessKeyId, aws_secret_access_key=ownerSecretAccessKey)
+            entry = to_entry(masterstsclient.get_session_token()['Credentials'])
+            _credentials[cacheKey] = entry
+    return get_client('sts', credentials=entry['credentials'])
+
+
+"""
+Returns a cached client for a service, either with explicit credentials (i.e. passed to a worker process) or with the
+credentials of roleArn. maxPoolConnections is part of the cache key, since it can't be changed once the client is created.
+"""
+def get_client(service, roleArn='', credentials=None, maxPoolConnections=None):
+    if credentials is None:
+        credentials = get_role_credentials(roleArn)
+        owner = roleArn
+    else:
+        owner = 'key:{}'.format(credentials.get('aws_access_key_id',''))
+    with _lock:
+        cacheKey = ('client', service, owner, maxPoolConnections)
+        entry = _clients.get(cacheKey)
+        if not entry or entry['accessKeyId'] != credentials.get('aws_access_key_id'):
+            config = Config(max_pool_connections=maxPoolConnections) if maxPoolConnections else None
+            entry = {'accessKeyId':credentials.get('aws_access_key_id'), 'client':boto3.client(service, config=config, **credentials)}
+            _clients[cacheKey] = entry
+        return entry['client']
+
+
+def get_resource(service, roleArn=''):
+    credentials = get_role_credentials(roleArn)
+    if not hasattr(_threadResources, 'entries'): _threadResources.entries = {}
+    cacheKey = (service, roleArn)
+    entry = _threadResources.entries.get(cacheKey)
+    if not entry or entry['accessKeyId'] != credentials.get('aws_access_key_id'):
+        with _lock:
+            entry = {'accessKeyId':credentials.get('aws_access_key_id'), 'client':boto3.resource(service, **credentials)}
+        _threadResources.entries[cacheKey] = entry
+    return entry['client']
+
+
+"""
+Resources cached by other threads are released when those threads end, only the current thread's resources are removed here.
+"""
+def clear():
+    with _lock:
+        _credentials.clear()
+        _clients.clear()
+    _threadResources.entries = {}
+
+
+def to_entry(stsCredentials):
+    credentials = {'aws_access_key_id':stsCredentials['AccessKeyId'], 'aws_secret_access_key':stsCredentials['SecretAccessKey'],
+                   'aws_session_token':stsCredentials['SessionToken']}
+    return {'credentials':credentials, 'expiration':stsCredentials.get('Expiration')}
+
+
+def is_expiring(expiration):
+    if not expiration: return False
+    if not isinstance(expiration, datetime.datetime): return True #unknown format, don't risk using expired credentials
+    if expiration.tzinfo is None: expiration = expiration.replace(tzinfo=pytz.utc)
+    return expiration - datetime.datetime.now(pytz.utc) < datetime.timedelta(seconds=CREDENTIALS_REFRESH_MARGIN_SECONDS)
@@ -0,0 +1,152 @@
+import csv
+import array
+import logging
+
+import awscostusageprocessor.s3stream as s3stream
+from awscostusageprocessor.errors import ValidationError
+
+#numpy is an optional dependency, it's only needed for local analysis of report data (see localengine.py)
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+
+
+CODE_TYPECODE = 'I' #unsigned 32-bit codes while rows are added; built tables use the smallest integer type for each column
+NUMBER_TYPECODE = 'd'
+
+
+def is_available():
+    return np is not None
+
+
+"""
+Builds a CompactTable one row at a time, so report files can be loaded while they're streamed (i.e. from a GzipStreamReader),
+without keeping a Python string for every value. Categorical columns (product codes, usage types, regions, resource ids, dates...)
+repeat the same values in millions of rows: every distinct value is stored once in a dictionary and rows only keep its integer code.
+Numeric columns (cost, usage amount) are stored as doubles. Both are kept in array.array buffers, which take 4 and 8 bytes per value.
+
+categoricalColumns and numericColumns are lists of (name, index), where index is the position of the column in each row.
+The same column can be both categorical and numeric (i.e. a rate that is also used in a group by).
+"""
+
+class CompactTableBuilder():
+
+    def __init__(self, categoricalColumns, numericColumns):
+        self.categoricalColumns = categoricalColumns
+        self.numericColumns = numericColumns
+        self.dictionaries = dict([(name, {}) for name, index in categoricalColumns])
+        self.codes = dict([(name, array.array(CODE_TYPECODE)) for name, index in categoricalColumns])
+        self.numbers = dict([(name, array.array(NUMBER_TYPECODE)) for name, index in numericColumns])
+        self.rows = 0
+
+    def add_row(self, row):
+        for name, index in self.categoricalColumns:
+            self.codes[name].append(self.get_code(name, row[index]))
+        for name, index in self.numericColumns:
+            self.numbers[name].append(to_float(row[index]))
+        self.rows += 1
+
+    def add_rows(self, rows):
+        for row in rows:
+            self.add_row(row)
+
+    """
+    Adds the rows in a gzip-compressed CSV stream (i.e. the 'Body' of an S3 get_object response), decompressing it incrementally.
+    """
+    def add_gzip_csv(self, stream, skipHeader=False):
+        rows = csv.reader(s3stream.GzipStreamReader(stream).iter_lines())
+        if skipHeader: next(rows, None)
+        self.add_rows(rows)
+
+    """
+    Adds values for columnar sources (i.e. Parquet files), one column at a time. columns is a dictionary of name and list of values,
+    it must include all the columns the builder was created with, with the same number of values.
+    """
+    def add_columns(self, columns):
+        counts = set([len(values) for values in columns.values()])
+        if len(counts) > 1: raise ValidationError("All columns must have the same number of values, got {}".format(sorted(counts)))
+        for name, index in self.categoricalColumns:
+            codes = self.codes[name]
+            for value in columns[name]:
+                codes.append(self.get_code(name, value))
+        for name, index in self.numericColumns:
+            self.numbers[name].extend([to_float(v) for v in columns[name]])
+        if counts: self.rows += counts.pop()
+
+    def get_code(self, name, value):
+        if value is None: value = ''
+        dictionary = self.dictionaries[name]
+        code = dictionary.get(value)
+        if code is None:
+            code = dictionary[value] = len(dictionary)
+        return code
+
+    def build(self):
+        if not is_available():
+            raise ValidationError("numpy must be installed in order to build compact tables")
+        table = CompactTable(self.rows)
+        for name, index in self.categoricalColumns:
+            dictionary = [None] * len(self.dictionaries[name])
+            for value, code in self.dictionaries[name].items():
+                dictionary[code] = value
+            codes = np.frombuffer(self.codes[name], dtype=np.uint32) if self.rows else np.zeros(0, dtype=np.uint32)
+            table.add_categorical(name, dictionary, codes.astype(get_code_dtype(len(dictionary))))
+        for name, index in self.numericColumns:
+            numbers = np.frombuffer(self.numbers[name], dtype=np.float64) if self.rows else np.zeros(0, dtype=np.float64)
+            table.add_numeric(name, numbers.copy())
+        return table
+
+
+"""
+Report data with dictionary-encoded categorical columns and float64 numeric columns, see CompactTableBuilder.
+"""
+
+class CompactTable():
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.dictionaries = {}
+        self.codes = {}
+        self.numbers = {}
+
+    def add_categorical(self, name, dictionary, codes):
+        self.dictionaries[name] = dictionary
+        self.codes[name] = codes
+
+    def add_numeric(self, name, numbers):
+        self.numbers[name] = numbers
+
+    """
+    Returns the distinct values of a categorical column in sorted order, together with the codes of each row in that order.
+    Sorted codes mean that sorting rows by code is the same as sorting them by value. Only the dictionary is sorted, not the rows.
+    formatter is applied to distinct values before sorting (values that format the same way get the same code).
+    """
+    def get_sorted_codes(self, name, formatter=None):
+        dictionary = self.dictionaries[name]
+        if formatter: dictionary = [formatter(v) for v in dictionary]
+        uniques, inverse = np.unique(np.array(dictionary, dtype=object), return_inverse=True)
+        return uniques, inverse[self.codes[name]]
+
+    def get_values(self, name):
+        return np.array(self.dictionaries[name], dtype=object)[self.codes[name]]
+
+    def nbytes(self):
+        result = sum([a.nbytes for a in self.codes.values()]) + sum([a.nbytes for a in self.numbers.values()])
+        return result
+
+
+def get_code_dtype(size):
+    if size <= 2**8: return np.uint8
+    if size <= 2**16: return np.uint16
+    return np.uint32
+
+
+def to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
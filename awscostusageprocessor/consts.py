@@ -1,4 +1,5 @@
 import os
+import json
 
 #_/_/_/ CONFIG - START _/_/_/
 ATHENA_BASE_OUTPUT_S3_BUCKET = os.environ.get('ATHENA_BASE_OUTPUT_S3_BUCKET','')
@@ -6,11 +7,40 @@ CUR_PROCESSOR_DEST_S3_BUCKET=os.environ.get('CUR_PROCESSOR_DEST_S3_BUCKET','')
 CUR_PROCESSOR_DEST_S3_PREFIX=os.environ.get('CUR_PROCESSOR_DEST_S3_PREFIX','')
 
 AWS_ACCOUNT_METADATA_DDB_TABLE = os.environ.get('AWS_ACCOUNT_METADATA_DDB_TABLE','')
+AWS_ACCOUNT_METADATA_DDB_STATUS_INDEX = os.environ.get('AWS_ACCOUNT_METADATA_DDB_STATUS_INDEX','') #index on (dataCollectionStatus, lastProcessedTimestamp), the table is scanned if empty
+AWS_ACCOUNT_METADATA_DDB_SCAN_SEGMENTS = int(os.environ.get('AWS_ACCOUNT_METADATA_DDB_SCAN_SEGMENTS','4'))
 STEP_FUNCTION_PREPARE_CUR_ATHENA =  os.environ.get('STEP_FUNCTION_PREPARE_CUR_ATHENA','')
 SNS_TOPIC = os.environ.get('SNS_TOPIC','')
 
 AWS_DEFAULT_REGION = os.environ.get('AWS_DEFAULT_REGION', 'us-east-1')
 
+CUR_PROCESSOR_PROCESSING_MODE = os.environ.get('CUR_PROCESSOR_PROCESSING_MODE','stream')
+CUR_PROCESSOR_MULTIPART_PART_SIZE_MB = int(os.environ.get('CUR_PROCESSOR_MULTIPART_PART_SIZE_MB','16'))
+CUR_PROCESSOR_WORKERS = int(os.environ.get('CUR_PROCESSOR_WORKERS','1'))
+CUR_PROCESSOR_TYPED_SCHEMA = os.environ.get('CUR_PROCESSOR_TYPED_SCHEMA','false').lower() == 'true' #numeric and timestamp columns are typed in Athena tables
+CUR_PROCESSOR_PARTITION_BY_USAGE_DATE = os.environ.get('CUR_PROCESSOR_PARTITION_BY_USAGE_DATE','false').lower() == 'true' #usage_date=YYYY-MM-DD partitions within each month
+CUR_PROCESSOR_MAX_OPEN_PARTITIONS = int(os.environ.get('CUR_PROCESSOR_MAX_OPEN_PARTITIONS','8')) #usage date files written at the same time by each worker, rows for other days are spilled to local disk
+ATHENA_TABLE_LAYOUT = os.environ.get('ATHENA_TABLE_LAYOUT','monthly') #monthly (one table per billing period) or account (one table per account, partitioned by billing period)
+CUR_PROCESSOR_PARQUET_ROW_GROUP_ROWS = int(os.environ.get('CUR_PROCESSOR_PARQUET_ROW_GROUP_ROWS','25000'))
+CUR_PROCESSOR_INCREMENTAL = os.environ.get('CUR_PROCESSOR_INCREMENTAL','true').lower() == 'true' #skip report files that haven't changed since they were last processed
+CUR_PROCESSOR_SERVER_SIDE_COPY = os.environ.get('CUR_PROCESSOR_SERVER_SIDE_COPY','true').lower() == 'true' #QuickSight files are copied by S3, without downloading them
+CUR_PROCESSOR_ROLLUPS = os.environ.get('CUR_PROCESSOR_ROLLUPS','false').lower() == 'true' #API aggregates are calculated while Athena files are processed, rows are parsed instead of copied
+CUR_PROCESSOR_INCLUDE_COLUMNS = os.environ.get('CUR_PROCESSOR_INCLUDE_COLUMNS','') #comma-separated categories or category/name columns, see projection.CurProjection
+CUR_PROCESSOR_EXCLUDE_COLUMNS = os.environ.get('CUR_PROCESSOR_EXCLUDE_COLUMNS','')
+CUR_PROCESSOR_EXCLUDE_ROWS = json.loads(os.environ.get('CUR_PROCESSOR_EXCLUDE_ROWS','[]')) #i.e. [{"lineItem/LineItemType":"Tax","lineItem/UnblendedCost":"0"}]
+CUR_PROCESSOR_SHARD_SIZE_MB = int(os.environ.get('CUR_PROCESSOR_SHARD_SIZE_MB','128')) #uncompressed size of each Athena file, 0 means no sharding
+
+API_BACKEND = os.environ.get('API_BACKEND','athena') #athena or local, see api.ApiProcessor
+API_RESULT_STORE = os.environ.get('API_RESULT_STORE','true').lower() == 'true' #dashboard result sets are stored in S3 by init-athena-queries, see resultstore.py
+API_RESULT_STORE_CACHE_TTL_SECONDS = int(os.environ.get('API_RESULT_STORE_CACHE_TTL_SECONDS','300')) #stored result sets are kept in memory, 0 disables the cache
+API_RESULT_STORE_CACHE_MAX_ENTRIES = int(os.environ.get('API_RESULT_STORE_CACHE_MAX_ENTRIES','50'))
+ATHENA_QUERY_TIMEOUT_SECONDS = int(os.environ.get('ATHENA_QUERY_TIMEOUT_SECONDS','600')) #how long to wait for Athena queries before raising AthenaQueryTimeoutError
+ATHENA_S3_RESULTS_MIN_ROWS = int(os.environ.get('ATHENA_S3_RESULTS_MIN_ROWS','500')) #rows after the first ones are read from the result CSV file in S3, 0 means never
+ATHENA_METADATA_CACHE_TTL_SECONDS = int(os.environ.get('ATHENA_METADATA_CACHE_TTL_SECONDS','3600')) #metadata of completed query executions is cached in memory, 0 disables the cache
+
+XACCT_STARTER_WORKERS = int(os.environ.get('XACCT_STARTER_WORKERS','16')) #accounts evaluated concurrently by the xAcct Step Function starter
+XACCT_STARTER_ACCOUNT_TIMEOUT_SECONDS = int(os.environ.get('XACCT_STARTER_ACCOUNT_TIMEOUT_SECONDS','60'))
+
 LAMBDA_OWNER_AWS_ACCESS_KEY_ID_VAR_KEY = 'LAMBDA_OWNER_AWS_ACCESS_KEY_ID'
 LAMBDA_OWNER_AWS_SECRET_ACCESS_KEY_VAR_KEY = 'LAMBDA_OWNER_AWS_SECRET_ACCESS_KEY'
 
@@ -22,6 +52,7 @@ QUICKSIGHT = 'quicksight'
 
 
 ACTION_PREPARE_ATHENA = 'prepare-athena'
+ACTION_PREPARE_ATHENA_PARQUET = 'prepare-athena-parquet'
 ACTION_PREPARE_QUICKSIGHT = 'prepare-quicksight'
 ACTION_CREATE_MANIFEST = 'create-manifest'
 ACTION_TEST_ROLE = 'test-role'
@@ -43,6 +74,7 @@ ACTION_GET_RESOURCE_BY_SERVICE = 'get_resources_by_service'
 QUERY_ID_CREATE_DATABASE = 'create_database'
 QUERY_ID_CREATE_TABLE = 'create_table'
 QUERY_ID_DROP_TABLE = 'drop_table'
+QUERY_ID_ALTER_TABLE = 'alter_table'
 
 
 ATHENA_QUERY_STATE_SUCCEEDED = 'SUCCEEDED'
@@ -59,8 +91,39 @@ LAST_PROCESS_STATUS_FAILED = 'FAILED'
 CUR_PROCESSOR_STATUS_OK = 'OK'
 CUR_PROCESSOR_STATUS_ERROR = 'ERROR'
 CUR_PROCESSOR_STATUS_DETAILS_NA = 'NA'
+CUR_PROCESSOR_STATUS_DETAILS_TIMEOUT = 'AccountEvaluationTimeout'
+
+PROCESSING_MODE_STREAM = 'stream' #reads, rewrites and uploads each report file in one pass, without using local disk
+PROCESSING_MODE_LOCAL = 'local' #downloads each report file to a local tmp folder before uploading it
+VALID_PROCESSING_MODES = [PROCESSING_MODE_STREAM, PROCESSING_MODE_LOCAL]
+
+WORKER_TYPE_THREAD = 'thread'
+WORKER_TYPE_PROCESS = 'process'
+VALID_WORKER_TYPES = [WORKER_TYPE_THREAD, WORKER_TYPE_PROCESS]
+
+VALID_ACTIONS = [ACTION_PREPARE_ATHENA,ACTION_PREPARE_ATHENA_PARQUET,ACTION_PREPARE_QUICKSIGHT, ACTION_CREATE_MANIFEST, ACTION_TEST_ROLE]
+ATHENA_ACTIONS = [ACTION_PREPARE_ATHENA,ACTION_PREPARE_ATHENA_PARQUET]
+
+ROW_FILTER_ZERO_COST_TAX = {'lineItem/LineItemType':'Tax', 'lineItem/UnblendedCost':'0'}
+
+API_BACKEND_ATHENA = 'athena'
+API_BACKEND_LOCAL = 'local' #queries are answered in memory, see localengine.LocalQueryEngine
+VALID_API_BACKENDS = [API_BACKEND_ATHENA, API_BACKEND_LOCAL]
+
+USAGE_DATE_PARTITION_COLUMN = 'usage_date'
+USAGE_DATE_OUT_OF_PERIOD = 'out_of_period' #partition for line items that start before or after the billing period
+BILLING_PERIOD_PARTITION_COLUMN = 'billing_period' #i.e. 20170601-20170701, same as the period folder
+USAGE_DATE_FORMAT = '%Y-%m-%d'
+
+STORAGE_FORMAT_TEXTFILE = 'TEXTFILE'
+STORAGE_FORMAT_PARQUET = 'PARQUET'
+
+#Athena ignores folders and files that start with an underscore, see utils.get_hidden_folder
+ATHENA_HIDDEN_PREFIX = '_'
 
-VALID_ACTIONS = [ACTION_PREPARE_ATHENA,ACTION_PREPARE_QUICKSIGHT, ACTION_CREATE_MANIFEST, ACTION_TEST_ROLE]
+ATHENA_TABLE_LAYOUT_MONTHLY = 'monthly'
+ATHENA_TABLE_LAYOUT_ACCOUNT = 'account'
+VALID_ATHENA_TABLE_LAYOUTS = [ATHENA_TABLE_LAYOUT_MONTHLY, ATHENA_TABLE_LAYOUT_ACCOUNT]
 
 TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%f%Z'
 EPOCH_TS = '1970-01-01T00:00:00.000000UTC'
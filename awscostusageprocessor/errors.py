@@ -16,7 +16,14 @@ class AthenaExecutionFailedException(Exception):
     def __init__(self, message):
         self.message = message
 
+class AthenaQueryTimeoutError(Exception):
+    def __init__(self, message):
+        self.message = message
+
 class AwsPayerAccountNotFoundError(Exception):
     def __init__(self, message):
         self.message = message
 
+class CurProcessingError(Exception):
+    def __init__(self, message):
+        self.message = message
@@ -0,0 +1,122 @@
+import json
+import hashlib
+import logging
+import datetime
+
+import pytz
+from botocore.exceptions import ClientError as BotoClientError
+
+import awscostusageprocessor.utils as utils
+import awscostusageprocessor.consts as consts
+
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+
+
+LEDGER_VERSION = 1
+LEDGER_FOLDER = utils.get_hidden_folder('processing_ledger')
+
+#Job settings that change the content or the location of the files written for a report file
+FINGERPRINT_JOB_FIELDS = ['action', 'processingMode', 'destKey', 'shardSize', 'columns', 'columnIndexes', 'rowRules', 'rowGroupRows',
+                          'partitionDates', 'rollupKey']
+
+
+"""
+AWS updates the Cost and Usage report for the current month several times per day, but most report files don't change
+between updates. The processing ledger keeps track of every report file that was processed for a period: source ETag and size,
+the settings used to process it and the keys of the files that were written. Report files with the same ETag, processed
+with the same settings, don't need to be downloaded and written again.
+
+There's one ledger per period (i.e. <destPrefix>/<accountId>/_processing_ledger/20170601-20170701.json), with a section for each action.
+Entries are keyed by file name, since AWS writes every update of the report under a new folder (assemblyId).
+"""
+
+class ProcessingLedger():
+
+    def __init__(self, s3client, bucket, key):
+        self.s3client = s3client
+        self.bucket = bucket
+        self.key = key
+        self.content = {'version':LEDGER_VERSION, 'actions':{}}
+
+    def load(self):
+        try:
+            response = self.s3client.get_object(Bucket=self.bucket, Key=self.key)
+            content = json.loads(response['Body'].read())
+            if content.get('version') == LEDGER_VERSION: self.content = content
+            else: log.info("Ignoring ledger [s3://{}/{}] with version [{}]".format(self.bucket, self.key, content.get('version')))
+        except BotoClientError as bce:
+            if bce.response['Error']['Code'] not in ('NoSuchKey', '404'): raise
+            log.info("No processing ledger found in [s3://{}/{}]".format(self.bucket, self.key))
+        return self
+
+    def save(self, assemblyId, manifestKey):
+        self.content.update({'assemblyId':assemblyId, 'manifestKey':manifestKey,
+                             'lastUpdated':datetime.datetime.now(pytz.utc).strftime(consts.TIMESTAMP_FORMAT)})
+        self.s3client.put_object(Bucket=self.bucket, Key=self.key, Body=json.dumps(self.content, indent=4, sort_keys=True),
+                                 ContentType='application/json')
+        log.info("Saved processing ledger [s3://{}/{}]".format(self.bucket, self.key))
+
+    """
+    Athena files don't have a header, so the columns they were written with are kept in the ledger, together with the action
+    that prepared the files currently in the Athena table location. This is what allows reading the files without Athena.
+    """
+    def set_table_files(self, action, columns):
+        self.content['actions'].setdefault(action, {'files':{}})['columns'] = columns
+        self.content['tableAction'] = action
+
+    def get_table_files(self):
+        action = self.content.get('tableAction','')
+        section = self.content['actions'].get(action, {})
+        keys = []
+        for name in sorted(section.get('files',{}).keys()):
+            keys.extend(section['files'][name]['destKeys'])
+        return action, section.get('columns',[]), keys
+
+    def get_files(self, action):
+        return self.content['actions'].setdefault(action, {'files':{}})['files']
+
+    """
+    Returns the ledger entry for a report file if it was already processed with the same content (ETag and size)
+    and the same settings, and all the files it produced (including its partial rollup) still exist. Otherwise returns None.
+    """
+    def get_current_entry(self, job, sourceObject, existingKeys):
+        entry = self.get_files(job['action']).get(get_file_name(job['sourceKey']))
+        if not entry or not sourceObject: return None
+        if entry['etag'] != sourceObject['etag'] or entry['size'] != sourceObject['size']: return None
+        if entry['fingerprint'] != get_job_fingerprint(job): return None
+        if not entry['destKeys'] or not set(entry['destKeys']).issubset(existingKeys): return None
+        if entry.get('rollupKey') and entry['rollupKey'] not in existingKeys: return None
+        return entry
+
+    def record(self, job, sourceObject, result):
+        entry = {'sourceKey':job['sourceKey'], 'etag':sourceObject['etag'], 'size':sourceObject['size'],
+                 'fingerprint':get_job_fingerprint(job), 'destKeys':result['destKeys']}
+        for k in ('records', 'invalidValues', 'excludedRecords', 'rollupKey'):
+            if k in result: entry[k] = result[k]
+        self.get_files(job['action'])[get_file_name(job['sourceKey'])] = entry
+
+    def remove(self, job):
+        self.get_files(job['action']).pop(get_file_name(job['sourceKey']), None)
+
+    """
+    Only report files that are part of the latest report are kept, so the ledger doesn't grow with files that don't exist anymore.
+    """
+    def retain(self, action, sourceKeys):
+        names = set([get_file_name(k) for k in sourceKeys])
+        files = self.get_files(action)
+        for name in files.keys():
+            if name not in names: del files[name]
+
+
+def get_ledger_key(destPrefix, accountId, year, month):
+    return "{}{}/{}/{}.json".format(destPrefix, accountId, LEDGER_FOLDER, utils.get_period_prefix(year, month).rstrip('/'))
+
+
+def get_file_name(sourceKey):
+    return sourceKey.split('/')[-1]
+
+
+def get_job_fingerprint(job):
+    settings = dict([(f, job.get(f)) for f in FINGERPRINT_JOB_FIELDS])
+    return hashlib.sha256(json.dumps(settings, sort_keys=True)).hexdigest()
@@ -0,0 +1,167 @@
+import io
+import time
+import logging
+
+import awscostusageprocessor.consts as consts
+import awscostusageprocessor.ledger as ledger
+import awscostusageprocessor.schema as schema
+import awscostusageprocessor.compacttable as compacttable
+import awscostusageprocessor.parquetwriter as parquetwriter
+from awscostusageprocessor.compacttable import np
+from awscostusageprocessor.errors import ValidationError
+
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+
+
+COST = 'lineitem_unblendedcost'
+USAGE_AMOUNT = 'lineitem_usageamount'
+USAGE_START_DATE = 'lineitem_usagestartdate'
+RESOURCE_ID = 'lineitem_resourceid'
+
+NUMERIC_COLUMNS = [COST, USAGE_AMOUNT, 'lineitem_unblendedrate']
+
+#The queries in queries.properties, expressed as a group by: columns in the result, sums (column, result name), rounding and sort order.
+#orderBy is either a sum, in descending order (ORDER BY sum_unblendedcost DESC), or 'group' to sort by the group columns.
+LOCAL_QUERIES = {
+    consts.ACTION_GET_TOTAL_COST: {'groupBy':[], 'sums':[(COST, 'sum_unblendedcost')], 'round':True, 'orderBy':'sum_unblendedcost'},
+    consts.ACTION_GET_HOURLY_COST: {'groupBy':[USAGE_START_DATE], 'sums':[(COST, 'sum_unblendedcost')], 'round':False, 'orderBy':'group'},
+    consts.ACTION_GET_COST_BY_SERVICE: {'groupBy':['lineitem_productcode'], 'sums':[(COST, 'sum_unblendedcost')], 'round':True, 'orderBy':'sum_unblendedcost'},
+    consts.ACTION_GET_COST_BY_USAGE_TYPE: {'groupBy':['lineitem_productcode', 'lineitem_usagetype'], 'sums':[(COST, 'sum_unblendedcost')],
+                                           'round':True, 'orderBy':'sum_unblendedcost'},
+    consts.ACTION_GET_COST_BY_RESOURCE: {'groupBy':['lineitem_productcode', 'product_region', RESOURCE_ID], 'sums':[(COST, 'sum_unblendedcost')],
+                                         'round':True, 'orderBy':'sum_unblendedcost'},
+    consts.ACTION_GET_USAGE_BY_RESOURCE_ID: {'groupBy':['lineitem_usagetype', 'lineitem_lineitemdescription', 'lineitem_unblendedrate'],
+                                             'sums':[(USAGE_AMOUNT, 'sum_usageamount'), (COST, 'sum_unblendedcost')],
+                                             'round':False, 'orderBy':'sum_unblendedcost', 'where':RESOURCE_ID, 'whereParam':'resourceid'}
+}
+
+QUERY_COLUMNS = sorted(set([USAGE_START_DATE] + [c for q in LOCAL_QUERIES.values() for c in q['groupBy'] + [s[0] for s in q['sums']] + [q.get('where',USAGE_START_DATE)]]))
+
+
+def is_available():
+    return compacttable.is_available()
+
+
+"""
+Answers the API queries (see LOCAL_QUERIES) in memory, without Athena. The Athena files for a period are loaded into
+a compact table (only the columns the queries use) and every query is a vectorized group by: group columns are encoded as integer codes
+once, and sums are calculated with numpy.bincount. This is meant for accounts whose monthly report fits in memory, and for testing
+queries offline. Results have the same format as AthenaQueryMgr.get_query_execution_results.
+"""
+
+class LocalQueryEngine():
+
+    def __init__(self, columns):
+        if not is_available():
+            raise ValidationError("numpy must be installed in order to use the local query engine")
+        self.names = [c['name'] for c in columns]
+        self.types = dict([(c['name'], c.get('type', schema.ATHENA_TYPE_STRING)) for c in columns])
+        self.indexes = [(c, self.names.index(c)) for c in QUERY_COLUMNS if c in self.names]
+        self.builder = compacttable.CompactTableBuilder(self.indexes, [(c, i) for c, i in self.indexes if c in NUMERIC_COLUMNS])
+        self.rows = 0
+        self.codes = {}
+        self.uniques = {}
+        self.numbers = {}
+
+    """
+    Rows are complete rows in an Athena file, with values in the same order as the columns the engine was created with.
+    """
+    def add_rows(self, rows):
+        self.builder.add_rows(rows)
+
+    def add_file(self, s3client, bucket, key):
+        response = s3client.get_object(Bucket=bucket, Key=key)
+        if key.endswith('.parquet'):
+            if not parquetwriter.is_available(): raise ValidationError("pyarrow must be installed in order to read Parquet files")
+            table = parquetwriter.pq.read_table(io.BytesIO(response['Body'].read()), columns=[c for c, i in self.indexes])
+            self.builder.add_columns(dict([(c, table.column(c).to_pylist()) for c, i in self.indexes]))
+        else:
+            self.builder.add_gzip_csv(response['Body'])
+
+    """
+    Converts the values that were added into arrays (see compacttable.CompactTable). Missing columns are treated as empty values.
+    Group codes are sorted, so groups come out of group_by in the same order as their values.
+    """
+    def build(self):
+        table = self.builder.build()
+        self.rows = table.rows
+        for c in QUERY_COLUMNS:
+            if c not in table.codes:
+                self.uniques[c], self.codes[c] = np.array([''], dtype=object), np.zeros(self.rows, dtype=np.intp)
+                if c in NUMERIC_COLUMNS: self.numbers[c] = np.zeros(self.rows, dtype=np.float64)
+                continue
+            if c in NUMERIC_COLUMNS: self.numbers[c] = np.nan_to_num(table.numbers[c])
+            #only distinct values are formatted
+            formatter = schema.format_athena_timestamp if self.types.get(c) == schema.ATHENA_TYPE_TIMESTAMP else None
+            self.uniques[c], self.codes[c] = table.get_sorted_codes(c, formatter)
+        log.info("Local query engine table: [{}] rows, [{}] bytes".format(self.rows, table.nbytes()))
+        self.builder = None
+        return self
+
+    def execute(self, action, startDate='', endDate='', **kargs):
+        query = LOCAL_QUERIES.get(action)
+        if not query: raise ValidationError("Query [{}] is not supported by the local query engine".format(action))
+        mask = np.ones(self.rows, dtype=bool)
+        if startDate or endDate:
+            days = self.uniques[USAGE_START_DATE]
+            inrange = np.array([(not startDate or d[0:10] >= startDate) and (not endDate or d[0:10] <= endDate) for d in days], dtype=bool)
+            mask &= inrange[self.codes[USAGE_START_DATE]]
+        if 'where' in query:
+            value = kargs.get(query['whereParam'], '')
+            matches = np.array([u == value for u in self.uniques[query['where']]], dtype=bool)
+            mask &= matches[self.codes[query['where']]]
+
+        groups, sums = self.group_by(mask, query['groupBy'], [s[0] for s in query['sums']])
+        result = []
+        for g, key in enumerate(groups):
+            row = dict(zip(query['groupBy'], key))
+            if 'lineitem_unblendedrate' in row: row['lineitem_unblendedrate'] = repr(to_float(row['lineitem_unblendedrate']))#cast(... AS double)
+            for (c, name), values in zip(query['sums'], sums):
+                value = values[g]
+                if query['round']: value = round(value, 2)
+                row[name] = repr(float(value))
+            result.append(row)
+
+        if query['orderBy'] != 'group':
+            result.sort(key=lambda r: (-float(r[query['orderBy']]), [r[c] for c in query['groupBy']]))
+        return result
+
+    """
+    Returns the distinct values of the group columns (as tuples) for the rows in mask and, for each one, the sum of each sum column.
+    Group codes of the different columns are combined into a single integer, so a single numpy.unique call finds all groups.
+    """
+    def group_by(self, mask, columns, sumColumns):
+        if not columns:
+            return [()], [np.array([self.numbers[c][mask].sum()]) for c in sumColumns]
+        dims = [max(len(self.uniques[c]), 1) for c in columns]
+        combined = np.ravel_multi_index([self.codes[c][mask] for c in columns], dims)
+        keys, inverse = np.unique(combined, return_inverse=True)
+        sums = [np.bincount(inverse, weights=self.numbers[c][mask], minlength=len(keys)) for c in sumColumns]
+        decoded = np.unravel_index(keys, dims)
+        groups = zip(*[self.uniques[c][codes] for c, codes in zip(columns, decoded)])
+        return groups, sums
+
+
+"""
+Loads the Athena files of a period, using the processing ledger to find the files and their columns (see ledger.get_table_files).
+"""
+def load_engine(s3client, bucket, destPrefix, accountId, year, month):
+    start = time.time()
+    processingLedger = ledger.ProcessingLedger(s3client, bucket, ledger.get_ledger_key(destPrefix, accountId, year, month)).load()
+    action, columns, keys = processingLedger.get_table_files()
+    if not keys:
+        raise ValidationError("No processed files found for account [{}] - year [{}] - month [{}]".format(accountId, year, month))
+    engine = LocalQueryEngine(columns)
+    for key in keys:
+        engine.add_file(s3client, bucket, key)
+    engine.build()
+    log.info("Loaded [{}] rows from [{}] files in [{}] seconds".format(engine.rows, len(keys), round(time.time()-start, 3)))
+    return engine
+
+
+def to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
@@ -0,0 +1,101 @@
+import logging
+
+import awscostusageprocessor.s3stream as s3stream
+import awscostusageprocessor.schema as schema
+from awscostusageprocessor.errors import ValidationError
+
+#pyarrow is an optional dependency, it's only needed for Parquet files (preparing them for Athena, or reading them in localengine.py)
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+
+
+DEFAULT_ROW_GROUP_ROWS = 25000
+
+
+def is_available():
+    return pa is not None
+
+
+def get_arrow_type(athenaType):
+    if athenaType == schema.ATHENA_TYPE_DOUBLE: return pa.float64()
+    if athenaType == schema.ATHENA_TYPE_BIGINT: return pa.int64()
+    if athenaType == schema.ATHENA_TYPE_TIMESTAMP: return pa.timestamp('ms')#timestamps are parsed as epoch milliseconds
+    return pa.string()
+
+
+"""
+Converts rows from a Cost and Usage report into Parquet files (shards) in S3. Values in typed columns must already be parsed
+(see schema.ValueConverter). Rows are buffered until a row group is complete; row groups are written with dictionary encoding
+(CUR columns have very few distinct values) and column statistics, so Athena can skip row groups and only read the columns a query needs.
+Shard keys are generated from key_template using a 1-based shard number, i.e. 'prefix/cost-and-usage-athena-0001-{shard:04d}.parquet'.
+A new shard is started once the current one reaches target_shard_bytes (compressed). A target_shard_bytes of 0 means a single shard.
+"""
+
+class ParquetShardWriter():
+
+    def __init__(self, s3client, bucket, key_template, columns, target_shard_bytes, row_group_rows=DEFAULT_ROW_GROUP_ROWS,
+                 extra_args=None, part_size=s3stream.MIN_MULTIPART_PART_SIZE):
+        if not is_available():
+            raise ValidationError("pyarrow must be installed in order to prepare Parquet files")
+        self.s3client = s3client
+        self.bucket = bucket
+        self.key_template = key_template
+        self.names = [c['name'] for c in columns]
+        self.schema = pa.schema([pa.field(c['name'], get_arrow_type(c.get('type',''))) for c in columns])
+        self.target_shard_bytes = target_shard_bytes
+        self.row_group_rows = row_group_rows
+        self.extra_args = extra_args or {}
+        self.part_size = part_size
+        self.keys = []
+        self.sink = None
+        self.writer = None
+        self.rows = []
+        self.row_count = 0
+
+    def open_shard(self):
+        key = self.key_template.format(shard=len(self.keys)+1)
+        self.sink = s3stream.S3MultipartUploadWriter(self.s3client, self.bucket, key, self.extra_args, self.part_size)
+        self.writer = pq.ParquetWriter(self.sink, self.schema, compression='snappy', use_dictionary=True, write_statistics=True)
+        self.keys.append(key)
+
+    def close_shard(self):
+        self.writer.close()
+        self.sink.close()
+        self.writer = None
+        self.sink = None
+
+    def write_row(self, row):
+        if len(row) != len(self.names):
+            raise ValidationError("Expected [{}] values per row, got [{}] - row: [{}]".format(len(self.names), len(row), row))
+        self.rows.append(row)
+        self.row_count += 1
+        if len(self.rows) >= self.row_group_rows:
+            self.write_row_group()
+
+    def write_row_group(self):
+        if not self.rows: return
+        if self.writer is None: self.open_shard()
+        arrays = []
+        for values, field in zip(zip(*self.rows), self.schema):
+            arrays.append(pa.array(list(values), type=field.type))
+        self.writer.write_table(pa.Table.from_arrays(arrays, names=self.names))
+        self.rows = []
+        if self.target_shard_bytes > 0 and self.sink.tell() >= self.target_shard_bytes:
+            self.close_shard()
+
+    def close(self):
+        self.write_row_group()
+        if self.writer: self.close_shard()
+
+    def abort(self):
+        if self.sink: self.sink.abort()
+        self.writer = None
+        self.sink = None
+        self.rows = []
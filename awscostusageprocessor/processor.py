@@ -1,15 +1,19 @@
 #!/usr/bin/python
 import sys
 import json, pytz, datetime
+import csv
 import gzip
 import os
 import traceback
-import boto3
-import utils, consts
-from errors import ManifestNotFoundError, CurBucketNotFoundError
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import utils, consts, s3stream, parquetwriter, schema, ledger, rollups, projection, clients
+from errors import ManifestNotFoundError, CurBucketNotFoundError, CurProcessingError, ValidationError
 
 from botocore.exceptions import ClientError as BotoClientError
 
+USAGE_DATE_PARTITION_COLUMN_SOURCE = 'lineitem_usagestartdate'
+
 class CostUsageProcessor():
     def __init__(self, **args):
         self.s3sourceclient = None
@@ -30,18 +34,37 @@ class CostUsageProcessor():
         self.xAccountDest = args.get('xAccountDest',False)
         self.roleArn = args.get('roleArn','')
         self.accountId = args.get('accountId','')
+        self.processingMode = args.get('processingMode', consts.CUR_PROCESSOR_PROCESSING_MODE)
+        self.workers = int(args.get('workers', consts.CUR_PROCESSOR_WORKERS))
+        self.workerType = args.get('workerType', consts.WORKER_TYPE_THREAD)
+        self.shardSizeMB = int(args.get('shardSizeMB', consts.CUR_PROCESSOR_SHARD_SIZE_MB))
+        self.typedSchema = args.get('typedSchema', consts.CUR_PROCESSOR_TYPED_SCHEMA)
+        self.partitionByUsageDate = args.get('partitionByUsageDate', consts.CUR_PROCESSOR_PARTITION_BY_USAGE_DATE)
+        self.incremental = args.get('incremental', consts.CUR_PROCESSOR_INCREMENTAL)
+        self.serverSideCopy = args.get('serverSideCopy', consts.CUR_PROCESSOR_SERVER_SIDE_COPY)
+        self.rollups = args.get('rollups', consts.CUR_PROCESSOR_ROLLUPS)
+        self.includeColumns = projection.parse_column_selectors(args.get('includeColumns', consts.CUR_PROCESSOR_INCLUDE_COLUMNS))
+        self.excludeColumns = projection.parse_column_selectors(args.get('excludeColumns', consts.CUR_PROCESSOR_EXCLUDE_COLUMNS))
+        self.excludeRows = args.get('excludeRows', consts.CUR_PROCESSOR_EXCLUDE_ROWS)
+        self.sourceCredentials = {}
+        self.destCredentials = {}
 
         self.validate()
         self.init_clients()
 
         self.aws_manifest_lastmodified_ts = datetime.datetime.strptime(consts.EPOCH_TS, consts.TIMESTAMP_FORMAT).replace(tzinfo=pytz.utc)
 
-        self.latest_manifest_key = self.get_latest_aws_manifest_key()
+        self.latest_manifest_key = ''
+        self.curManifestJson = None
         self.curManifestJson = self.get_aws_manifest_content()
 
         if not self.accountId:
             self.accountId = self.curManifestJson.get('account','')
 
+        #Columns and rows written to Athena files, the Athena table must be created using outputManifestJson
+        self.projection = projection.CurProjection(self.curManifestJson.get('columns',[]), self.includeColumns, self.excludeColumns, self.excludeRows)
+        self.outputManifestJson = self.projection.get_manifest(self.curManifestJson)
+
 
 
     """
@@ -59,99 +82,342 @@ class CostUsageProcessor():
 
     def process_latest_aws_cur(self, action):
 
-      if action in (consts.ACTION_PREPARE_ATHENA, consts.ACTION_PREPARE_QUICKSIGHT):
+      if action in (consts.ACTION_PREPARE_ATHENA, consts.ACTION_PREPARE_ATHENA_PARQUET, consts.ACTION_PREPARE_QUICKSIGHT):
         if not utils.is_valid_prefix(self.destPrefix):
           raise Exception ("Invalid Destination S3 Bucket prefix: [{}]".format(self.destPrefix))
 
+      if action == consts.ACTION_PREPARE_ATHENA_PARQUET or (action in consts.ATHENA_ACTIONS and (self.typedSchema or self.partitionByUsageDate or self.projection.is_active())):
+        if self.processingMode != consts.PROCESSING_MODE_STREAM:
+          raise ValidationError("Action [{}] with typedSchema [{}], partitionByUsageDate [{}] or a column/row projection is only supported in processing mode [{}]".format(
+                                    action, self.typedSchema, self.partitionByUsageDate, consts.PROCESSING_MODE_STREAM))
+      if action in consts.ATHENA_ACTIONS:
+        schema.validate_storage_format(self.typedSchema, utils.get_storage_format(action))
+      if action == consts.ACTION_PREPARE_ATHENA_PARQUET:
+        if not parquetwriter.is_available():
+          raise ValidationError("pyarrow must be installed in order to execute action [{}]".format(action))
+
       period_prefix = utils.get_period_prefix(self.year, self.month)
       monthSourcePrefix = self.sourcePrefix + period_prefix
       monthDestPrefix = '{}{}/{}'.format(self.destPrefix, self.accountId, period_prefix)
       report_keys = self.get_latest_aws_cur_keys(self.sourceBucket, monthSourcePrefix, self.s3sourceclient )
-      destS3keys = []
 
-      #Get content for all report files
-      for rk in report_keys:
+      #Athena files can be partitioned by usage date, within the month
+      partitionDates = ()
+      if action in consts.ATHENA_ACTIONS and self.partitionByUsageDate:
+        partitionDates = utils.get_period_dates(self.year, self.month)
+
+      #Aggregates served by the API are calculated while Athena files are written, see rollups.RollupAccumulator
+      rollupsPrefix = ''
+      if action in consts.ATHENA_ACTIONS and self.rollups and self.processingMode == consts.PROCESSING_MODE_STREAM:
+        rollupsPrefix = rollups.get_rollups_prefix(self.destPrefix, self.accountId, self.year, self.month)
 
+      sourceObjects = self.get_source_objects(report_keys)
+
+      jobs = []
+      for index, rk in enumerate(report_keys):
         tokens = rk.split("/")
-        hash = tokens[len(tokens)-2]
+        jobs.append({
+            'action': action,
+            'index': index,
+            'processingMode': self.processingMode,
+            'sourceBucket': self.sourceBucket,
+            'sourceKey': rk,
+            'sourceSize': sourceObjects.get(rk, {}).get('size', -1),
+            'destBucket': self.destBucket,
+            'destPrefix': monthDestPrefix,
+            'destKey': self.get_dest_s3_key(action, monthDestPrefix, index, len(report_keys)),
+            'reportId': tokens[len(tokens)-2],
+            'partSize': consts.CUR_PROCESSOR_MULTIPART_PART_SIZE_MB*1024*1024,
+            'shardSize': self.shardSizeMB*1024*1024,
+            'columns': self.get_output_columns(),
+            'sourceColumnCount': len(self.curManifestJson.get('columns',[])),
+            'columnIndexes': self.projection.indexes if action in consts.ATHENA_ACTIONS and self.projection.is_active() else None,
+            'rowRules': self.projection.rules if action in consts.ATHENA_ACTIONS else [],
+            'rowGroupRows': consts.CUR_PROCESSOR_PARQUET_ROW_GROUP_ROWS,
+            'partitionDates': partitionDates,
+            'maxOpenPartitions': consts.CUR_PROCESSOR_MAX_OPEN_PARTITIONS,
+            'serverSideCopy': action == consts.ACTION_PREPARE_QUICKSIGHT and self.serverSideCopy,
+            'rollupKey': rollups.get_partial_key(rollupsPrefix, action, rk) if rollupsPrefix else ''
+        })
+
+      #Report files that haven't changed since they were last processed (same ETag and settings) are not processed again
+      processingLedger = ledger.ProcessingLedger(self.s3destclient, self.destBucket,
+                                                 ledger.get_ledger_key(self.destPrefix, self.accountId, self.year, self.month)).load()
+      basename = self.get_dest_s3_basename(action)
+      existingKeys = self.get_dest_keys(monthDestPrefix, basename)
+      processedKeys = set(existingKeys)
+      if rollupsPrefix: processedKeys.update(self.get_dest_keys(rollups.get_partials_prefix(rollupsPrefix, action), ''))
+      results = []
+      pendingJobs = []
+      for job in jobs:
+        entry = None
+        if self.incremental: entry = processingLedger.get_current_entry(job, sourceObjects.get(job['sourceKey']), processedKeys)
+        if entry: results.append({'index':job['index'], 'sourceKey':job['sourceKey'], 'destKeys':entry['destKeys'], 'error':'', 'skipped':True})
+        else: pendingJobs.append(job)
+      print "Unchanged report files: [{}] - report files to process: [{}]".format(len(results), len(pendingJobs))
+
+      #Get content for all report files
+      results.extend(self.run_report_key_jobs(pendingJobs))
+      results.sort(key=lambda r: r['index'])
+
+      #The ledger is updated even if some files failed, so files that were processed successfully are not processed again
+      for job, r in zip(jobs, results):
+        if r['error']: processingLedger.remove(job)
+        elif not r.get('skipped') and job['sourceKey'] in sourceObjects: processingLedger.record(job, sourceObjects[job['sourceKey']], r)
+      processingLedger.retain(action, report_keys)
+      if action in consts.ATHENA_ACTIONS: processingLedger.set_table_files(action, self.get_output_columns())
+      processingLedger.save(self.curManifestJson.get('assemblyId',''), self.latest_manifest_key)
+
+      errors = [r for r in results if r['error']]
+      if errors:
+        self.status = consts.CUR_PROCESSOR_STATUS_ERROR
+        self.statusDetails = "Failed to process [{}] of [{}] report files: {}".format(len(errors), len(results),
+                                    "; ".join(["[{}] {}".format(r['sourceKey'], r['error']) for r in errors]))
+        raise CurProcessingError(self.statusDetails)
+
+      destS3keys = []
+      for r in results: destS3keys.extend(r['destKeys'])
+
+      #Only remove files from previous executions once all new files are in place
+      self.delete_stale_objects(monthDestPrefix, basename, destS3keys, existingKeys)
+      if rollupsPrefix: self.update_rollups(rollupsPrefix, jobs)
+
+      self.status = consts.CUR_PROCESSOR_STATUS_OK
+
+      return destS3keys
+
+
+    """
+    Report files are independent from each other, so they can be processed concurrently. Threads are a good fit since most of the
+    work is S3 I/O and zlib releases the GIL; processes can be used when there are more cores than the gzip work can use in threads.
+    Processes are not available inside Lambda functions (there is no /dev/shm), use threads there.
+    Results are returned in the same order as the jobs, regardless of the order in which they complete.
+    """
+
+    def run_report_key_jobs(self, jobs):
+        workers = min(self.workers, len(jobs))
+        if workers <= 1:
+            return [self.process_report_key_job(job) for job in jobs]
+
+        print "Processing [{}] report files using [{}] {} workers".format(len(jobs), workers, self.workerType)
+        if self.workerType == consts.WORKER_TYPE_PROCESS:
+            for job in jobs:
+                job['sourceCredentials'] = self.sourceCredentials
+                job['destCredentials'] = self.destCredentials
+            pool = multiprocessing.Pool(workers)
+            jobfunction = process_report_key_job
+        else:
+            pool = ThreadPool(workers)
+            jobfunction = self.process_report_key_job
+        try:
+            results = pool.map(jobfunction, jobs)
+        finally:
+            pool.close()
+            pool.join()
+        return results
+
+
+    """
+    Processes a single report file. Errors are not raised, they're returned with the result so they can be aggregated for all files.
+    """
+
+    def process_report_key_job(self, job):
+        result = {'index':job['index'], 'sourceKey':job['sourceKey'], 'destKeys':[], 'error':''}
+        try:
+            print "Putting: [{}/{}] in [{}/{}] - processingMode: [{}]".format(job['sourceBucket'],job['sourceKey'],job['destBucket'],job['destKey'],job['processingMode'])
+            copied = copy_report_key(job, self.s3sourceclient, self.s3destclient)
+            if copied:
+                result.update(copied)
+            elif job['processingMode'] == consts.PROCESSING_MODE_LOCAL:
+                result['destKeys'] = self.process_report_key_local(job)
+            else:
+                result.update(stream_report_key(job, self.s3sourceclient, self.s3destclient))
+        except Exception as e:
+            traceback.print_exc()
+            result['error'] = "{}: {}".format(type(e).__name__, e)
+        return result
+
+
+    """
+    Every report file is put in its own destination key, so files can be processed in any order without overwriting each other.
+    Athena files are split in shards, therefore their key is a template with a {shard} placeholder.
+    Keys are deterministic, which means a new execution for the same period overwrites the files of the previous one.
+    """
+
+    def get_dest_s3_key(self, action, monthDestPrefix, index, count):
+        basename = self.get_dest_s3_basename(action)
+        if action == consts.ACTION_PREPARE_ATHENA:
+            return monthDestPrefix + basename + "-{:04d}-{{shard:04d}}.csv.gz".format(index+1)
+        if action == consts.ACTION_PREPARE_ATHENA_PARQUET:
+            return monthDestPrefix + basename + "-{:04d}-{{shard:04d}}.parquet".format(index+1)
+        if count > 1: basename += "-{:04d}".format(index+1)
+        return monthDestPrefix + basename + ".csv.gz"
+
+    #CSV and Parquet files share the same base name, this way switching formats doesn't leave files of the other format in the table location
+    def get_dest_s3_basename(self, action):
+        basename = ''
+        if action in consts.ATHENA_ACTIONS: basename = "cost-and-usage-athena"
+        if action == consts.ACTION_PREPARE_QUICKSIGHT: basename = "cost-and-usage-quicksight"
+        return basename
+
+
+    """
+    Removes data files from previous executions for the same period that were not written by the current execution
+    (i.e. the previous report had more files or more shards). This only happens after all new files have been written,
+    so a failed execution never leaves a period with missing data. S3 doesn't support transactions across objects, but stale
+    keys are removed using batched delete_objects calls (up to 1000 keys per request) right after the new files are in place.
+    """
+
+    def delete_stale_objects(self, prefix, basename, keepKeys, existingKeys=None):
+        keep = set(keepKeys)
+        if existingKeys is None: existingKeys = self.get_dest_keys(prefix, basename)
+        stale = sorted([k for k in existingKeys if k not in keep])
+
+        for i in range(0, len(stale), 1000):
+            self.s3destclient.delete_objects(Bucket=self.destBucket,
+                                             Delete={'Objects':[{'Key':k} for k in stale[i:i+1000]], 'Quiet':True})
+        print "Deleted [{}] stale objects from [{}/{}]".format(len(stale), self.destBucket, prefix)
+        return stale
 
 
-        response = self.s3sourceclient.get_object(Bucket=self.sourceBucket, Key=rk)
+    """
+    Combines the partial rollups of all report files (processed in this execution or in a previous one) into the rollups for the period.
+    If a partial rollup is missing, rollups for the period are removed, this way the API never serves rollups that don't match the data.
+    """
+
+    def update_rollups(self, rollupsPrefix, jobs):
+        rollupsKey = rollupsPrefix + rollups.ROLLUPS_FILE_NAME
+        accumulator = rollups.RollupAccumulator([])
+        for job in jobs:
+            partial = rollups.get_rollups(self.s3destclient, self.destBucket, job['rollupKey'])
+            if partial is None:
+                print "Partial rollup [{}/{}] not found, removing rollups [{}]".format(self.destBucket, job['rollupKey'], rollupsKey)
+                self.s3destclient.delete_objects(Bucket=self.destBucket, Delete={'Objects':[{'Key':rollupsKey}], 'Quiet':True})
+                return ''
+            accumulator.merge(partial)
+        rollups.put_rollups(self.s3destclient, self.destBucket, rollupsKey, accumulator,
+                            assemblyId=self.curManifestJson.get('assemblyId',''),
+                            lastUpdated=datetime.datetime.now(pytz.utc).strftime(consts.TIMESTAMP_FORMAT))
+        print "Rollups for [{}] rows written to [{}/{}]".format(accumulator.rows, self.destBucket, rollupsKey)
+        return rollupsKey
+
+
+    """
+    Returns the keys of the data files (files that start with basename) under a prefix in the destination bucket, at any depth.
+    """
+
+    def get_dest_keys(self, prefix, basename):
+        result = set()
+        paginator = self.s3destclient.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.destBucket, Prefix=prefix):
+            for o in page.get('Contents',[]):
+                if o['Key'].split('/')[-1].startswith(basename): result.add(o['Key'])
+        return result
+
+
+    """
+    Returns the ETag and size of each report file. All files for a report are in the same folder,
+    so a single listing (one request per 1000 files) is enough, instead of a HEAD request per file.
+    """
+
+    def get_source_objects(self, report_keys):
+        result = {}
+        keys = set(report_keys)
+        paginator = self.s3sourceclient.get_paginator('list_objects_v2')
+        for prefix in sorted(set([k[:k.rfind('/')+1] for k in report_keys])):
+            for page in paginator.paginate(Bucket=self.sourceBucket, Prefix=prefix):
+                for o in page.get('Contents',[]):
+                    if o['Key'] in keys: result[o['Key']] = {'etag':o['ETag'].strip('"'), 'size':o['Size']}
+        return result
+
+
+    """
+    Returns the columns in the files prepared for Athena, in the same order as they appear in the report files.
+    Column names and types are the same ones used in the Athena table (see schema.CurSchema). Only projected columns are included.
+    """
+
+    def get_output_columns(self):
+        return schema.CurSchema(self.projection.get_columns(), self.typedSchema).columns
+
+
+    """
+    Downloads a report file to a local tmp folder, removes the header (for Athena) into a second local file and uploads it.
+    This is the original processing mode; it's kept as a fallback for environments where streaming is not an option.
+    """
+
+    def process_report_key_local(self, job):
+
         if '/var/task' in os.getcwd(): #executing as a Lambda function
             tmpLocalFolder = '/tmp'
         else:
             tmpLocalFolder = os.getcwd()+'/tmp'
 
-        if not os.path.isdir(tmpLocalFolder): os.mkdir(tmpLocalFolder)
-        tmpLocalKey = tmpLocalFolder+'/tmp_'+rk.replace("/","-")+'.csv.gz'#temporary file that is downloaded from S3, before any modifications take place
-        finalLocalKey = tmpLocalFolder+'/'+hash+'.csv.gz'#final local file after any modifications take place
+        if not os.path.isdir(tmpLocalFolder):
+            try: os.mkdir(tmpLocalFolder)
+            except OSError: pass #created by another worker
+        tmpLocalKey = tmpLocalFolder+'/tmp_'+job['sourceKey'].replace("/","-")+'.csv.gz'#temporary file that is downloaded from S3, before any modifications take place
+        finalLocalKey = tmpLocalFolder+'/'+job['reportId']+'-'+str(job['index'])+'.csv.gz'#final local file after any modifications take place
         fileToUpload = ''
-        finalS3Key = ''
 
 
         #Download latest report as a tmp local file
         with open(tmpLocalKey, 'wb') as report:
-            self.s3resource.Bucket(self.sourceBucket).download_fileobj(rk, report)
+            self.s3sourceclient.download_fileobj(job['sourceBucket'], job['sourceKey'], report)
 
         #Read through the tmp local file and skip first line (for Athena)
         record_count = 0
-        if action == consts.ACTION_PREPARE_ATHENA:
+        destKey = job['destKey']
+        if job['action'] == consts.ACTION_PREPARE_ATHENA:
+            destKey = job['destKey'].format(shard=1)#files are not split in shards when processed locally
             fileToUpload = finalLocalKey
-            finalS3Key = monthDestPrefix + "cost-and-usage-athena.csv.gz"
             with gzip.open(tmpLocalKey, 'rb') as f:
                 f.next()#skips first line for Athena files
                 #Write contents to another tmp file, which will be uploaded to S3
-                with gzip.open(finalLocalKey,'ab') as no_header:
+                with gzip.open(finalLocalKey,'wb') as no_header:
                     for line in f:
                         no_header.write(line)
                         record_count = record_count + 1
 
             print "Number of records: [{}]".format(record_count)
 
-        #TODO:if we're using the files for QuickSight, do a Copy operation and don't download.
-        if action == consts.ACTION_PREPARE_QUICKSIGHT:
+        if job['action'] == consts.ACTION_PREPARE_QUICKSIGHT:
             fileToUpload = tmpLocalKey
-            finalS3Key = monthDestPrefix + "cost-and-usage-quicksight.csv.gz"
-
-        print "Putting: [{}/{}] in [{}/{}]".format(self.sourceBucket,rk,self.destBucket,finalS3Key)
 
         with open(fileToUpload, 'rb') as data:
-            self.s3destclient.upload_fileobj(data, self.destBucket, finalS3Key,
+            self.s3destclient.upload_fileobj(data, job['destBucket'], destKey,
                                     ExtraArgs={
-                                        'Metadata':{'reportId':hash},
+                                        'Metadata':{'reportId':job['reportId']},
                                         'StorageClass':'REDUCED_REDUNDANCY'
                                     })
-            destS3keys.append(finalS3Key)
 
         #Remove temporary files. This is also important to avoid Lambda errors where the local Lambda storage limit can be easily reached after a few executions
         os.remove(tmpLocalKey)
-        os.remove(finalLocalKey)
+        if os.path.exists(finalLocalKey): os.remove(finalLocalKey)
 
-
-      self.status = consts.CUR_PROCESSOR_STATUS_OK
-
-      return destS3keys
+        return [destKey]
 
 
     """
     Every time a new Cost and Usage report is generated, AWS updates a Manifest file with the S3 keys that
     correspond to the latest report. This method gets the location of that Manifest file.
+    The manifest is at the top level of the period prefix, next to one folder per report version (assemblyId), so objects
+    are listed with a '/' delimiter: folders are returned as a single CommonPrefixes entry, regardless of how many files they have.
+    The key is resolved once per instance.
     """
 
     def get_latest_aws_manifest_key(self):
+        if self.latest_manifest_key: return self.latest_manifest_key
         manifestprefix = self.sourcePrefix + utils.get_period_prefix(self.year, self.month)
         print "Getting Manifest key for acccount:[{}] - bucket:[{}] - prefix:[{}]".format(self.accountId, self.sourceBucket, manifestprefix)
         manifest_key = ''
         try:
-            response = self.s3sourceclient.list_objects_v2(Bucket=self.sourceBucket,Prefix=manifestprefix)
-            #Get the latest manifest
-            if 'Contents' in response:
-                for o in response['Contents']:
-                    key = o['Key']
-                    post_prefix = key[key.find(manifestprefix)+len(manifestprefix):]
-                    if '-Manifest.json' in key and post_prefix.find("/") < 0:#manifest file is at top level after prefix and not inside one of the folders
-                        manifest_key = key
+            paginator = self.s3sourceclient.get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=self.sourceBucket, Prefix=manifestprefix, Delimiter='/'):
+                for o in page.get('Contents',[]):
+                    if o['Key'].endswith('-Manifest.json'):
+                        manifest_key = o['Key']
                         break
+                if manifest_key: break
 
         except BotoClientError as bce:
             self.status = consts.CUR_PROCESSOR_STATUS_ERROR
@@ -174,17 +440,25 @@ class CostUsageProcessor():
             self.statusDetails = "ManifestNotFoundError - key:[{}]".format(manifest_key)
             raise ManifestNotFoundError("Could not find manifest file in bucket:[{}]".format(self.sourceBucket))
 
+        self.latest_manifest_key = manifest_key
         return manifest_key
 
 
     """
     Every time a new Cost and Usage report is generated, AWS updates a Manifest file with the S3 keys that
     correspond to the latest report. This method gets those keys.
+    The manifest in the source bucket is already loaded when the processor is created (see get_aws_manifest_content),
+    it's only downloaded again when keys are requested from a different bucket.
     """
 
     def get_latest_aws_cur_keys(self, bucket, prefix, s3client):
         result = []
         print "Getting report keys for bucket:[{}] - prefix:[{}]".format(bucket,prefix)
+        if bucket == self.sourceBucket:
+            result = self.get_aws_manifest_content().get('reportKeys',[])
+            print "Latest Cost and Usage report keys: [{}]".format(result)
+            return result
+
         manifest_key = self.get_latest_aws_manifest_key()
         response = {}
         try:
@@ -206,15 +480,19 @@ class CostUsageProcessor():
 
 
     """
-    Returns a JSON object representing the AWS Cost and Usage Report manifest
+    Returns a JSON object representing the AWS Cost and Usage Report manifest. The content and its LastModified timestamp
+    are downloaded once per instance.
     """
     def get_aws_manifest_content(self):
+        if self.curManifestJson is not None: return self.curManifestJson
         result = {}
-        print "Getting manifest file JSON content - bucket: [{}] - key: [{}]".format(self.sourceBucket, self.latest_manifest_key)
-        response = self.s3sourceclient.get_object(Bucket=self.sourceBucket, Key=self.latest_manifest_key)
+        manifest_key = self.get_latest_aws_manifest_key()
+        print "Getting manifest file JSON content - bucket: [{}] - key: [{}]".format(self.sourceBucket, manifest_key)
+        response = self.s3sourceclient.get_object(Bucket=self.sourceBucket, Key=manifest_key)
         self.aws_manifest_lastmodified_ts = response.get('LastModified','')
         if 'Body' in response:
             result = json.loads(response['Body'].read())
+        self.curManifestJson = result
         return result
 
 
@@ -299,6 +577,18 @@ class CostUsageProcessor():
         if not (self.limit >= 1 and self.limit <= 1000):
             message += "Limit must be between 1 and 1000\n"
 
+        if self.processingMode not in consts.VALID_PROCESSING_MODES:
+            message += "Processing mode must be one of {}\n".format(consts.VALID_PROCESSING_MODES)
+
+        if self.workers < 1:
+            message += "Workers must be at least 1\n"
+
+        if self.workerType not in consts.VALID_WORKER_TYPES:
+            message += "Worker type must be one of {}\n".format(consts.VALID_WORKER_TYPES)
+
+        if self.workerType == consts.WORKER_TYPE_PROCESS and self.processingMode != consts.PROCESSING_MODE_STREAM:
+            message += "Process workers are only supported in processing mode [{}]\n".format(consts.PROCESSING_MODE_STREAM)
+
         if message:
             raise Exception(message)
         else:
@@ -306,43 +596,195 @@ class CostUsageProcessor():
 
 
 
+    """
+    Clients and cross-account credentials come from the module-level cache in clients.py, so processors created for the same
+    account (i.e. in warm Lambda invocations) reuse them instead of assuming the role and creating new clients every time.
+    """
     def init_clients(self):
 
-        self.s3sourceclient = boto3.client('s3')
-        self.s3resource = boto3.resource('s3') #TODO rename to something that describes whether it's destination or source
-        self.s3destclient = boto3.client('s3')
-
-        if self.roleArn and (self.xAccountSource or self.xAccountDest):
-            lambda_owner_aws_access_key_id = ''
-            lambda_owner_aws_secret_access_key = ''
-            if 'LAMBDA_OWNER_AWS_ACCESS_KEY_ID' in os.environ and 'LAMBDA_OWNER_AWS_SECRET_ACCESS_KEY' in os.environ:
-                lambda_owner_aws_access_key_id = os.environ['LAMBDA_OWNER_AWS_ACCESS_KEY_ID']
-                lambda_owner_aws_secret_access_key = os.environ['LAMBDA_OWNER_AWS_SECRET_ACCESS_KEY']
-                #If running from inside a Lambda function, assume role using the function's owner's credentials (and not the temp credentials given to the function)
-                masterstsclient = boto3.client('sts', aws_access_key_id=lambda_owner_aws_access_key_id, aws_secret_access_key=lambda_owner_aws_secret_access_key)
-                #instead of using the masterstsclient, we get a session token, otherwise we run into AccessDenied exceptions when using the same master credentials for assuming roles for multiple customer accounts
-                sessionToken = masterstsclient.get_session_token()
-                stsclient = boto3.client('sts', aws_access_key_id=sessionToken['Credentials']['AccessKeyId'],
-                                                aws_secret_access_key=sessionToken['Credentials']['SecretAccessKey'],
-                                                aws_session_token=sessionToken['Credentials']['SessionToken']
-                                                )
-                #stsclient = boto3.client('sts', aws_access_key_id=lambda_owner_aws_access_key_id, aws_secret_access_key=lambda_owner_aws_secret_access_key)
-
+        #Each worker keeps up to two connections open (source and destination), make sure the pool doesn't become a bottleneck
+        maxPoolConnections = max(10, self.workers*2)
+        xAccountRoleArn = self.roleArn if self.roleArn else ''
+        sourceRoleArn = xAccountRoleArn if self.xAccountSource else ''
+        destRoleArn = xAccountRoleArn if self.xAccountDest else ''
+
+        if self.xAccountSource: print("Getting xAcct S3 source client")
+        self.sourceCredentials = clients.get_role_credentials(sourceRoleArn)
+        self.s3sourceclient = clients.get_client('s3', roleArn=sourceRoleArn, maxPoolConnections=maxPoolConnections)
+        self.s3resource = clients.get_resource('s3', roleArn=sourceRoleArn) #TODO rename to something that describes whether it's destination or source
+
+        if self.xAccountDest: print("Getting xAcct S3 dest client")
+        self.destCredentials = clients.get_role_credentials(destRoleArn)
+        self.s3destclient = clients.get_client('s3', roleArn=destRoleArn, maxPoolConnections=maxPoolConnections)
+
+
+
+"""
+Checks whether the manifest of a period changed since a timestamp with a single conditional HEAD request (If-Modified-Since),
+without creating a CostUsageProcessor, which lists the period prefix and downloads the manifest. S3 answers 304 when it didn't change.
+Returns True or False, or None when the manifest key is unknown or isn't the one for the period (i.e. the last processed manifest
+was for the previous month), in which case the caller needs to find the manifest by listing.
+"""
+
+def is_manifest_modified(s3client, bucket, sourcePrefix, year, month, manifestKey, since):
+    if not manifestKey or not manifestKey.startswith(sourcePrefix + utils.get_period_prefix(year, month)):
+        return None
+    try:
+        s3client.head_object(Bucket=bucket, Key=manifestKey, IfModifiedSince=since)
+    except BotoClientError as bce:
+        code = bce.response['Error']['Code']
+        if code in ('304', 'NotModified'): return False
+        if code in ('404', 'NoSuchKey'): return None
+        raise
+    return True
+
+
+"""
+Reads a report file from the source bucket, removes the header (for Athena), compresses it again and uploads it to
+the destination bucket using multipart uploads, all in a single pass. Nothing is written to local disk (except rows for usage dates
+that are spilled by PartitionedWriter) and memory usage is bounded by the multipart upload part size, which means large reports can
+be processed by a Lambda function.
+Athena files are split in shards of job['shardSize'] bytes. Returns the keys that were written and processing stats.
+"""
+
+def stream_report_key(job, s3sourceclient, s3destclient):
+    response = s3sourceclient.get_object(Bucket=job['sourceBucket'], Key=job['sourceKey'])
+    extra_args = get_dest_extra_args(job)
+    result = {'destKeys':[], 'records':0, 'invalidValues':{}, 'excludedRecords':0}
+
+    if job['action'] in consts.ATHENA_ACTIONS:
+        reader = s3stream.GzipStreamReader(response['Body'])
+        converters = [schema.ValueConverter(i, c['name'], c['type']) for i, c in enumerate(job['columns']) if c['type'] != schema.ATHENA_TYPE_STRING]
+        accumulator = None
+        if job.get('rollupKey'): accumulator = rollups.RollupAccumulator([c['name'] for c in job['columns']])
+        partitionIndex = -1
+        if job['partitionDates']:
+            names = [c['name'] for c in job['columns']]
+            if USAGE_DATE_PARTITION_COLUMN_SOURCE not in names:
+                raise ValidationError("Column [{}] is required in order to partition by usage date - key: [{}]".format(USAGE_DATE_PARTITION_COLUMN_SOURCE, job['sourceKey']))
+            partitionIndex = names.index(USAGE_DATE_PARTITION_COLUMN_SOURCE)
+            #partition writers use the smallest part size and only a few are open at a time, rows for other days are spilled to local disk
+            writer = s3stream.PartitionedWriter(lambda usage_date: get_athena_writer(job, s3destclient, extra_args, get_partition_key(job, usage_date),
+                                                            partSize=s3stream.MIN_MULTIPART_PART_SIZE), job['maxOpenPartitions'])
+        else:
+            writer = get_athena_writer(job, s3destclient, extra_args, job['destKey'])
+        try:
+            projected = job.get('columnIndexes') is not None or job.get('rowRules')
+            if job['action'] == consts.ACTION_PREPARE_ATHENA and not converters and partitionIndex < 0 and accumulator is None and not projected:
+                #Rows don't change, so they're copied chunk by chunk, which is much faster than parsing every row
+                last_chunk = ''
+                for chunk in s3stream.skip_first_line(reader.iter_chunks()):#skips first line for Athena files
+                    writer.write(chunk)
+                    result['records'] += chunk.count('\n')
+                    last_chunk = chunk
+                if last_chunk and not last_chunk.endswith('\n'): result['records'] += 1
             else:
-                #Assume role using the AWS credentials configured in the environment
-                stsclient = boto3.client('sts')
-            print ("Assuming role [{}]".format(self.roleArn))
-            stsresponse = stsclient.assume_role(RoleArn=self.roleArn, RoleSessionName='costAnalysis')
-
-            if 'Credentials' in stsresponse:
-                accessKeyId = stsresponse['Credentials']['AccessKeyId']
-                secretAccessKey = stsresponse['Credentials']['SecretAccessKey']
-                sessionToken = stsresponse['Credentials']['SessionToken']
-                if self.xAccountSource:
-                    print("Getting xAcct S3 source client")
-                    self.s3sourceclient = boto3.client('s3',aws_access_key_id=accessKeyId, aws_secret_access_key=secretAccessKey,aws_session_token=sessionToken)
-                    self.s3resource = boto3.resource('s3',aws_access_key_id=accessKeyId, aws_secret_access_key=secretAccessKey,aws_session_token=sessionToken)
-                if self.xAccountDest:
-                    print("Getting xAcct S3 dest client")
-                    self.s3destclient = boto3.client('s3',aws_access_key_id=accessKeyId, aws_secret_access_key=secretAccessKey,aws_session_token=sessionToken)
-
+                rows = csv.reader(reader.iter_lines())
+                header = next(rows, [])#skips first line for Athena files
+                if len(header) != job['sourceColumnCount']:
+                    raise ValidationError("Report file has [{}] columns, manifest has [{}] - key: [{}]".format(len(header), job['sourceColumnCount'], job['sourceKey']))
+                for row in rows:
+                    if job['rowRules'] and projection.is_excluded(job['rowRules'], row):
+                        result['excludedRecords'] += 1
+                        continue
+                    if job['columnIndexes'] is not None: row = [row[i] for i in job['columnIndexes']]
+                    if accumulator: accumulator.add_row(row)
+                    if partitionIndex >= 0: usage_date = get_usage_date_partition(row[partitionIndex], job['partitionDates'])
+                    for c in converters: row[c.index] = c.parse(row[c.index])
+                    if partitionIndex >= 0: writer.write_partition_row(usage_date, row)
+                    else: writer.write_row(row)
+                    result['records'] += 1
+            writer.close()
+        except Exception:
+            writer.abort()
+            raise
+        result['destKeys'] = writer.keys
+        if accumulator:
+            rollups.put_rollups(s3destclient, job['destBucket'], job['rollupKey'], accumulator, sourceKey=job['sourceKey'])
+            result['rollupKey'] = job['rollupKey']
+        for c in converters:
+            if c.invalid_count: result['invalidValues'][c.name] = c.invalid_count
+        print "Number of records: [{}] - excluded records: [{}] - uncompressed bytes: [{}] - shards: [{}] - invalid values: [{}]".format(
+                    result['records'], result['excludedRecords'], reader.uncompressed_bytes, len(result['destKeys']), result['invalidValues'])
+
+    #Files for QuickSight are not modified, therefore they're not decompressed
+    if job['action'] == consts.ACTION_PREPARE_QUICKSIGHT:
+        with s3stream.S3MultipartUploadWriter(s3destclient, job['destBucket'], job['destKey'], extra_args, job['partSize']) as uploader:
+            for chunk in iter(lambda: response['Body'].read(s3stream.DEFAULT_READ_CHUNK_SIZE), ''):
+                uploader.write(chunk)
+        result['destKeys'] = [job['destKey']]
+
+    return result
+
+
+def get_dest_extra_args(job):
+    return {'Metadata':{'reportId':job['reportId']}, 'StorageClass':'REDUCED_REDUNDANCY'}
+
+
+"""
+Files for QuickSight are not modified, so they're copied server side: no data is downloaded or uploaded by the caller.
+The copy request is sent by the destination client, which means the destination credentials must be able to read the source object.
+That's not always the case for cross-account configurations, so when S3 denies access, this function returns None and the file
+is processed by downloading and uploading it instead.
+"""
+
+def copy_report_key(job, s3sourceclient, s3destclient):
+    if not job.get('serverSideCopy'): return None
+    size = job.get('sourceSize', -1)
+    if size < 0: size = s3sourceclient.head_object(Bucket=job['sourceBucket'], Key=job['sourceKey'])['ContentLength']
+    try:
+        s3stream.copy_object(s3destclient, job['sourceBucket'], job['sourceKey'], job['destBucket'], job['destKey'], size, get_dest_extra_args(job))
+    except BotoClientError as bce:
+        if bce.response['Error']['Code'] not in ('AccessDenied', '403'): raise
+        print "Server side copy is not allowed for [{}/{}], downloading file instead".format(job['sourceBucket'], job['sourceKey'])
+        return None
+    return {'destKeys':[job['destKey']]}
+
+
+def get_athena_writer(job, s3destclient, extra_args, keyTemplate, partSize=None):
+    partSize = partSize or job['partSize']
+    if job['action'] == consts.ACTION_PREPARE_ATHENA_PARQUET:
+        return parquetwriter.ParquetShardWriter(s3destclient, job['destBucket'], keyTemplate, job['columns'], job['shardSize'],
+                                                row_group_rows=job['rowGroupRows'], extra_args=extra_args, part_size=partSize)
+    return s3stream.ShardedGzipWriter(s3destclient, job['destBucket'], keyTemplate, job['shardSize'],
+                                      extra_args=extra_args, part_size=partSize)
+
+
+"""
+Places files in a Hive-style partition inside the month prefix, i.e. <prefix>/usage_date=2017-06-01/cost-and-usage-athena-0001-0001.csv.gz
+"""
+
+def get_partition_key(job, usage_date):
+    partitionPrefix = "{}{}={}/".format(job['destPrefix'], consts.USAGE_DATE_PARTITION_COLUMN, usage_date)
+    return partitionPrefix + job['destKey'][len(job['destPrefix']):]
+
+
+"""
+Returns the usage date partition (YYYY-MM-DD) for a lineItem/UsageStartDate value (i.e. 2017-06-01T00:00:00Z).
+Day partitions are limited to the dates in the billing period. Line items that start before or after the billing period
+go to their own partition (usage_date=out_of_period), so they're not counted as usage of another day: queries for a date range
+read that partition too when the range goes beyond the billing period (see athena.AthenaQueryMgr.get_usage_date_filter).
+"""
+
+def get_usage_date_partition(usageStartDate, partitionDates):
+    usage_date = usageStartDate[0:10]
+    if usage_date < partitionDates[0] or usage_date > partitionDates[1]: return consts.USAGE_DATE_OUT_OF_PERIOD
+    return usage_date
+
+
+"""
+Entry point for report files processed in a separate process. boto3 clients can't be sent to another process,
+so they're created here using the credentials of the processor that created the job.
+"""
+
+def process_report_key_job(job):
+    result = {'index':job['index'], 'sourceKey':job['sourceKey'], 'destKeys':[], 'error':''}
+    try:
+        print "Putting: [{}/{}] in [{}/{}] - pid: [{}]".format(job['sourceBucket'],job['sourceKey'],job['destBucket'],job['destKey'],os.getpid())
+        s3sourceclient = clients.get_client('s3', credentials=job.get('sourceCredentials',{}))
+        s3destclient = clients.get_client('s3', credentials=job.get('destCredentials',{}))
+        result.update(copy_report_key(job, s3sourceclient, s3destclient) or stream_report_key(job, s3sourceclient, s3destclient))
+    except Exception as e:
+        traceback.print_exc()
+        result['error'] = "{}: {}".format(type(e).__name__, e)
+    return result
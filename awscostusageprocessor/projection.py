@@ -0,0 +1,105 @@
+import logging
+
+import awscostusageprocessor.utils as utils
+from awscostusageprocessor.errors import ValidationError
+
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+
+
+#Columns used by the API queries (queries.properties), rollups and usage date partitions. They're always kept, otherwise
+#API calls would fail for tables created with a column projection.
+REQUIRED_COLUMNS = ['lineitem_usagestartdate', 'lineitem_productcode', 'lineitem_usagetype', 'lineitem_resourceid',
+                    'lineitem_lineitemdescription', 'lineitem_usageamount', 'lineitem_unblendedrate', 'lineitem_unblendedcost',
+                    'product_region']
+
+
+"""
+Reduces the columns and rows that are written to Athena files. Reports can have hundreds of columns (mostly user tags),
+but only a few of them are usually queried: dropping the rest reduces the size of the files and the amount of data Athena scans.
+
+Columns are selected using manifest categories (i.e. 'resourceTags') or single columns in 'category/name' format
+(i.e. 'resourceTags/user:Name'), either as an allow-list (includeColumns) or a deny-list (excludeColumns). Rows are removed using
+excludeRows rules: each rule is a dictionary of column ('category/name') and value, and a row is removed when all the values in a rule
+match (i.e. {'lineItem/LineItemType':'Tax', 'lineItem/UnblendedCost':'0'} removes zero-cost tax line items). Numbers are compared
+as numbers, so '0' matches '0.0000000000'. Rules are evaluated on the original row, so they can use columns that are not projected.
+"""
+
+class CurProjection():
+
+    def __init__(self, manifestColumns, includeColumns=None, excludeColumns=None, excludeRows=None):
+        self.manifestColumns = manifestColumns
+        includeColumns = includeColumns or []
+        excludeColumns = excludeColumns or []
+        if includeColumns and excludeColumns:
+            raise ValidationError("Columns can be either included or excluded, not both")
+
+        self.indexes = []
+        for i, c in enumerate(manifestColumns):
+            if utils.get_column_name(c['category'], c['name']) in REQUIRED_COLUMNS: keep = True
+            elif includeColumns: keep = matches_column(c, includeColumns)
+            else: keep = not matches_column(c, excludeColumns)
+            if keep: self.indexes.append(i)
+
+        headers = ["{}/{}".format(c['category'], c['name']) for c in manifestColumns]
+        self.rules = []
+        for rule in excludeRows or []:
+            conditions = []
+            for column, value in sorted(rule.items()):
+                if column not in headers:
+                    raise ValidationError("Column [{}] in row filter [{}] is not in the report".format(column, rule))
+                conditions.append((headers.index(column), value, to_number(value)))
+            if conditions: self.rules.append(conditions)
+
+    """
+    True if the projection changes the report files: columns are removed or there are row filters
+    """
+    def is_active(self):
+        return len(self.indexes) < len(self.manifestColumns) or len(self.rules) > 0
+
+    def get_columns(self):
+        return [self.manifestColumns[i] for i in self.indexes]
+
+    """
+    Returns a copy of the manifest with the projected columns only, which is what the Athena table is created from.
+    """
+    def get_manifest(self, curManifest):
+        result = dict(curManifest)
+        result['columns'] = self.get_columns()
+        return result
+
+
+"""
+Rules are evaluated by the workers that process report files, which only get the rules (see CurProjection.rules), not the projection.
+"""
+def is_excluded(rules, row):
+    for conditions in rules:
+        if all([matches_value(row[index], value, number) for index, value, number in conditions]):
+            return True
+    return False
+
+
+def matches_column(column, selectors):
+    return column['category'] in selectors or "{}/{}".format(column['category'], column['name']) in selectors
+
+
+def matches_value(rowValue, value, number):
+    if rowValue == value: return True
+    if number is None: return False
+    return to_number(rowValue) == number
+
+
+def to_number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+"""
+Column selectors can be configured as a list or as a comma-separated string (i.e. from an environment variable)
+"""
+def parse_column_selectors(value):
+    if not value: return []
+    if isinstance(value, basestring): value = value.split(',')
+    return [v.strip() for v in value if v.strip()]
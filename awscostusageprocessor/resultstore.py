@@ -0,0 +1,115 @@
+import json
+import zlib
+import time
+import logging
+import datetime
+import threading
+import collections
+
+import pytz
+from botocore.exceptions import ClientError as BotoClientError
+
+import awscostusageprocessor.utils as utils
+import awscostusageprocessor.consts as consts
+import awscostusageprocessor.s3stream as s3stream
+
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+
+
+RESULTS_VERSION = 1
+RESULTS_FOLDER = utils.get_hidden_folder('results')
+
+#Dashboard result sets, calculated by init-athena-queries after every report is processed
+STORED_ACTIONS = [consts.ACTION_GET_TOTAL_COST, consts.ACTION_GET_HOURLY_COST, consts.ACTION_GET_COST_BY_SERVICE,
+                  consts.ACTION_GET_COST_BY_USAGE_TYPE, consts.ACTION_GET_COST_BY_RESOURCE]
+
+#Documents already read by this process: key -> (expiration, ETag, document), least recently used first. They're read again with
+#IfNoneMatch, so unchanged documents are not downloaded again in warm invocations. See API_RESULT_STORE_CACHE_TTL_SECONDS and
+#API_RESULT_STORE_CACHE_MAX_ENTRIES.
+_documents = collections.OrderedDict()
+_lock = threading.Lock()
+
+
+"""
+API result sets are stored as gzip-compressed JSON documents next to the rollups:
+<destPrefix>/<accountId>/_results/<period>/<action>.json.gz. Each document is versioned by the account's lastProcessedTimestamp
+(dataVersion) when it was calculated, so the API only serves it until a new report is processed.
+"""
+
+def get_results_prefix(destPrefix, accountId, year, month):
+    return "{}{}/{}/{}".format(destPrefix, accountId, RESULTS_FOLDER, utils.get_period_prefix(year, month))
+
+
+def get_result_key(resultsPrefix, action):
+    return "{}{}.json.gz".format(resultsPrefix, action)
+
+
+"""
+response is an API response (executionId, queryState, results), see api.ApiProcessor.getResultSet. Returns the ETag of the document.
+"""
+def put_result_set(s3client, bucket, key, action, dataVersion, response):
+    document = {'version':RESULTS_VERSION, 'action':action, 'dataVersion':dataVersion,
+                'createdTimestamp':datetime.datetime.now(pytz.utc).strftime(consts.TIMESTAMP_FORMAT),
+                'executionId':response.get('executionId',''), 'results':response['results']}
+    compressor = zlib.compressobj(6, zlib.DEFLATED, s3stream.GZIP_WBITS)
+    body = compressor.compress(json.dumps(document, separators=(',',':'))) + compressor.flush()
+    s3response = s3client.put_object(Bucket=bucket, Key=key, Body=body, ContentType='application/json', ContentEncoding='gzip',
+                                     Metadata={'dataversion':dataVersion})
+    log.info("Stored [{}] results for [{}] in s3://{}/{} - [{}] bytes".format(len(response['results']), action, bucket, key, len(body)))
+    return s3response.get('ETag','')
+
+
+"""
+Returns the stored document for dataVersion, or None if there's no document or it was calculated for a different version.
+"""
+def get_result_set(s3client, bucket, key, dataVersion):
+    cached = get_cached_document((bucket, key))
+    kwargs = {'IfNoneMatch':cached[0]} if cached else {}
+    try:
+        response = s3client.get_object(Bucket=bucket, Key=key, **kwargs)
+    except BotoClientError as bce:
+        code = bce.response['Error']['Code']
+        if code in ('304', 'NotModified') and cached:
+            document = cached[1]
+            cache_document((bucket, key), cached[0], document)
+        elif code in ('NoSuchKey', '404'): return None
+        else: raise
+    else:
+        document = json.loads(zlib.decompress(response['Body'].read(), s3stream.GZIP_WBITS))
+        cache_document((bucket, key), response.get('ETag',''), document)
+
+    if document.get('version') != RESULTS_VERSION or document.get('dataVersion') != dataVersion:
+        log.info("Stored results in s3://{}/{} are for version [{}], current version is [{}]".format(bucket, key, document.get('dataVersion'), dataVersion))
+        return None
+    return document
+
+
+"""
+Returns the cached ETag and document, or None if the document is not cached or it expired.
+"""
+def get_cached_document(cacheKey):
+    with _lock:
+        entry = _documents.pop(cacheKey, None)
+        if not entry or entry[0] <= time.time(): return None
+        _documents[cacheKey] = entry #most recently used
+        return entry[1], entry[2]
+
+
+"""
+Expired entries are removed whenever a document is cached, and the least recently used ones once there are more than
+API_RESULT_STORE_CACHE_MAX_ENTRIES.
+"""
+def cache_document(cacheKey, etag, document):
+    if consts.API_RESULT_STORE_CACHE_TTL_SECONDS <= 0 or consts.API_RESULT_STORE_CACHE_MAX_ENTRIES <= 0: return
+    now = time.time()
+    with _lock:
+        for k in [k for k, e in _documents.items() if e[0] <= now]: del _documents[k]
+        _documents.pop(cacheKey, None)
+        _documents[cacheKey] = (now + consts.API_RESULT_STORE_CACHE_TTL_SECONDS, etag, document)
+        while len(_documents) > consts.API_RESULT_STORE_CACHE_MAX_ENTRIES: _documents.popitem(last=False)
+
+
+def clear():
+    with _lock:
+        _documents.clear()
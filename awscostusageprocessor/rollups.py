@@ -0,0 +1,159 @@
+import json
+import logging
+
+from botocore.exceptions import ClientError as BotoClientError
+
+import awscostusageprocessor.utils as utils
+import awscostusageprocessor.consts as consts
+import awscostusageprocessor.schema as schema
+
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+
+
+ROLLUPS_VERSION = 1
+ROLLUPS_FOLDER = utils.get_hidden_folder('rollups')
+ROLLUPS_FILE_NAME = 'rollups.json'
+PARTIALS_FOLDER = 'partials'
+
+COST_COLUMN = 'lineitem_unblendedcost'
+
+#Each rollup is the result of one of the API queries in queries.properties: the columns it groups by and the name of the aggregated value.
+#Cost is rounded to 2 decimals, same as the queries, except for the hourly cost.
+ROLLUP_DEFINITIONS = {
+    consts.ACTION_GET_TOTAL_COST: {'columns':[], 'value':'sum_unblendedcost', 'round':True},
+    consts.ACTION_GET_HOURLY_COST: {'columns':['lineitem_usagestartdate'], 'value':'sum_unblendedcost', 'round':False},
+    consts.ACTION_GET_COST_BY_SERVICE: {'columns':['lineitem_productcode'], 'value':'sum_unblendedcost', 'round':True},
+    consts.ACTION_GET_COST_BY_USAGE_TYPE: {'columns':['lineitem_productcode', 'lineitem_usagetype'], 'value':'sum_unblendedcost', 'round':True},
+    consts.ACTION_GET_COST_BY_RESOURCE: {'columns':['lineitem_productcode', 'product_region', 'lineitem_resourceid'], 'value':'sum_unblendedcost', 'round':True}
+}
+
+
+"""
+Accumulates the aggregates served by the API (total cost, hourly cost, cost by service, usage type and resource) while report files
+are processed, so they don't need to be calculated with a full table scan in Athena. Rows are the raw values in the report file,
+in the same order as column_names. The total cost is derived from the hourly cost, which also makes it possible to calculate
+both of them for a range of usage dates.
+"""
+
+class RollupAccumulator():
+
+    def __init__(self, column_names):
+        self.cost_index = get_index(column_names, COST_COLUMN)
+        self.rollups = {}
+        self.indexes = {}
+        for action, definition in ROLLUP_DEFINITIONS.items():
+            if not definition['columns']: continue
+            self.rollups[action] = {}
+            self.indexes[action] = [get_index(column_names, c) for c in definition['columns']]
+        self.rows = 0
+
+    def add_row(self, row):
+        self.rows += 1
+        try:
+            cost = float(row[self.cost_index]) if self.cost_index >= 0 else 0.0
+        except ValueError:
+            cost = 0.0
+        for action, indexes in self.indexes.items():
+            key = tuple([row[i] if i >= 0 else '' for i in indexes])
+            values = self.rollups[action]
+            values[key] = values.get(key, 0.0) + cost
+
+    def merge(self, other):
+        self.rows += other.rows
+        for action, values in other.rollups.items():
+            target = self.rollups.setdefault(action, {})
+            for key, cost in values.items():
+                target[key] = target.get(key, 0.0) + cost
+        return self
+
+    def to_dict(self):
+        result = {'version':ROLLUPS_VERSION, 'rows':self.rows, 'rollups':{}}
+        for action, values in self.rollups.items():
+            result['rollups'][action] = [list(key) + [cost] for key, cost in values.items()]
+        return result
+
+    @classmethod
+    def from_dict(cls, content):
+        accumulator = cls([])
+        accumulator.rows = content.get('rows', 0)
+        for action, values in content.get('rollups', {}).items():
+            accumulator.rollups[action] = dict([(tuple(v[:-1]), v[-1]) for v in values])
+        return accumulator
+
+    """
+    Returns the rollup for an API action in the same format as Athena query results (a list of dictionaries with string values),
+    sorted the same way as the query. Returns None if the rollup can't answer the request (i.e. a date range for cost by service).
+    Keys have the raw values from the report files; for typed tables, timestamps are formatted the way Athena returns them.
+    """
+    def get_results(self, action, startDate='', endDate='', typed=False):
+        definition = ROLLUP_DEFINITIONS.get(action)
+        if not definition: return None
+        if (startDate or endDate) and action not in (consts.ACTION_GET_TOTAL_COST, consts.ACTION_GET_HOURLY_COST): return None
+
+        if action == consts.ACTION_GET_TOTAL_COST:
+            hourly = self.rollups.get(consts.ACTION_GET_HOURLY_COST, {})
+            values = {(): sum([cost for key, cost in hourly.items() if in_date_range(key[0], startDate, endDate)])}
+        else:
+            values = self.rollups.get(action, {})
+            if startDate or endDate: values = dict([(k, v) for k, v in values.items() if in_date_range(k[0], startDate, endDate)])
+
+        if action == consts.ACTION_GET_HOURLY_COST: items = sorted(values.items())
+        else: items = sorted(values.items(), key=lambda i: (-round(i[1], 2), i[0]))
+
+        formatters = [schema.format_athena_timestamp if typed and schema.KNOWN_COLUMN_TYPES.get(c) == schema.ATHENA_TYPE_TIMESTAMP else None
+                      for c in definition['columns']]
+        result = []
+        for key, cost in items:
+            row = dict(zip(definition['columns'], [f(k) if f else k for f, k in zip(formatters, key)]))
+            if definition['round']: cost = round(cost, 2)
+            row[definition['value']] = repr(cost)
+            result.append(row)
+        return result
+
+
+def get_index(column_names, name):
+    if name in column_names: return column_names.index(name)
+    return -1
+
+
+def in_date_range(usageStartDate, startDate, endDate):
+    usage_date = usageStartDate[0:10]
+    if startDate and usage_date < startDate: return False
+    if endDate and usage_date > endDate: return False
+    return True
+
+
+"""
+Rollups are stored next to the processing ledger: <destPrefix>/<accountId>/_rollups/<period>/rollups.json, with a partial rollup
+for each report file in partials/. Partials are what make incremental processing possible: report files that didn't change are not
+processed again, their partial rollup from a previous execution is used instead.
+"""
+
+def get_rollups_prefix(destPrefix, accountId, year, month):
+    return "{}{}/{}/{}".format(destPrefix, accountId, ROLLUPS_FOLDER, utils.get_period_prefix(year, month))
+
+
+def get_partials_prefix(rollupsPrefix, action):
+    return "{}{}/{}/".format(rollupsPrefix, PARTIALS_FOLDER, action)
+
+
+def get_partial_key(rollupsPrefix, action, sourceKey):
+    return "{}{}.json".format(get_partials_prefix(rollupsPrefix, action), sourceKey.split('/')[-1])
+
+
+def put_rollups(s3client, bucket, key, accumulator, **metadata):
+    content = accumulator.to_dict()
+    content.update(metadata)
+    s3client.put_object(Bucket=bucket, Key=key, Body=json.dumps(content, separators=(',',':')), ContentType='application/json')
+
+
+def get_rollups(s3client, bucket, key):
+    try:
+        response = s3client.get_object(Bucket=bucket, Key=key)
+    except BotoClientError as bce:
+        if bce.response['Error']['Code'] in ('NoSuchKey', '404'): return None
+        raise
+    content = json.loads(response['Body'].read())
+    if content.get('version') != ROLLUPS_VERSION: return None
+    return RollupAccumulator.from_dict(content)
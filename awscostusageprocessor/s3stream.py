@@ -0,0 +1,437 @@
+import io
+import csv
+import zlib
+import cPickle
+import tempfile
+import logging
+from multiprocessing.pool import ThreadPool
+
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+
+
+#S3 multipart uploads require every part, except the last one, to be at least 5MB
+MIN_MULTIPART_PART_SIZE = 5 * 1024 * 1024
+DEFAULT_READ_CHUNK_SIZE = 1024 * 1024
+MAX_COPY_OBJECT_SIZE = 5 * 1024 * 1024 * 1024 #objects larger than 5GB can't be copied with a single copy_object request
+DEFAULT_COPY_PART_SIZE = 512 * 1024 * 1024
+MAX_MULTIPART_PARTS = 10000
+DEFAULT_COPY_WORKERS = 8
+CSV_WRITE_BATCH_ROWS = 1000
+GZIP_WBITS = 16 + zlib.MAX_WBITS #tells zlib to read and write gzip headers and trailers
+
+
+"""
+Reads a gzip-compressed stream (i.e. the 'Body' of an S3 get_object response) and decompresses it
+incrementally, without writing anything to local disk. Only one read chunk is kept in memory at a time.
+AWS Cost and Usage report files can contain more than one gzip member, so all members are read.
+"""
+
+class GzipStreamReader():
+
+    def __init__(self, stream, chunk_size=DEFAULT_READ_CHUNK_SIZE):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.compressed_bytes = 0
+        self.uncompressed_bytes = 0
+
+    def iter_chunks(self):
+        decompressor = zlib.decompressobj(GZIP_WBITS)
+        while True:
+            data = self.stream.read(self.chunk_size)
+            if not data: break
+            self.compressed_bytes += len(data)
+            while data:
+                out = decompressor.decompress(data)
+                if out:
+                    self.uncompressed_bytes += len(out)
+                    yield out
+                data = decompressor.unused_data
+                if data:#start of a new gzip member
+                    decompressor = zlib.decompressobj(GZIP_WBITS)
+        out = decompressor.flush()
+        if out:
+            self.uncompressed_bytes += len(out)
+            yield out
+
+    """
+    Yields complete lines (including the line terminator), regardless of where chunk boundaries fall.
+    """
+    def iter_lines(self):
+        return split_lines(self.iter_chunks())
+
+
+"""
+Reads an uncompressed stream (i.e. an Athena query result CSV file) in chunks.
+"""
+def iter_stream_chunks(stream, chunk_size=DEFAULT_READ_CHUNK_SIZE):
+    while True:
+        data = stream.read(chunk_size)
+        if not data: break
+        yield data
+
+
+def split_lines(chunks):
+    pending = b''
+    for chunk in chunks:
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line + b'\n'
+    if pending: yield pending
+
+
+"""
+Skips the first line of a stream of data chunks and yields everything after it, chunk by chunk.
+This is how the CSV header gets removed for Athena without splitting the whole file into lines.
+"""
+def skip_first_line(chunks):
+    header_skipped = False
+    for chunk in chunks:
+        if not header_skipped:
+            newline = chunk.find(b'\n')
+            if newline < 0: continue
+            chunk = chunk[newline+1:]
+            header_skipped = True
+        if chunk: yield chunk
+
+
+"""
+Compresses data written to it and forwards the gzip output to another file-like object (i.e. an S3MultipartUploadWriter).
+"""
+
+class GzipStreamWriter():
+
+    def __init__(self, fileobj, compresslevel=6):
+        self.fileobj = fileobj
+        self.compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, GZIP_WBITS)
+        self.uncompressed_bytes = 0
+        self.closed = False
+
+    def write(self, data):
+        self.uncompressed_bytes += len(data)
+        out = self.compressor.compress(data)
+        if out: self.fileobj.write(out)
+
+    def close(self):
+        if self.closed: return
+        self.fileobj.write(self.compressor.flush())
+        self.fileobj.close()
+        self.closed = True
+
+    def abort(self):
+        self.fileobj.abort()
+        self.closed = True
+
+
+"""
+Splits a stream of CSV data into gzip-compressed S3 objects (shards) of approximately target_shard_bytes of uncompressed data each.
+Shards are only split at record boundaries. Shard keys are deterministic: they're generated from key_template, i.e.
+'prefix/cost-and-usage-athena-0001-{shard:04d}.csv.gz', using a 1-based shard number. This way Athena can read shards in parallel,
+instead of scanning one large gzip file that can't be split. A target_shard_bytes of 0 means all data goes to a single shard.
+Data can be written either as raw CSV chunks (write) or as parsed rows (write_row), which are converted back to CSV in batches.
+"""
+
+class ShardedGzipWriter():
+
+    def __init__(self, s3client, bucket, key_template, target_shard_bytes, extra_args=None, part_size=MIN_MULTIPART_PART_SIZE):
+        self.s3client = s3client
+        self.bucket = bucket
+        self.key_template = key_template
+        self.target_shard_bytes = target_shard_bytes
+        self.extra_args = extra_args or {}
+        self.part_size = part_size
+        self.keys = []
+        self.shard = None
+        self.uncompressed_bytes = 0
+        self.quote_parity = 0
+        self.rowbuffer = io.BytesIO()
+        self.csvwriter = csv.writer(self.rowbuffer, lineterminator='\n')
+        self.buffered_rows = 0
+
+    def open_shard(self):
+        key = self.key_template.format(shard=len(self.keys)+1)
+        self.shard = GzipStreamWriter(S3MultipartUploadWriter(self.s3client, self.bucket, key, self.extra_args, self.part_size))
+        self.keys.append(key)
+
+    def close_shard(self):
+        self.shard.close()
+        self.shard = None
+
+    def write(self, data):
+        self.uncompressed_bytes += len(data)
+        while data:
+            if self.shard is None: self.open_shard()
+            remaining = self.target_shard_bytes - self.shard.uncompressed_bytes
+            if self.target_shard_bytes <= 0 or len(data) < remaining:
+                self.write_shard(data)
+                return
+            #the shard is full once the record that crosses the target size is complete
+            newline = self.find_record_end(data, max(remaining-1, 0))
+            if newline < 0:
+                self.write_shard(data)
+                return
+            self.write_shard(data[:newline+1])
+            self.close_shard()
+            data = data[newline+1:]
+
+    def write_row(self, row):
+        self.csvwriter.writerow(row)
+        self.buffered_rows += 1
+        if self.buffered_rows >= CSV_WRITE_BATCH_ROWS: self.flush_rows()
+
+    def flush_rows(self):
+        data = self.rowbuffer.getvalue()
+        self.rowbuffer.seek(0)
+        self.rowbuffer.truncate()
+        self.buffered_rows = 0
+        if data: self.write(data)
+
+    def write_shard(self, data):
+        self.quote_parity = (self.quote_parity + data.count(b'"')) % 2
+        self.shard.write(data)
+
+    """
+    Quoted CSV fields can contain line breaks, so a newline only ends a record if there's an even number of quotes before it
+    (escaped quotes are doubled, so they don't change the parity).
+    """
+    def find_record_end(self, data, start):
+        newline = data.find(b'\n', start)
+        while newline >= 0:
+            if (self.quote_parity + data.count(b'"', 0, newline)) % 2 == 0: return newline
+            newline = data.find(b'\n', newline+1)
+        return -1
+
+    def close(self):
+        self.flush_rows()
+        if self.shard: self.close_shard()
+
+    def abort(self):
+        if self.shard: self.shard.abort()
+        self.shard = None
+
+
+"""
+Routes rows to a different writer for each partition (i.e. usage_date=2017-06-01). Writers are created by writer_factory(partition)
+the first time a row for a partition is written. Every open writer buffers up to a multipart part, so at most max_open_writers
+are open at a time (0 means no limit). Rows for other partitions are spilled to local temporary files (see RowSpill) and written
+once the open writers are complete, one partition at a time. Each partition is written by a single writer, so files are only
+split when they reach the writer's shard size, no matter how rows for different partitions are interleaved.
+"""
+
+class PartitionedWriter():
+
+    def __init__(self, writer_factory, max_open_writers=0):
+        self.writer_factory = writer_factory
+        self.max_open_writers = max_open_writers
+        self.writers = {}
+        self.spills = {}
+        self.partition_keys = {}
+
+    def write_partition_row(self, partition, row):
+        writer = self.writers.get(partition)
+        if writer is None and partition not in self.spills:
+            if self.max_open_writers <= 0 or len(self.writers) < self.max_open_writers:
+                writer = self.open_writer(partition)
+            else:
+                self.spills[partition] = RowSpill()
+        if writer is not None: writer.write_row(row)
+        else: self.spills[partition].write_row(row)
+
+    def open_writer(self, partition):
+        writer = self.writer_factory(partition)
+        self.writers[partition] = writer
+        return writer
+
+    def close_writer(self, partition):
+        writer = self.writers.pop(partition)
+        writer.close()
+        self.partition_keys[partition] = writer.keys
+
+    @property
+    def keys(self):
+        result = []
+        for partition in sorted(self.partition_keys.keys()):
+            result.extend(self.partition_keys[partition])
+        return result
+
+    def close(self):
+        for partition in sorted(self.writers.keys()):
+            self.close_writer(partition)
+        for partition in sorted(self.spills.keys()):
+            spill = self.spills.pop(partition)
+            try:
+                writer = self.open_writer(partition)
+                for row in spill.iter_rows(): writer.write_row(row)
+                self.close_writer(partition)
+            finally:
+                spill.close()
+
+    def abort(self):
+        for writer in self.writers.values():
+            writer.abort()
+        self.writers = {}
+        for spill in self.spills.values():
+            spill.close()
+        self.spills = {}
+
+
+"""
+Keeps rows in a local temporary file until they can be written. Rows are pickled and compressed in batches of batch_rows,
+so only one batch is kept in memory. The file is deleted when the spill is closed.
+"""
+
+class RowSpill():
+
+    def __init__(self, batch_rows=CSV_WRITE_BATCH_ROWS):
+        self.file = tempfile.TemporaryFile()
+        self.batch_rows = batch_rows
+        self.batch = []
+        self.rows = 0
+
+    def write_row(self, row):
+        self.batch.append(row)
+        self.rows += 1
+        if len(self.batch) >= self.batch_rows: self.flush()
+
+    def flush(self):
+        if not self.batch: return
+        cPickle.dump(zlib.compress(cPickle.dumps(self.batch, cPickle.HIGHEST_PROTOCOL), 1), self.file, cPickle.HIGHEST_PROTOCOL)
+        self.batch = []
+
+    def iter_rows(self):
+        self.flush()
+        self.file.seek(0)
+        while True:
+            try:
+                batch = cPickle.loads(zlib.decompress(cPickle.load(self.file)))
+            except EOFError:
+                break
+            for row in batch: yield row
+
+    def close(self):
+        self.batch = []
+        self.file.close()
+
+
+"""
+File-like object that uploads whatever is written to it to S3 using a multipart upload. Data is buffered in memory
+only until a part is complete, which means memory usage is bounded by part_size regardless of the size of the object.
+Objects smaller than a single part are uploaded with a regular put_object call.
+"""
+
+class S3MultipartUploadWriter():
+
+    def __init__(self, s3client, bucket, key, extra_args=None, part_size=MIN_MULTIPART_PART_SIZE):
+        self.s3client = s3client
+        self.bucket = bucket
+        self.key = key
+        self.extra_args = extra_args or {}
+        self.part_size = max(part_size, MIN_MULTIPART_PART_SIZE)
+        self.upload_id = ''
+        self.parts = []
+        self.buffer = []
+        self.buffered_bytes = 0
+        self.bytes_written = 0
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type: self.abort()
+        else: self.close()
+        return False
+
+    def write(self, data):
+        if not data: return
+        self.buffer.append(data)
+        self.buffered_bytes += len(data)
+        self.bytes_written += len(data)
+        if self.buffered_bytes >= self.part_size:
+            self.upload_part()
+
+    def tell(self):
+        return self.bytes_written
+
+    def flush(self):
+        pass
+
+    def upload_part(self):
+        if not self.upload_id:
+            response = self.s3client.create_multipart_upload(Bucket=self.bucket, Key=self.key, **self.extra_args)
+            self.upload_id = response['UploadId']
+        partnumber = len(self.parts) + 1
+        body = b''.join(self.buffer)
+        self.buffer = []
+        self.buffered_bytes = 0
+        response = self.s3client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                             PartNumber=partnumber, Body=body)
+        self.parts.append({'ETag':response['ETag'], 'PartNumber':partnumber})
+
+    def close(self):
+        if self.closed: return
+        try:
+            if not self.upload_id:
+                self.s3client.put_object(Bucket=self.bucket, Key=self.key, Body=b''.join(self.buffer), **self.extra_args)
+            else:
+                if self.buffer: self.upload_part()
+                self.s3client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                                        MultipartUpload={'Parts':self.parts})
+        except Exception:
+            self.abort()
+            raise
+        self.buffer = []
+        self.closed = True
+        log.info("Uploaded [s3://{}/{}] - bytes:[{}] - parts:[{}]".format(self.bucket, self.key, self.bytes_written, max(len(self.parts),1)))
+
+    """
+    Incomplete multipart uploads are billed as storage until they're aborted, so make sure they're cleaned up on errors.
+    """
+    def abort(self):
+        if self.closed: return
+        if self.upload_id:
+            log.info("Aborting multipart upload for [s3://{}/{}] - uploadId:[{}]".format(self.bucket, self.key, self.upload_id))
+            self.s3client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+        self.buffer = []
+        self.closed = True
+
+
+"""
+Copies an object from one bucket to another without transferring any data through the caller: S3 copies the bytes server side.
+The destination object gets the metadata and storage class in extra_args (the source metadata is replaced). Objects larger than
+5GB are copied using a multipart upload with upload_part_copy, one byte range per part, up to copy_workers parts at a time.
+s3client must be able to read the source object and write the destination object. Returns the destination key.
+"""
+def copy_object(s3client, sourceBucket, sourceKey, destBucket, destKey, size, extra_args=None, part_size=DEFAULT_COPY_PART_SIZE,
+                copy_workers=DEFAULT_COPY_WORKERS):
+    extra_args = extra_args or {}
+    copysource = {'Bucket':sourceBucket, 'Key':sourceKey}
+    if size <= MAX_COPY_OBJECT_SIZE:
+        s3client.copy_object(Bucket=destBucket, Key=destKey, CopySource=copysource, MetadataDirective='REPLACE', **extra_args)
+        log.info("Copied [s3://{}/{}] to [s3://{}/{}] - bytes:[{}]".format(sourceBucket, sourceKey, destBucket, destKey, size))
+        return destKey
+
+    part_size = min(max(part_size, MIN_MULTIPART_PART_SIZE, -(-size // MAX_MULTIPART_PARTS)), MAX_COPY_OBJECT_SIZE)
+    upload_id = s3client.create_multipart_upload(Bucket=destBucket, Key=destKey, **extra_args)['UploadId']
+
+    def copy_part(partnumber):
+        start = (partnumber-1) * part_size
+        byterange = "bytes={}-{}".format(start, min(start+part_size, size)-1)
+        response = s3client.upload_part_copy(Bucket=destBucket, Key=destKey, UploadId=upload_id, PartNumber=partnumber,
+                                             CopySource=copysource, CopySourceRange=byterange)
+        return {'ETag':response['CopyPartResult']['ETag'], 'PartNumber':partnumber}
+
+    partnumbers = range(1, -(-size // part_size) + 1)
+    pool = ThreadPool(min(copy_workers, len(partnumbers)))
+    try:
+        parts = pool.map(copy_part, partnumbers)#parts are copied in parallel, results keep the part order
+        s3client.complete_multipart_upload(Bucket=destBucket, Key=destKey, UploadId=upload_id, MultipartUpload={'Parts':parts})
+    except Exception:
+        s3client.abort_multipart_upload(Bucket=destBucket, Key=destKey, UploadId=upload_id)
+        raise
+    finally:
+        pool.close()
+        pool.join()
+    log.info("Copied [s3://{}/{}] to [s3://{}/{}] - bytes:[{}] - parts:[{}]".format(sourceBucket, sourceKey, destBucket, destKey, size, len(parts)))
+    return destKey
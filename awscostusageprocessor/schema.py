@@ -0,0 +1,170 @@
+import re
+import calendar
+import datetime
+import logging
+
+import awscostusageprocessor.utils as utils
+import awscostusageprocessor.consts as consts
+from awscostusageprocessor.errors import ValidationError
+
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+
+
+ATHENA_TYPE_STRING = 'string'
+ATHENA_TYPE_DOUBLE = 'double'
+ATHENA_TYPE_BIGINT = 'bigint'
+ATHENA_TYPE_TIMESTAMP = 'timestamp'
+
+#Types in the 'columns' section of the CUR manifest
+MANIFEST_TYPES = {
+    'BigDecimal': ATHENA_TYPE_DOUBLE,
+    'OptionalBigDecimal': ATHENA_TYPE_DOUBLE,
+    'Double': ATHENA_TYPE_DOUBLE,
+    'Integer': ATHENA_TYPE_BIGINT,
+    'OptionalInteger': ATHENA_TYPE_BIGINT,
+    'Long': ATHENA_TYPE_BIGINT,
+    'DateTime': ATHENA_TYPE_TIMESTAMP
+}
+
+#Columns used by the queries in queries.properties always get the same type, regardless of what the manifest says (older manifests
+#don't include types). This way API queries can be generated without looking at the table definition.
+KNOWN_COLUMN_TYPES = {
+    'bill_billingperiodstartdate': ATHENA_TYPE_TIMESTAMP,
+    'bill_billingperiodenddate': ATHENA_TYPE_TIMESTAMP,
+    'lineitem_usagestartdate': ATHENA_TYPE_TIMESTAMP,
+    'lineitem_usageenddate': ATHENA_TYPE_TIMESTAMP,
+    'lineitem_usageamount': ATHENA_TYPE_DOUBLE,
+    'lineitem_normalizationfactor': ATHENA_TYPE_DOUBLE,
+    'lineitem_normalizedusageamount': ATHENA_TYPE_DOUBLE,
+    'lineitem_unblendedrate': ATHENA_TYPE_DOUBLE,
+    'lineitem_unblendedcost': ATHENA_TYPE_DOUBLE,
+    'lineitem_blendedrate': ATHENA_TYPE_DOUBLE,
+    'lineitem_blendedcost': ATHENA_TYPE_DOUBLE,
+    'pricing_publicondemandcost': ATHENA_TYPE_DOUBLE,
+    'pricing_publicondemandrate': ATHENA_TYPE_DOUBLE
+}
+
+TIMESTAMP_FORMATS = ['%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%dT%H:%M:%S.%fZ', '%Y-%m-%dT%H:%MZ', '%Y-%m-%d %H:%M:%S']
+ATHENA_TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S.000' #how Athena returns timestamp values in query results
+
+CAST_REGEX = re.compile(r"cast\(\s*([a-z0-9_]+)\s+as\s+double\s*\)", re.IGNORECASE)
+
+
+"""
+Maps the columns in a CUR manifest (category/name/type) to Athena columns. When typed is False, all columns are strings,
+which is how tables were originally created.
+"""
+
+class CurSchema():
+
+    def __init__(self, manifestColumns, typed=True):
+        self.typed = typed
+        self.columns = []
+        for c in manifestColumns:
+            name = utils.get_column_name(c['category'], c['name'])
+            athenaType = ATHENA_TYPE_STRING
+            if typed: athenaType = get_column_type(name, c.get('type',''))
+            self.columns.append({'category':c['category'], 'name':name, 'type':athenaType})
+
+    def get_names(self):
+        return [c['name'] for c in self.columns]
+
+    def get_index(self, name):
+        return self.get_names().index(name)
+
+    """
+    Returns a converter for each column that isn't a string. See ValueConverter.
+    """
+    def get_converters(self):
+        result = []
+        for i, c in enumerate(self.columns):
+            if c['type'] != ATHENA_TYPE_STRING:
+                result.append(ValueConverter(i, c['name'], c['type']))
+        return result
+
+
+def get_column_type(name, manifestType):
+    if name in KNOWN_COLUMN_TYPES: return KNOWN_COLUMN_TYPES[name]
+    return MANIFEST_TYPES.get(manifestType, ATHENA_TYPE_STRING)
+
+
+"""
+Parses the values of a typed column while report files are processed. This validates that Athena will be able to read every value
+using the declared type. Values that can't be parsed are counted and replaced with None (NULL in Athena), instead of
+making the whole query fail. Parsed values are returned as Python types (float, int, or epoch milliseconds for timestamps),
+which is what Parquet files need.
+"""
+
+class ValueConverter():
+
+    def __init__(self, index, name, athenaType):
+        self.index = index
+        self.name = name
+        self.type = athenaType
+        self.invalid_count = 0
+        self.timestamps = {}#CUR files repeat the same hourly timestamps in every row, so parsed values are cached
+
+    def parse(self, value):
+        if value == '': return None
+        try:
+            if self.type == ATHENA_TYPE_DOUBLE: return float(value)
+            if self.type == ATHENA_TYPE_BIGINT: return int(value)
+            if self.type == ATHENA_TYPE_TIMESTAMP:
+                if value not in self.timestamps:
+                    self.timestamps[value] = parse_timestamp_millis(value)
+                return self.timestamps[value]
+        except ValueError:
+            if not self.invalid_count:
+                log.warning("Invalid {} value in column [{}]: [{}]".format(self.type, self.name, value))
+            self.invalid_count += 1
+            return None
+        return value
+
+
+
+"""
+Typed columns are only supported in Parquet files. OpenCSVSerde can't read empty values in double, bigint or timestamp columns
+(HIVE_BAD_DATA), and it has no NULL marker, but reports have many empty numeric columns (i.e. pricing/*, reservation/*).
+"""
+def validate_storage_format(typed, storageFormat):
+    if typed and storageFormat != consts.STORAGE_FORMAT_PARQUET:
+        raise ValidationError("Typed columns are only supported in [{}] files, got [{}]. Prepare Parquet files or disable the typed schema".format(
+                                consts.STORAGE_FORMAT_PARQUET, storageFormat))
+
+
+def parse_timestamp_millis(value):
+    #CUR DateTime values can also be intervals (start/end), in that case the start is used
+    value = value.split('/')[0]
+    for f in TIMESTAMP_FORMATS:
+        try:
+            ts = datetime.datetime.strptime(value, f)
+            return calendar.timegm(ts.timetuple()) * 1000 + ts.microsecond // 1000
+        except ValueError:
+            pass
+    raise ValueError("Invalid timestamp: [{}]".format(value))
+
+
+"""
+Results of typed tables must look the same regardless of where they come from (Athena, the local engine or rollups):
+timestamps are formatted the way Athena returns them. value can be a datetime (Parquet files), epoch milliseconds (typed CSV files)
+or a timestamp from a CUR file.
+"""
+def format_athena_timestamp(value):
+    if value is None or value == '': return ''
+    if not isinstance(value, datetime.datetime):
+        millis = int(value) if str(value).isdigit() else parse_timestamp_millis(value)
+        value = datetime.datetime.utcfromtimestamp(millis/1000.0)
+    return value.strftime(ATHENA_TIMESTAMP_FORMAT)
+
+
+"""
+SQL templates in queries.properties were written for tables where every column is a string, therefore numeric columns are cast to double.
+For typed tables those casts are not needed: this function removes them for columns that are always typed as double.
+"""
+def remove_casts(sqlstatement):
+    def replace(match):
+        column = match.group(1)
+        if KNOWN_COLUMN_TYPES.get(column.lower(),'') == ATHENA_TYPE_DOUBLE: return column
+        return match.group(0)
+    return CAST_REGEX.sub(replace, sqlstatement)
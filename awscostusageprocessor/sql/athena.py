@@ -4,12 +4,14 @@ __location__ = os.path.dirname(os.path.realpath(__file__))
 site_pkgs = os.path.join(os.path.split(__location__)[0], "lib", "python2.7", "site-packages")
 sys.path.append(site_pkgs)
 
-import time, logging, json, datetime, pytz
+import time, random, decimal, csv, hashlib, threading, logging, json, datetime, pytz
 import boto3, botocore
 from botocore.config import Config
 import awscostusageprocessor.utils as utils
 import awscostusageprocessor.consts as consts
 import awscostusageprocessor.errors as errors
+import awscostusageprocessor.schema as schema
+import awscostusageprocessor.s3stream as s3stream
 
 log = logging.getLogger()
 log.setLevel(logging.INFO)
@@ -18,6 +20,7 @@ log.setLevel(logging.INFO)
 athenaclient = boto3.client('athena')
 s3resource = boto3.resource('s3')
 ddbclient = boto3.client('dynamodb')
+glueclient = boto3.client('glue') #Athena tables are in the Glue Data Catalog, reading them doesn't need a query
 
 
 
@@ -26,109 +29,238 @@ ddbclient = boto3.client('dynamodb')
 QUERY_EXECUTIONS_FOLDER = 'queryexecutions'
 QUERY_METADATA_FOLDER = 'querymetadata'
 
+#Query state is polled with exponential backoff: short intervals for fast queries, fewer API calls for long ones
+POLL_INITIAL_INTERVAL_MS = 100
+POLL_MAX_INTERVAL_MS = 5000
+POLL_BACKOFF_MULTIPLIER = 2
+BATCH_GET_QUERY_EXECUTION_MAX_IDS = 50
+RETRYABLE_ERROR_CODES = ('ThrottlingException', 'TooManyRequestsException', 'InternalServerException')
+
+DDL_QUERY_IDS = (consts.QUERY_ID_CREATE_DATABASE, consts.QUERY_ID_DROP_TABLE, consts.QUERY_ID_CREATE_TABLE, consts.QUERY_ID_ALTER_TABLE)
+ACCOUNT_TABLE_NAME = 'hourly' #table name for the account table layout
+STALE_QUERY_STATES = (consts.ATHENA_QUERY_STATE_FAILED, consts.ATHENA_QUERY_STATE_CANCELLED)
+UNKNOWN_LAST_PROCESSED_TIMESTAMP = datetime.datetime(2050,01,01)
+
+#Metadata of completed query executions, cached across warm invocations: key -> (expiration, value)
+_metadataCache = {}
+_metadataCacheLock = threading.Lock()
+
+GET_QUERY_RESULTS_MAX_RESULTS = 1000
+RESULT_MODE_DICT = 'dict'
+RESULT_MODE_TUPLE = 'tuple'
+RESULT_MODE_COLUMNS = 'columns'
+RESULT_MODES = (RESULT_MODE_DICT, RESULT_MODE_TUPLE, RESULT_MODE_COLUMNS)
+ATHENA_FINAL_QUERY_STATES = (consts.ATHENA_QUERY_STATE_FAILED, consts.ATHENA_QUERY_STATE_CANCELLED, consts.ATHENA_QUERY_STATE_SUCCEEDED)
+
 
 
 class AthenaQueryMgr():
-    def __init__(self,athena_base_output_s3_bucket, accountid, year, month):
+    def __init__(self,athena_base_output_s3_bucket, accountid, year, month, typedSchema=consts.CUR_PROCESSOR_TYPED_SCHEMA,
+                 partitionByUsageDate=consts.CUR_PROCESSOR_PARTITION_BY_USAGE_DATE, tableLayout=consts.ATHENA_TABLE_LAYOUT):
+        if tableLayout not in consts.VALID_ATHENA_TABLE_LAYOUTS:
+            raise errors.ValidationError("Invalid table layout [{}], valid options are: {}".format(tableLayout, consts.VALID_ATHENA_TABLE_LAYOUTS))
         #Athena query output is placed in a bucket and prefix with the account id and month.
         self.athena_output_s3_location = "{}/{}/{}".format(athena_base_output_s3_bucket, accountid, utils.get_period_prefix(year, month))
         self.athena_result_configuration = {'OutputLocation': self.athena_output_s3_location+QUERY_EXECUTIONS_FOLDER+"/", 'EncryptionConfiguration': {'EncryptionOption': 'SSE_S3'}}
         self.dbname = "costusage_"+accountid
         self.tablename = "hourly_"+utils.get_period_prefix(year, month).replace("-","_").replace("/","")
         self.payerAccountid = accountid
+        self.typedSchema = typedSchema #numeric and timestamp columns are typed instead of strings, see schema.CurSchema
+        self.partitionByUsageDate = partitionByUsageDate #files are placed in usage_date=YYYY-MM-DD partitions, see processor.get_partition_key
+        self.periodDates = utils.get_period_dates(year, month)
+        self.tableLayout = tableLayout
+        self.billingPeriod = utils.get_period_prefix(year, month).replace("/","")
+        if tableLayout == consts.ATHENA_TABLE_LAYOUT_ACCOUNT: self.tablename = ACCOUNT_TABLE_NAME
+        self.submitted = {} #fresh executions whose statistics haven't been stored yet: queryexecutionid -> (fingerprint, metadata)
+        self.lastProcessedTimestamp = None #read once per instance, see get_last_processed_timestamp
 
 
-    #TODO: add option to execute synchronously or asynchronously
+    """
+    Runs a query and waits until it finishes. Returns the query execution id and its final state.
+    """
     def execute_query(self, queryid, querystring):
+        queryexecutionid, runfresh = self.submit_query(queryid, querystring)
+        querystate = self.poll_query_state(queryexecutionid, initialDelay=runfresh)
+        return queryexecutionid, querystate
+
+
+    """
+    Starts a query without waiting for it to finish (see poll_query_executions), or finds a previous execution of the same SQL
+    statement that is still valid (see should_run_fresh). Returns the query execution id and whether it's a new execution.
+    """
+    def submit_query(self, queryid, querystring):
         log.info("Query: {}".format(querystring))
 
         #Database management queries such as create database, create table or drop table should always execute fresh
-        if queryid in (consts.QUERY_ID_CREATE_DATABASE, consts.QUERY_ID_DROP_TABLE, consts.QUERY_ID_CREATE_TABLE):
-            runfresh = True
+        cacheable = queryid not in DDL_QUERY_IDS
+        if cacheable:
+            runfresh, queryexecutionid = self.should_run_fresh(queryid, querystring)
         else:
-            runfresh, queryexecutionid = self.should_run_fresh(queryid)
+            runfresh = True
 
-        querystate = ''
         if runfresh:
             log.info("Running fresh Athena query")
             start_query_response = athenaclient.start_query_execution(QueryString=querystring, ResultConfiguration=self.athena_result_configuration)
             queryexecutionid = self.get_queryexecutionid(start_query_response)
             log.info("QueryExecutionId: {}".format(queryexecutionid))
-            self.create_query_metadata(queryid, queryexecutionid)
-            querystate = self.poll_query_state(queryexecutionid, 500)
+            if cacheable:
+                metadata = self.create_query_metadata(queryid, queryexecutionid, querystring)
+                if metadata: self.submitted[queryexecutionid] = metadata
         else:
             log.info("Fetching results for query [{}] based on existing queryExecutionId: [{}]".format(queryid, queryexecutionid))
-            querystate = self.poll_query_state(queryexecutionid, 1)
 
-        return queryexecutionid, querystate
+        return queryexecutionid, runfresh
 
 
     """
-    This method determines if the query should be re-executed in Athena or if results should be fetched
-    based on the Athena queryid
+    This method determines if the query should be re-executed in Athena or if results should be fetched from a previous execution.
+    Executions are reused by SQL fingerprint (see get_query_fingerprint): the statement after replace_params, including its parameters
+    (i.e. a resource id or a date range), and the data version, which is the account's lastProcessedTimestamp. A new report makes
+    all previous executions stale. Executions that failed or were cancelled are not reused.
     """
-    def should_run_fresh(self, queryid):
+    def should_run_fresh(self, queryid, querystring):
         result = True
         queryexecutionid = ''
-        queryexecutionts = ''
-        lastProcessedTimestamp = datetime.datetime(2050,01,01)
+        dataVersion = self.get_data_version()
+        fingerprint = get_query_fingerprint(querystring, dataVersion)
+
+        querymetadatabody = self.get_query_metadata(fingerprint) if dataVersion else {}
+        if querymetadatabody.get('dataVersion') == dataVersion and querymetadatabody.get('state') not in STALE_QUERY_STATES:
+            queryexecutionid = querymetadatabody.get('queryExecutionId','')
+        if queryexecutionid: result = False
+
+        log.info("queryid: [{}] - fingerprint: [{}] - dataVersion: [{}] - run query from Athena: [{}] - queryexecutionid: [{}] - queryexecutionts: [{}]".
+                 format(queryid, fingerprint, dataVersion, result, queryexecutionid, querymetadatabody.get('queryExecutionTimestamp','')))
+        return result, queryexecutionid
+
+
+    """
+    Returns the last Cost and Usage processed timestamp from DynamoDB, based on accountid.
+    It's read once per instance (i.e. once per API call or batch of queries) and never cached across invocations, so a new report
+    is used as soon as it's processed.
+    """
+    def get_last_processed_timestamp(self):
+        if self.lastProcessedTimestamp is None:
+            self.lastProcessedTimestamp = UNKNOWN_LAST_PROCESSED_TIMESTAMP
+            response = ddbclient.get_item(TableName=consts.AWS_ACCOUNT_METADATA_DDB_TABLE,
+                                            Key={'awsPayerAccountId': {'S': self.payerAccountid }},
+                                            AttributesToGet=['lastProcessedTimestamp'],
+                                            ConsistentRead=False)
+            if 'Item' in response:
+                item = response['Item']
+                self.lastProcessedTimestamp = datetime.datetime.strptime(item['lastProcessedTimestamp']['S'], consts.TIMESTAMP_FORMAT)
+        return self.lastProcessedTimestamp
+
+    """
+    Query results are only reused for the data they were calculated from. Returns '' when the account has no processed reports,
+    in which case queries always run fresh.
+    """
+    def get_data_version(self):
+        lastProcessedTimestamp = self.get_last_processed_timestamp()
+        if lastProcessedTimestamp == UNKNOWN_LAST_PROCESSED_TIMESTAMP: return ''
+        return lastProcessedTimestamp.strftime(consts.TIMESTAMP_FORMAT)
+
 
-        #get the last Cost and Usage processed timestamp from DynamoDB based on accountid
-        response = ddbclient.get_item(TableName=consts.AWS_ACCOUNT_METADATA_DDB_TABLE,
-                                        Key={'awsPayerAccountId': {'S': self.payerAccountid }},
-                                        AttributesToGet=['lastProcessedTimestamp'],
-                                        ConsistentRead=False)
-        if 'Item' in response:
-            item = response['Item']
-            lastProcessedTimestamp = datetime.datetime.strptime(item['lastProcessedTimestamp']['S'], consts.TIMESTAMP_FORMAT)
+    """
+    The metadata of each execution is kept in its own object, querymetadata/<fingerprint>.json. Entries are only written by the function
+    that started the execution, so concurrent functions (init-athena-queries, API calls) never overwrite each other's entries.
+    Each query reads its own entry with one GET. Completed entries are cached by key, and the key has the data version (through the
+    fingerprint), so a new report never reads a cached entry.
+    """
+    def get_query_metadata(self, fingerprint):
+        bucket = self.get_athena_query_output_s3_bucket()
+        key = self.get_athena_query_output_s3_key(bucket, fingerprint)
+        return get_cached_metadata(('queryMetadata', bucket, key), lambda: read_json_object(bucket, key), cacheable=is_query_metadata_complete)
 
+    def put_query_metadata(self, fingerprint, metadatabody):
+        bucket = self.get_athena_query_output_s3_bucket()
+        s3resource.Object(bucket, self.get_athena_query_output_s3_key(bucket, fingerprint)).put(
+                Body=json.dumps(metadatabody, indent=4, sort_keys=True), StorageClass='REDUCED_REDUNDANCY')
 
-        #get latest execution timestamp from S3, based on the query id and accountid
+    def delete_query_metadata(self, fingerprint):
         bucket = self.get_athena_query_output_s3_bucket()
-        key = self.get_athena_query_output_s3_key(bucket, queryid)
-        querymetadatabody = {}
-        try:
-            if s3resource.Object(bucket,key).get():
-                querymetadatabody = json.loads(s3resource.Object(bucket,key).get()['Body'].read())
-            log.info("Looking for existing metadata: {}/{}: {}".format(bucket,key,json.dumps(querymetadatabody, indent=4)))
-            if 'queryExecutionId' in querymetadatabody: queryexecutionid = querymetadatabody['queryExecutionId']
-            if 'queryExecutionTimestamp' in querymetadatabody: queryexecutionts = querymetadatabody['queryExecutionTimestamp']
-        except botocore.exceptions.ClientError as e:
-            if e.response['Error']['Code'] == 'NoSuchKey':
-                queryexecutionts = consts.EPOCH_TS
-
-        #if there's a new processed CUR (query execution timestamp < CUR timestamp), then get query fresh
-        #else, get queryexecutionid
-        if  lastProcessedTimestamp < datetime.datetime.strptime(queryexecutionts, consts.TIMESTAMP_FORMAT):
-            result = False
-
-        if not queryexecutionid: result = True
-
-        log.info("queryid: [{}] - lastProcessedTimestamp: [{}] - run query from Athena: [{}] - queryexecutionid: [{}] - queryexecutionts: [{}]".
-                 format(queryid, lastProcessedTimestamp.strftime(consts.TIMESTAMP_FORMAT), result,queryexecutionid, queryexecutionts))
-        return result, queryexecutionid
+        s3resource.meta.client.delete_object(Bucket=bucket, Key=self.get_athena_query_output_s3_key(bucket, fingerprint))
+
+    """
+    Entries for previous data versions are never read again, since the data version is part of the fingerprint. They're deleted
+    once a new report is processed (see init-athena-queries): every entry written before the current lastProcessedTimestamp.
+    Returns the number of deleted entries.
+    """
+    def prune_query_metadata(self):
+        lastProcessedTimestamp = self.get_last_processed_timestamp()
+        if lastProcessedTimestamp == UNKNOWN_LAST_PROCESSED_TIMESTAMP: return 0
+        lastProcessedTimestamp = lastProcessedTimestamp.replace(tzinfo=pytz.utc)
+        bucket = self.get_athena_query_output_s3_bucket()
+        prefix = self.get_athena_query_output_s3_key(bucket, '')[:-len('.json')]
+        s3client = s3resource.meta.client
+        stale = []
+        for page in s3client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+            for o in page.get('Contents', []):
+                if o['LastModified'].replace(tzinfo=pytz.utc) < lastProcessedTimestamp: stale.append({'Key':o['Key']})
+        for i in range(0, len(stale), 1000):
+            s3client.delete_objects(Bucket=bucket, Delete={'Objects':stale[i:i+1000], 'Quiet':True})
+        log.info("Deleted [{}] stale query metadata entries from [{}/{}]".format(len(stale), bucket, prefix))
+        return len(stale)
 
 
     """
     Athena query executions take some time to complete. This method polls the execution state until there is a result (or failure).
+    Raises AthenaExecutionFailedException if the query fails and AthenaQueryTimeoutError if it doesn't finish before timeout (seconds).
     """
-    #TODO: send a timeout parameter
-    def poll_query_state(self,queryexecutionid, sleep_ms):
-        sleep_ms = float(sleep_ms)/1000
-        querystate = ''
+    def poll_query_state(self, queryexecutionid, timeout=consts.ATHENA_QUERY_TIMEOUT_SECONDS, initialDelay=True):
+        queryexecution = self.poll_query_executions([queryexecutionid], timeout, initialDelay)[queryexecutionid]
+        querystate = queryexecution['Status']['State']
+        if querystate == consts.ATHENA_QUERY_STATE_FAILED:
+            querystatereason = queryexecution['Status'].get('StateChangeReason', '')
+            raise errors.AthenaExecutionFailedException("AthenaExecutionFailedException reason [{}]".format(querystatereason))
+        return querystate
+
+
+    """
+    Polls several query executions at once, with a single batch_get_query_execution call per interval (for up to 50 queries),
+    until all of them are in a final state. Intervals start at POLL_INITIAL_INTERVAL_MS and grow exponentially up to POLL_MAX_INTERVAL_MS,
+    with random jitter so concurrent callers don't poll in lockstep. Returns a dictionary of queryexecutionid and QueryExecution;
+    failed queries are returned, not raised. Raises AthenaQueryTimeoutError if there are queries still running after timeout (seconds).
+    """
+    def poll_query_executions(self, queryexecutionids, timeout=consts.ATHENA_QUERY_TIMEOUT_SECONDS, initialDelay=True):
+        deadline = time.time() + timeout
+        result = {}
+        pending = list(queryexecutionids)
+        intervals = get_poll_intervals()
+        if initialDelay: time.sleep(next(intervals))
         while True:
-            queryexecution = athenaclient.get_query_execution(QueryExecutionId=queryexecutionid)
-            querystate = queryexecution['QueryExecution']['Status']['State']
-            if querystate == consts.ATHENA_QUERY_STATE_FAILED:
-                querystatereason = ""
-                if 'StateChangeReason' in queryexecution['QueryExecution']['Status']:
-                    querystatereason = queryexecution['QueryExecution']['Status']['StateChangeReason']
-                raise errors.AthenaExecutionFailedException("AthenaExecutionFailedException reason [{}]".format(querystatereason))
+            for i in range(0, len(pending), BATCH_GET_QUERY_EXECUTION_MAX_IDS):
+                response = athenaclient.batch_get_query_execution(QueryExecutionIds=pending[i:i+BATCH_GET_QUERY_EXECUTION_MAX_IDS])
+                for queryexecution in response.get('QueryExecutions', []):
+                    if queryexecution['Status']['State'] in ATHENA_FINAL_QUERY_STATES:
+                        result[queryexecution['QueryExecutionId']] = queryexecution
+                for unprocessed in response.get('UnprocessedQueryExecutionIds', []):#i.e. unknown execution ids, throttled ids are checked again
+                    if unprocessed.get('ErrorCode') not in RETRYABLE_ERROR_CODES:
+                        raise errors.AthenaExecutionFailedException("AthenaExecutionFailedException queryExecutionId [{}] [{}] [{}]".format(
+                                unprocessed.get('QueryExecutionId'), unprocessed.get('ErrorCode'), unprocessed.get('ErrorMessage','')))
+            pending = [q for q in pending if q not in result]
+            log.info("querystates {}".format(dict([(q, result[q]['Status']['State']) for q in queryexecutionids if q in result])))
+            if not pending: break
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise errors.AthenaQueryTimeoutError("AthenaQueryTimeoutError - queries still running after [{}] seconds: {}".format(timeout, pending))
+            time.sleep(min(next(intervals), remaining))
+
+        #statistics of fresh executions are stored with the number of result rows (see get_query_execution_results),
+        #metadata of failed executions is deleted so they're not reused
+        for queryexecutionid, queryexecution in result.items():
+            if queryexecutionid not in self.submitted: continue
+            fingerprint, metadata = self.submitted[queryexecutionid]
+            state = queryexecution['Status']['State']
+            if state in STALE_QUERY_STATES:
+                self.delete_query_metadata(fingerprint)
+                del self.submitted[queryexecutionid]
             else:
-                log.info("querystate {}".format(querystate))
-            if querystate in [consts.ATHENA_QUERY_STATE_FAILED,consts.ATHENA_QUERY_STATE_CANCELLED,consts.ATHENA_QUERY_STATE_SUCCEEDED]:break
-            else: time.sleep(sleep_ms)
-        return querystate
+                statistics = queryexecution.get('Statistics', {})
+                metadata.update({'state':state, 'dataScannedInBytes':statistics.get('DataScannedInBytes'),
+                                 'engineExecutionTimeInMillis':statistics.get('EngineExecutionTimeInMillis')})
+        return result
 
 
     def get_queryexecutionid(self,response):
@@ -139,71 +271,259 @@ class AthenaQueryMgr():
     """
     This method returns query results as an array of dictionaries, which can be converted to a JSON object
     """
-    def get_query_execution_results(self, queryexecutionid):
-        result = []
+    def get_query_execution_results(self, queryexecutionid, typed=False):
         #TODO: validate first that the query execution status is 'SUCCEEDED'
-        queryresults = athenaclient.get_query_results(QueryExecutionId=queryexecutionid)#TODO:paginate
-        log.debug("queryresults: {}".format(json.dumps(queryresults,indent=4)))
-        rowheaders = queryresults['ResultSet']['Rows'][0]['Data']#The first item in ['ResultSet']['Rows'] contains a list of the column names
-        rowindex = 0
-        for r in queryresults['ResultSet']['Rows']:
-            row_dict = {}
-            if rowindex > 0:#skip column names
-                columnindex = 0
-                for columnvalue in r['Data']:
-                    row_dict[rowheaders[columnindex]['VarCharValue']] = columnvalue['VarCharValue']
-                    columnindex += 1
-                result.append(row_dict)
-            rowindex += 1
+        result = list(self.iter_query_execution_results(queryexecutionid, typed=typed))
+        if queryexecutionid in self.submitted:
+            fingerprint, metadata = self.submitted.pop(queryexecutionid)
+            metadata['resultRows'] = len(result)
+            self.put_query_metadata(fingerprint, metadata)
+        return result
+
+    """
+    Reads query results one page (up to 1000 rows) at a time, following NextToken, so result sets of any size are read completely
+    and only one page is kept in memory. Rows are yielded as dictionaries (RESULT_MODE_DICT), tuples in column order (RESULT_MODE_TUPLE),
+    or one dictionary of column name and list of values per page (RESULT_MODE_COLUMNS). With typed=True, values are converted
+    based on the column types Athena returns (see get_result_converter), otherwise they're strings. NULL values are returned as None,
+    except in string columns of rows read from S3, where they can't be told apart from empty strings.
+    The first row of SELECT results has the column names; skipHeader=False is for statements such as SHOW DATABASES, which don't have it.
+
+    Once ATHENA_S3_RESULTS_MIN_ROWS rows have been read, if there are more pages, the rest of the rows are streamed from the CSV file
+    Athena writes in the output location instead, with a single GET request (see iter_s3_results). Small results only need one API call.
+    """
+    def iter_query_execution_results(self, queryexecutionid, mode=RESULT_MODE_DICT, typed=False, skipHeader=True):
+        if mode not in RESULT_MODES:
+            raise errors.ValidationError("Invalid result mode [{}], valid options are: {}".format(mode, RESULT_MODES))
+        pages = self.iter_api_results(queryexecutionid, typed, skipHeader, consts.ATHENA_S3_RESULTS_MIN_ROWS if skipHeader else 0)
+        for names, values in pages:
+            if mode == RESULT_MODE_COLUMNS:
+                if values: yield dict(zip(names, [list(c) for c in zip(*values)]))
+            elif mode == RESULT_MODE_TUPLE:
+                for v in values: yield v
+            else:
+                for v in values: yield dict(zip(names, v))
+
+    """
+    Yields the column names and a page of rows (as tuples) for each get_query_results call. Once s3MinRows rows were read
+    (0 means never), the remaining rows are read from the result file in S3.
+    """
+    def iter_api_results(self, queryexecutionid, typed=False, skipHeader=True, s3MinRows=0):
+        kwargs = {'QueryExecutionId':queryexecutionid, 'MaxResults':GET_QUERY_RESULTS_MAX_RESULTS}
+        names = None
+        converters = None
+        rowcount = 0
+        while True:
+            queryresults = athenaclient.get_query_results(**kwargs)
+            rows = queryresults['ResultSet']['Rows']
+            if names is None:
+                columninfo = queryresults['ResultSet'].get('ResultSetMetadata',{}).get('ColumnInfo',[])
+                if skipHeader and rows:
+                    names = [c.get('VarCharValue','') for c in rows[0]['Data']]#The first row contains a list of the column names
+                    rows = rows[1:]
+                else:
+                    names = [c['Name'] for c in columninfo]
+                converters = get_result_converters(columninfo, len(names), typed)
+
+            yield names, [tuple([convert(c.get('VarCharValue')) for convert, c in zip(converters, r['Data'])]) for r in rows]
+            rowcount += len(rows)
+
+            if not queryresults.get('NextToken'): break
+            if s3MinRows > 0 and rowcount >= s3MinRows:
+                for page in self.iter_s3_results(queryexecutionid, typed, skipRows=rowcount, columninfo=columninfo): yield page
+                break
+            kwargs['NextToken'] = queryresults['NextToken']
+
+    """
+    Streams the result CSV file from S3 and parses it incrementally, yielding the column names and pages of
+    GET_QUERY_RESULTS_MAX_RESULTS rows (as tuples), after the first skipRows rows. Athena writes NULL values and empty strings as empty
+    fields in CSV files: they're returned as '' in string columns, same as empty strings in iter_api_results, and as None in typed
+    columns. Column types are not in the CSV file: typed results need columninfo, or one get_query_results call to get them.
+    """
+    def iter_s3_results(self, queryexecutionid, typed=False, skipRows=0, columninfo=None):
+        bucket, key = self.get_result_s3_location(queryexecutionid)
+        log.info("Reading query results from [s3://{}/{}] - skipped rows: [{}]".format(bucket, key, skipRows))
+        response = s3resource.meta.client.get_object(Bucket=bucket, Key=key)
+        rows = csv.reader(s3stream.split_lines(s3stream.iter_stream_chunks(response['Body'])))
+        names = next(rows, [])
+        if typed and columninfo is None:
+            columninfo = athenaclient.get_query_results(QueryExecutionId=queryexecutionid, MaxResults=1)['ResultSet'].get('ResultSetMetadata',{}).get('ColumnInfo',[])
+        converters = get_result_converters(columninfo or [], len(names), typed)
+        for i in range(skipRows): next(rows, None)
+        page = []
+        for row in rows:
+            page.append(tuple([convert(v) for convert, v in zip(converters, row)]))
+            if len(page) == GET_QUERY_RESULTS_MAX_RESULTS:
+                yield names, page
+                page = []
+        if page or not names: yield names, page
+
+    """
+    Athena writes the results of every query to <OutputLocation><queryexecutionid>.csv (statements like SHOW DATABASES or DDL
+    write .txt files instead, which are never read from S3).
+    """
+    def get_result_s3_location(self, queryexecutionid):
+        location = self.athena_result_configuration['OutputLocation'] + queryexecutionid + '.csv'
+        bucket, key = location[len('s3://'):].split('/', 1)
+        return bucket, key
+
+    """
+    Creates the database and table for the files of the billing period in curS3Prefix (<destPrefix><accountId>/<period>/).
+    With the monthly layout the period's table is dropped and created again. With the account layout (see prepare_account_table),
+    DDL only runs when something changed.
+    """
+    def create_resources(self, curManifest, curS3Bucket, curS3Prefix, storageFormat=consts.STORAGE_FORMAT_TEXTFILE):
+        schema.validate_storage_format(self.typedSchema, storageFormat)
+        if self.tableLayout == consts.ATHENA_TABLE_LAYOUT_ACCOUNT:
+            return self.prepare_account_table(curManifest, curS3Bucket, curS3Prefix, storageFormat)
+        self.create_database()
+        self.drop_table()
+        return self.create_table(curManifest, curS3Bucket, curS3Prefix, storageFormat)
+
+    """
+    The account layout has a single table per account, partitioned by billing period, so queries can read several months and
+    Athena only scans the periods in the query (see get_usage_date_filter). The table and partitions are read from the Glue Data Catalog
+    and DDL queries only run when the table doesn't exist, when a new period appears (ALTER TABLE ADD PARTITION) or when a period
+    has columns that are not in the table (ALTER TABLE ADD COLUMNS). Only Parquet files are supported (see validate_table_layout).
+    """
+    def prepare_account_table(self, curManifest, curS3Bucket, curS3Prefix, storageFormat=consts.STORAGE_FORMAT_TEXTFILE):
+        validate_table_layout(self.tableLayout, storageFormat)
+        table = self.get_table_metadata()
+        if table is None:
+            log.info("Creating table [{}.{}]".format(self.dbname, self.tablename))
+            self.create_database()
+            self.create_table(curManifest, curS3Bucket, curS3Prefix, storageFormat)
+        else:
+            self.align_table_columns(table, schema.CurSchema(curManifest.get('columns',[]), self.typedSchema).columns)
+
+        if self.has_billing_period_partition():
+            log.info("Partition [{}={}] already exists in table [{}.{}]".format(consts.BILLING_PERIOD_PARTITION_COLUMN, self.billingPeriod, self.dbname, self.tablename))
+            return None
+        return self.execute_query(consts.QUERY_ID_ALTER_TABLE, self.get_add_partitions_query(curS3Bucket, curS3Prefix))
+
+    """
+    Returns the Glue Data Catalog table, or None if the database or the table don't exist.
+    """
+    def get_table_metadata(self):
+        try:
+            return glueclient.get_table(DatabaseName=self.dbname, Name=self.tablename)['Table']
+        except botocore.exceptions.ClientError as bce:
+            if bce.response['Error']['Code'] == 'EntityNotFoundException': return None
+            raise
+
+    def has_billing_period_partition(self):
+        response = glueclient.get_partitions(DatabaseName=self.dbname, TableName=self.tablename, MaxResults=1,
+                                             Expression="{}='{}'".format(consts.BILLING_PERIOD_PARTITION_COLUMN, self.billingPeriod))
+        return len(response.get('Partitions',[])) > 0
+
+    """
+    Parquet files are read by column name: columns that are new in this period are added to the table, and columns that are missing
+    from this period are read as null.
+    """
+    def align_table_columns(self, table, columns):
+        descriptor = table.get('StorageDescriptor', {})
+        if 'parquet' not in descriptor.get('InputFormat','').lower():
+            raise errors.ValidationError("Table [{}.{}] doesn't have [{}] files. Drop the table so it's created again".format(
+                                            self.dbname, self.tablename, consts.STORAGE_FORMAT_PARQUET))
+        existing = [c['Name'].lower() for c in descriptor.get('Columns',[])]
+        newColumns = [c for c in columns if c['name'].lower() not in existing]
+        if not newColumns: return None
+        log.info("Adding columns {} to table [{}.{}]".format([c['name'] for c in newColumns], self.dbname, self.tablename))
+        querystring = "ALTER TABLE {}.{} ADD COLUMNS ({})".format(self.dbname, self.tablename, ", ".join(["`{}` {}".format(c['name'], c['type']) for c in newColumns]))
+        return self.execute_query(consts.QUERY_ID_ALTER_TABLE, querystring)
+
+    """
+    Partitions for the billing period: one for the period folder or, when files are partitioned by usage date, one for each day.
+    """
+    def get_add_partitions_query(self, curS3Bucket, curS3Prefix):
+        querystring = "ALTER TABLE {}.{} ADD IF NOT EXISTS".format(self.dbname, self.tablename)
+        if not self.partitionByUsageDate:
+            return querystring + "\nPARTITION (`{}` = '{}') LOCATION 's3://{}/{}'".format(consts.BILLING_PERIOD_PARTITION_COLUMN, self.billingPeriod, curS3Bucket, curS3Prefix)
+        for usageDate in self.get_usage_date_partitions():
+            querystring += "\nPARTITION (`{}` = '{}', `{}` = '{}') LOCATION 's3://{}/{}{}={}/'".format(consts.BILLING_PERIOD_PARTITION_COLUMN, self.billingPeriod,
+                                consts.USAGE_DATE_PARTITION_COLUMN, usageDate, curS3Bucket, curS3Prefix, consts.USAGE_DATE_PARTITION_COLUMN, usageDate)
+        return querystring
+
+    """
+    Every day in the billing period, and the partition for line items outside of it (see processor.get_usage_date_partition).
+    """
+    def get_usage_date_partitions(self):
+        result = []
+        day = datetime.datetime.strptime(self.periodDates[0], consts.USAGE_DATE_FORMAT)
+        while day.strftime(consts.USAGE_DATE_FORMAT) <= self.periodDates[1]:
+            result.append(day.strftime(consts.USAGE_DATE_FORMAT))
+            day += datetime.timedelta(days=1)
+        result.append(consts.USAGE_DATE_OUT_OF_PERIOD)
         return result
 
+    """
+    The account table is located in the account's folder (<destPrefix><accountId>/), the parent of all period folders.
+    """
+    def get_table_s3_prefix(self, curS3Prefix):
+        periodPrefix = self.billingPeriod + "/"
+        if self.tableLayout == consts.ATHENA_TABLE_LAYOUT_ACCOUNT and curS3Prefix.endswith(periodPrefix):
+            return curS3Prefix[:-len(periodPrefix)]
+        return curS3Prefix
+
     def drop_table(self):
         querystring = "DROP TABLE {}.{}".format(self.dbname, self.tablename)
         return self.execute_query(consts.QUERY_ID_DROP_TABLE, querystring)
 
-    def create_table(self, curManifest, curS3Bucket, curS3Prefix):
-        return self.execute_query(consts.QUERY_ID_CREATE_TABLE, self.get_create_table_query(curManifest, curS3Bucket, curS3Prefix))
+    def create_table(self, curManifest, curS3Bucket, curS3Prefix, storageFormat=consts.STORAGE_FORMAT_TEXTFILE):
+        return self.execute_query(consts.QUERY_ID_CREATE_TABLE, self.get_create_table_query(curManifest, curS3Bucket, curS3Prefix, storageFormat))
 
-    def get_create_table_query(self, curManifest, curS3Bucket, curS3Prefix):
+    def get_create_table_query(self, curManifest, curS3Bucket, curS3Prefix, storageFormat=consts.STORAGE_FORMAT_TEXTFILE):
         querystring = "CREATE EXTERNAL TABLE IF NOT EXISTS {}.{} (\n".format(self.dbname, self.tablename)
         i = 0
-        for c in curManifest.get('columns',[]):
+        for c in schema.CurSchema(curManifest.get('columns',[]), self.typedSchema).columns:
             if i: querystring += ",\n"
-            column_type = 'string'
-            #if c['name'].lower() in ('billingperiodstartdate','billingperiodenddate','usagestartdate','usageenddate'):
-            #    column_type = 'timestamp'
-            category = c['category']
-            name = c['name']
-            category, name = self.quote_uppercase(category, name)
-            querystring += "`{}_{}` {}".format(category,name.replace(':','_'),column_type)
+            querystring += "`{}` {}".format(c['name'],c['type'])
             i += 1
-        querystring += " )\n" \
-                        " ROW FORMAT SERDE 'org.apache.hadoop.hive.serde2.OpenCSVSerde' \n" \
+        querystring += " )\n"
+        tblproperties = []
+        if self.tableLayout == consts.ATHENA_TABLE_LAYOUT_ACCOUNT:
+            #partitions are added for each period, see prepare_account_table
+            partitions = [consts.BILLING_PERIOD_PARTITION_COLUMN]
+            if self.partitionByUsageDate: partitions.append(consts.USAGE_DATE_PARTITION_COLUMN)
+            querystring += "PARTITIONED BY ({})\n".format(", ".join(["`{}` string".format(p) for p in partitions]))
+            curS3Prefix = self.get_table_s3_prefix(curS3Prefix)
+        elif self.partitionByUsageDate:
+            querystring += "PARTITIONED BY (`{}` string)\n".format(consts.USAGE_DATE_PARTITION_COLUMN)
+            tblproperties.extend(self.get_partition_projection_properties(curS3Bucket, curS3Prefix))
+        if storageFormat == consts.STORAGE_FORMAT_PARQUET:
+            #Parquet files are read by column name, so only the columns used in a query are scanned
+            tblproperties.append("'parquet.compression'='SNAPPY'")
+            querystring += "STORED AS PARQUET \n" \
+                           "LOCATION 's3://{}/{}' \n".format(curS3Bucket,curS3Prefix)
+        else:
+            querystring += " ROW FORMAT SERDE 'org.apache.hadoop.hive.serde2.OpenCSVSerde' \n" \
                             "WITH SERDEPROPERTIES ( \n" \
-                            "'separatorChar' = ',', \n" \
-                            "'quoteChar' = '\\\"', \n" \
-                            "'escapeChar' = '\\\\' \n" \
-                        ") \n" \
-                        "STORED AS TEXTFILE \n" \
-                        "LOCATION 's3://{}/{}';".format(curS3Bucket,curS3Prefix)
-        return querystring
+                                "'separatorChar' = ',', \n" \
+                                "'quoteChar' = '\\\"', \n" \
+                                "'escapeChar' = '\\\\' \n" \
+                            ") \n" \
+                            "STORED AS TEXTFILE \n" \
+                            "LOCATION 's3://{}/{}' \n".format(curS3Bucket,curS3Prefix)
+        if tblproperties:
+            querystring += "TBLPROPERTIES ({})".format(", ".join(tblproperties))
+        return querystring.rstrip()+";"
 
     """
-    Athena doesn't accept upper case fields. However, user-defined resource tags are case sensitive and they're included in
-    the CUR manifest as such. There are situations where users define the same tag with different letter case (e.g. MyTag, mytag):
-    Without making a distinction, the code would instruct Athena to create duplicate field names. For example,
-    if the customer has two tags, 'MyTag' and 'mytag', resourcetags_user_MyTag would turn into resourcetags_user_mytag,
-    creating a duplicate field name with resourcetags_user_mytag.
+    Usage date partitions are resolved with partition projection, which means there's no need to load partitions
+    (MSCK REPAIR TABLE or ALTER TABLE ADD PARTITION) after files are processed. The values are every day in the billing period
+    and the out_of_period partition, which is why it's an enum projection and not a date range.
+    """
+    def get_partition_projection_properties(self, curS3Bucket, curS3Prefix):
+        column = consts.USAGE_DATE_PARTITION_COLUMN
+        return ["'projection.enabled'='true'",
+                "'projection.{}.type'='enum'".format(column),
+                "'projection.{}.values'='{}'".format(column, ",".join(self.get_usage_date_partitions())),
+                "'storage.location.template'='s3://{}/{}{}=${{{}}}/'".format(curS3Bucket, curS3Prefix, column, column)]
+
+    """
+    Athena doesn't accept upper case fields, see utils.quote_uppercase for details.
     """
     def quote_uppercase(self, category, name):
-        newname = ""
-        if category.lower() == "resourcetags" and name.find("user:")==0:
-            for n in name:
-                log.info("Evaluating: {}".format(n))
-                if n.isupper(): n = "__upper__" + n
-                newname += n
-        else: newname = name
-        return category.lower(), newname.lower()
+        return utils.quote_uppercase(category, name)
 
 
 
@@ -216,18 +536,20 @@ class AthenaQueryMgr():
         querystring = "SHOW DATABASES"
         queryexecutionid, querystate = self.execute_query('show_databases', querystring)
         if querystate == consts.ATHENA_QUERY_STATE_SUCCEEDED:
-            queryresults = athenaclient.get_query_results(QueryExecutionId=queryexecutionid)#TODO:paginate
-            for r in queryresults['ResultSet']['Rows']:
-                result.append(r['Data'][0]['VarCharValue'])
+            for r in self.iter_query_execution_results(queryexecutionid, mode=RESULT_MODE_TUPLE, skipHeader=False):
+                result.append(r[0])
         return result
 
 
     """
     SQL statements in the config file have placeholders for parameters such as dbname and table.
-    This function replaces those placeholders with real values.
+    This function replaces those placeholders with real values. For typed tables, casts to double are removed from the statement.
+    Optional startDate and endDate parameters (YYYY-MM-DD, inclusive) limit the usage dates a query reads, see get_usage_date_filter.
     """
-    def replace_params(self, sqlstatement, **kargs):
+    def replace_params(self, sqlstatement, startDate='', endDate='', **kargs):
         result = sqlstatement.replace("{dbname}", self.dbname).replace("{tablename}", self.tablename)
+        result = result.replace("{usage_date_filter}", self.get_usage_date_filter(startDate, endDate))
+        if self.typedSchema: result = schema.remove_casts(result)
         if kargs:
             for k in kargs.keys():
                 placeholder = '{'+k+'}'
@@ -237,26 +559,51 @@ class AthenaQueryMgr():
 
 
     """
-    Query metadata is used to find a valid previous execution of a query type and avoid
-    querying Athena every time a customer requests data that has already been queried using
-    the most recent Cost and Usage report.
+    Returns the SQL condition for a usage date range. For partitioned tables the condition is on the partition column,
+    so Athena only reads the files for those days (and the out_of_period partition if needed). Otherwise the condition is evaluated on lineitem_usagestartdate,
+    which returns the same results but scans the whole month.
+    With the account table layout, the condition always includes the billing period partition.
     """
+    def get_usage_date_filter(self, startDate='', endDate=''):
+        result = "true"
+        if startDate or endDate:
+            startDate = validate_usage_date(startDate or self.periodDates[0])
+            endDate = validate_usage_date(endDate or self.periodDates[1])
+            if startDate > endDate:
+                raise errors.ValidationError("startDate [{}] can't be after endDate [{}]".format(startDate, endDate))
+            usageDateColumn = "substr(cast(lineitem_usagestartdate AS varchar),1,10)"
+            if not self.partitionByUsageDate:
+                result = "{} BETWEEN '{}' AND '{}'".format(usageDateColumn, startDate, endDate)
+            else:
+                result = "{} BETWEEN '{}' AND '{}'".format(consts.USAGE_DATE_PARTITION_COLUMN, startDate, endDate)
+                #line items outside the billing period are in their own partition, it's only read when the range goes beyond the period
+                if startDate < self.periodDates[0] or endDate > self.periodDates[1]:
+                    result = "({} OR ({} = '{}' AND {} BETWEEN '{}' AND '{}'))".format(result, consts.USAGE_DATE_PARTITION_COLUMN, consts.USAGE_DATE_OUT_OF_PERIOD,
+                                                                                     usageDateColumn, startDate, endDate)
+        if self.tableLayout == consts.ATHENA_TABLE_LAYOUT_ACCOUNT:
+            periodFilter = "{} = '{}'".format(consts.BILLING_PERIOD_PARTITION_COLUMN, self.billingPeriod)
+            result = periodFilter if result == "true" else "{} AND {}".format(periodFilter, result)
+        return result
 
-    def create_query_metadata(self, queryid, queryexecutionid):
-        #create queryid metadata and upload to S3
-        bucket = self.get_athena_query_output_s3_bucket()
-        key = self.get_athena_query_output_s3_key(bucket, queryid)
-        log.info("query metadata s3 location - bucket: [{}] key:[{}]".format(bucket, key))
-        querymetadata = s3resource.Object(bucket,key)
 
-        response = athenaclient.get_query_execution(QueryExecutionId=queryexecutionid)
+    """
+    Query metadata is used to find a valid previous execution of a query type and avoid
+    querying Athena every time a customer requests data that has already been queried using
+    the most recent Cost and Usage report. Returns the fingerprint and the metadata, or None if the account has no data version.
+    """
 
+    def create_query_metadata(self, queryid, queryexecutionid, querystring):
+        dataVersion = self.get_data_version()
+        if not dataVersion: return None
         metadatabody = {
+            "queryId":queryid,
             "queryExecutionId":queryexecutionid,
-            "queryExecutionTimestamp":datetime.datetime.now(pytz.utc).strftime(consts.TIMESTAMP_FORMAT)
+            "queryExecutionTimestamp":datetime.datetime.now(pytz.utc).strftime(consts.TIMESTAMP_FORMAT),
+            "dataVersion":dataVersion
         }
-
-        querymetadata.put(Body=json.dumps(metadatabody, indent=4), StorageClass='REDUCED_REDUNDANCY')
+        fingerprint = get_query_fingerprint(querystring, dataVersion)
+        self.put_query_metadata(fingerprint, metadatabody)
+        return fingerprint, metadatabody
 
 
     def get_athena_query_output_s3_bucket(self):
@@ -266,3 +613,100 @@ class AthenaQueryMgr():
         return self.athena_output_s3_location.split(bucket)[1][1:]+QUERY_METADATA_FOLDER+"/"+queryid+".json"
 
 
+"""
+Columns change between periods and CSV files are read by position, so the account layout (one table for all periods) needs Parquet files.
+"""
+def validate_table_layout(tableLayout, storageFormat):
+    if tableLayout == consts.ATHENA_TABLE_LAYOUT_ACCOUNT and storageFormat != consts.STORAGE_FORMAT_PARQUET:
+        raise errors.ValidationError("The [{}] table layout needs [{}] files, got [{}]. Prepare Parquet files or use the [{}] table layout".format(
+                                        tableLayout, consts.STORAGE_FORMAT_PARQUET, storageFormat, consts.ATHENA_TABLE_LAYOUT_MONTHLY))
+
+
+"""
+Dates are added to SQL statements, so they must be valid YYYY-MM-DD values
+"""
+def validate_usage_date(value):
+    try:
+        if datetime.datetime.strptime(value, consts.USAGE_DATE_FORMAT).strftime(consts.USAGE_DATE_FORMAT) == value: return value
+    except (ValueError, TypeError):
+        pass
+    raise errors.ValidationError("Invalid date [{}], expected format is YYYY-MM-DD".format(value))
+
+
+"""
+Intervals (in seconds) between query state checks: exponential backoff with equal jitter, up to POLL_MAX_INTERVAL_MS.
+"""
+def get_poll_intervals(initialMs=POLL_INITIAL_INTERVAL_MS, maxMs=POLL_MAX_INTERVAL_MS):
+    intervalMs = initialMs
+    while True:
+        yield (intervalMs/2.0 + random.uniform(0, intervalMs/2.0))/1000
+        intervalMs = min(intervalMs * POLL_BACKOFF_MULTIPLIER, maxMs)
+
+
+"""
+Athena returns every value as a string (VarCharValue), together with the type of each column. Returns a function that converts
+values of an Athena type to the matching Python type; unknown types (and '') are returned as strings.
+"""
+def get_result_converter(athenaType):
+    athenaType = athenaType.lower()
+    if athenaType in ('double', 'float', 'real'): convert = float
+    elif athenaType in ('bigint', 'integer', 'int', 'smallint', 'tinyint'): convert = int
+    elif athenaType == 'decimal': convert = decimal.Decimal
+    elif athenaType == 'boolean': convert = lambda v: v.lower() == 'true'
+    else: return lambda v: v
+    return lambda v: None if v is None or v == '' else convert_result_value(convert, v)
+
+
+def get_result_converters(columninfo, count, typed):
+    converters = [get_result_converter(c.get('Type','') if typed else '') for c in columninfo]
+    if len(converters) != count: converters = [get_result_converter('')] * count
+    return converters
+
+
+def convert_result_value(convert, value):
+    try:
+        return convert(value)
+    except (ValueError, decimal.InvalidOperation):
+        return value
+
+
+"""
+Query executions are reused when the same SQL statement runs on the same data. Statements are normalized first (whitespace and
+the trailing semicolon), so formatting differences in queries.properties don't change the fingerprint.
+"""
+def get_query_fingerprint(querystring, dataVersion):
+    canonical = " ".join(querystring.split()).rstrip(';').strip()
+    return hashlib.sha256(u"{}\n{}".format(canonical, dataVersion).encode('utf-8')).hexdigest()
+
+
+"""
+Returns a cached value, or calls load() if it's not cached or it expired (see ATHENA_METADATA_CACHE_TTL_SECONDS).
+Loaded values are only cached if cacheable(value) is true. Expired entries are removed whenever a new value is cached.
+"""
+def get_cached_metadata(cacheKey, load, cacheable=None):
+    now = time.time()
+    with _metadataCacheLock:
+        entry = _metadataCache.get(cacheKey)
+        if entry and entry[0] > now: return entry[1]
+    value = load()
+    if consts.ATHENA_METADATA_CACHE_TTL_SECONDS > 0 and (cacheable is None or cacheable(value)):
+        with _metadataCacheLock:
+            for k in [k for k, e in _metadataCache.items() if e[0] <= now]: del _metadataCache[k]
+            _metadataCache[cacheKey] = (now + consts.ATHENA_METADATA_CACHE_TTL_SECONDS, value)
+    return value
+
+
+"""
+Query metadata doesn't change once the execution succeeded and its statistics were stored, so only those entries are cached.
+Missing entries and executions that are still running (or failed) are always read from S3.
+"""
+def is_query_metadata_complete(metadatabody):
+    return metadatabody.get('state') == consts.ATHENA_QUERY_STATE_SUCCEEDED and 'resultRows' in metadatabody
+
+
+def read_json_object(bucket, key):
+    try:
+        return json.loads(s3resource.Object(bucket,key).get()['Body'].read())
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] not in ('NoSuchKey', '404'): raise
+        return {}
@@ -1,5 +1,7 @@
 #!/usr/bin/python
 import re
+import calendar
+import consts
 
 def is_valid_prefix(prefix):
     result = True
@@ -26,6 +28,15 @@ def get_period_prefix(year, month):
   return "{}{:02d}01-{}{:02d}01/".format(year,month,nextYear,nextMonth)
 
 
+"""
+Returns the first and last day of a billing period, in YYYY-MM-DD format (i.e. 2017-06-01, 2017-06-30)
+"""
+def get_period_dates(year, month):
+  year = int(year)
+  month = int(month)
+  return "{}-{:02d}-01".format(year, month), "{}-{:02d}-{:02d}".format(year, month, calendar.monthrange(year, month)[1])
+
+
 """
 This method extracts the year and month of a Cost and Usage report,
 as well as the prefix, based on the S3 key of the report.
@@ -57,6 +68,43 @@ def extract_period(s3key):
     return prefix, year, month
 
 
+"""
+Athena doesn't accept upper case fields. However, user-defined resource tags are case sensitive and they're included in
+the CUR manifest as such. There are situations where users define the same tag with different letter case (e.g. MyTag, mytag):
+Without making a distinction, the code would instruct Athena to create duplicate field names. For example,
+if the customer has two tags, 'MyTag' and 'mytag', resourcetags_user_MyTag would turn into resourcetags_user_mytag,
+creating a duplicate field name with resourcetags_user_mytag.
+"""
+def quote_uppercase(category, name):
+    newname = ""
+    if category.lower() == "resourcetags" and name.find("user:")==0:
+        for n in name:
+            if n.isupper(): n = "__upper__" + n
+            newname += n
+    else: newname = name
+    return category.lower(), newname.lower()
 
 
+"""
+Returns the name of the Athena column for a column in the CUR manifest (i.e. lineItem/UnblendedCost -> lineitem_unblendedcost).
+The same names are used in Athena tables and in Parquet files, so both always match.
+"""
+def get_column_name(category, name):
+    category, name = quote_uppercase(category, name)
+    return "{}_{}".format(category, name.replace(':','_'))
+
+
+"""
+Folders for the processor's own state (processing ledger, rollups, stored result sets), which is kept next to the Athena files
+of an account but must never be read as table data.
+"""
+def get_hidden_folder(name):
+    return consts.ATHENA_HIDDEN_PREFIX + name
+
 
+"""
+Athena files are stored as compressed CSV (TEXTFILE) or as Parquet, depending on the action that prepared them.
+"""
+def get_storage_format(action):
+    if action == consts.ACTION_PREPARE_ATHENA_PARQUET: return consts.STORAGE_FORMAT_PARQUET
+    return consts.STORAGE_FORMAT_TEXTFILE
@@ -36,18 +36,13 @@ def handler(event, context):
     if 'roleArn' in event: event['roleArn'] = ''
 
     try:
+        #typedSchema, partitionByUsageDate and tableLayout come from the environment, same as in process-cur and the API functions
         athena = ath.AthenaQueryMgr(consts.ATHENA_BASE_OUTPUT_S3_BUCKET, accountid, year, month)
 
-        #construct database name based on input parameters: costusage-accountid
-        athena.create_database()
-
-        #drop table for the current month - 20170601-20170701
-        athena.drop_table()
-
-        #TODO: use columnar format, for better performance
-        #create new table for the current month
+        #database costusage_<accountid>, with a table for the current month (i.e. 20170601-20170701) or a table for the account
+        #with a partition for the current month, using the format of the files prepared by process-cur (CSV or Parquet)
         curS3Prefix = consts.CUR_PROCESSOR_DEST_S3_PREFIX + accountid + "/" + utils.get_period_prefix(year, month)#TODO: move to a method in athena module, so it can be reused
-        athena.create_table(curManifest, curS3Bucket, curS3Prefix)
+        athena.create_resources(curManifest, curS3Bucket, curS3Prefix, utils.get_storage_format(event.get('action', consts.ACTION_PREPARE_ATHENA)))
 
     except AthenaExecutionFailedException as ae:
         log.error(ae.message)
@@ -7,6 +7,7 @@ site_pkgs = os.path.join(os.path.split(__location__)[0], "lib", "python2.7", "si
 sys.path.append(site_pkgs)
 
 import awscostusageprocessor.api as curapi
+import awscostusageprocessor.consts as consts
 
 log = logging.getLogger()
 log.setLevel(logging.INFO)
@@ -15,6 +16,9 @@ log.setLevel(logging.INFO)
 This function initializes common queries, so the results are available in S3.
 The API implementation will search first in S3 before making calls to the Athena API. This will
 increase performance and reduce cost.
+Queries that can be answered by the rollups calculated when the report was processed (see rollups.py) don't run in Athena.
+Result sets are stored as compressed JSON documents for the report that was just processed (see resultstore.py), so the API
+serves dashboards with a single S3 GET.
 """
 
 def handler(event, context):
@@ -31,11 +35,18 @@ def handler(event, context):
     result_dict = {'getTotalCost':resultset, 'getHourlyCost':resultset, 'getCostByService':resultset, 'getCostByUsageType':resultset,
                    'getCostByResource':resultset, 'getUsageByResourceId':resultset}
 
-    result_dict['getCostByService']['resultset'] = apiprocessor.getCostByService()
-    result_dict['getCostByUsageType']['resultset'] = apiprocessor.getCostByUsageType()
-    result_dict['getCostByResource']['resultset'] = apiprocessor.getCostByResource()
-    result_dict['getTotalCost']['resultset'] = apiprocessor.getTotalCost()
-    result_dict['getHourlyCost']['resultset'] = apiprocessor.getHourlyCost()
+    #queries run in Athena at the same time
+    resultsets = apiprocessor.getResultSets([consts.ACTION_GET_COST_BY_SERVICE, consts.ACTION_GET_COST_BY_USAGE_TYPE, consts.ACTION_GET_COST_BY_RESOURCE,
+                                             consts.ACTION_GET_TOTAL_COST, consts.ACTION_GET_HOURLY_COST])
+    result_dict['getCostByService']['resultset'] = resultsets[consts.ACTION_GET_COST_BY_SERVICE]
+    result_dict['getCostByUsageType']['resultset'] = resultsets[consts.ACTION_GET_COST_BY_USAGE_TYPE]
+    result_dict['getCostByResource']['resultset'] = resultsets[consts.ACTION_GET_COST_BY_RESOURCE]
+    result_dict['getTotalCost']['resultset'] = resultsets[consts.ACTION_GET_TOTAL_COST]
+    result_dict['getHourlyCost']['resultset'] = resultsets[consts.ACTION_GET_HOURLY_COST]
+    apiprocessor.putResultSets(resultsets)
+
+    #metadata of query executions for previous reports can't be reused anymore
+    apiprocessor.athena.prune_query_metadata()
 
     #log.info("Results:{}".format(json.dumps(result_dict,indent=4)))
 
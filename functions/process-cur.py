@@ -8,6 +8,8 @@ sys.path.append(site_pkgs)
 
 import awscostusageprocessor.processor as cur
 import awscostusageprocessor.consts as consts
+import awscostusageprocessor.utils as utils
+import awscostusageprocessor.sql.athena as athena
 
 
 
@@ -15,6 +17,9 @@ log = logging.getLogger()
 log.setLevel(logging.INFO)
 ddbclient = boto3.client('dynamodb')
 
+#The API functions build their queries from the same settings, which they read from the environment (see consts.py)
+TABLE_SETTINGS = ['typedSchema', 'partitionByUsageDate', 'tableLayout']
+
 """
 This function starts the process that copies and prepares incoming AWS Cost and Usage reports.
 """
@@ -23,10 +28,21 @@ def handler(event, context):
 
     log.info("Received event {}".format(json.dumps(event)))
 
+    #This function only supports processing files for Athena (for now), either as CSV (default) or Parquet.
+    action = event.get('action', consts.ACTION_PREPARE_ATHENA)
+    if action not in consts.ATHENA_ACTIONS:
+        raise Exception("Invalid action [{}], valid options are: {}".format(action, consts.ATHENA_ACTIONS))
+    event['action'] = action
+    overrides = [s for s in TABLE_SETTINGS if s in event]
+    if overrides:
+        raise Exception("Settings {} can't be set per event, the API functions would query the table with different ones".format(overrides))
+    #fail before processing any files if create-athena-resources can't create the table
+    athena.validate_table_layout(consts.ATHENA_TABLE_LAYOUT, utils.get_storage_format(action))
+
     curprocessor = cur.CostUsageProcessor(**event)
-    #This function only supports processing files for Athena (for now).
-    curprocessor.process_latest_aws_cur(consts.ACTION_PREPARE_ATHENA)
-    event.update({'curManifest':curprocessor.curManifestJson})
+    curprocessor.process_latest_aws_cur(action)
+    #the Athena table is created using the columns in the processed files
+    event.update({'curManifest':curprocessor.outputManifestJson, 'curManifestKey':curprocessor.latest_manifest_key})
     if not event.get('accountId',''): event['accountId']=curprocessor.accountId
     log.info("CurKeyCount {}".format(len(curprocessor.curManifestJson.get('reportKeys',[]))))
     log.info("Return object:[{}]".format(event))
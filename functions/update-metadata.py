@@ -31,14 +31,19 @@ def handler(event, context):
     log.info("Received event {}".format(json.dumps(event)))
     accountid = event['accountId']
 
+    attributeUpdates = {
+                           'lastProcessedTimestamp':{'Value': {'S': event['startTimestamp']}},
+                           'status':{'Value': {'S': consts.CUR_PROCESSOR_STATUS_OK}},
+                           'statusDetails':{'Value': {'S': consts.CUR_PROCESSOR_STATUS_DETAILS_NA}},
+                           'lastUpdateTimestamp':{'Value': {'S': datetime.datetime.now(pytz.utc).strftime(consts.TIMESTAMP_FORMAT)}}
+                       }
+    #The Step Function starter checks if this manifest changed with a single conditional request, instead of looking for it
+    if event.get('curManifestKey',''):
+        attributeUpdates['curManifestKey'] = {'Value': {'S': event['curManifestKey']}}
+
     ddbresponse = ddbclient.update_item(TableName=consts.AWS_ACCOUNT_METADATA_DDB_TABLE,
                                 Key = {'awsPayerAccountId': {'S': accountid}},
-                                AttributeUpdates={
-                                    'lastProcessedTimestamp':{'Value': {'S': event['startTimestamp']}},
-                                    'status':{'Value': {'S': consts.CUR_PROCESSOR_STATUS_OK}},
-                                    'statusDetails':{'Value': {'S': consts.CUR_PROCESSOR_STATUS_DETAILS_NA}},
-                                    'lastUpdateTimestamp':{'Value': {'S': datetime.datetime.now(pytz.utc).strftime(consts.TIMESTAMP_FORMAT)}}
-                                },
+                                AttributeUpdates=attributeUpdates,
                                 ReturnConsumedCapacity='TOTAL'
                             )
 
@@ -4,13 +4,16 @@ __location__ = os.path.dirname(os.path.realpath(__file__))
 site_pkgs = os.path.join(os.path.split(__location__)[0], "lib", "python2.7", "site-packages")
 sys.path.append(site_pkgs)
 
-import logging, json, time, datetime, hashlib, pytz
+import logging, json, time, datetime, hashlib, pytz, threading
+import _strptime #datetime.strptime is not thread-safe until _strptime is imported (Python bug 7980)
+from multiprocessing.pool import ThreadPool
 import boto3
 from botocore.exceptions import ClientError as BotoClientError
 
 import awscostusageprocessor.utils as utils
 import awscostusageprocessor.processor as cur
 import awscostusageprocessor.consts as consts
+import awscostusageprocessor.clients as clients
 from awscostusageprocessor.errors import ManifestNotFoundError, CurBucketNotFoundError
 
 log = logging.getLogger()
@@ -19,7 +22,6 @@ log.setLevel(logging.INFO)
 sfnclient = boto3.client('stepfunctions')
 snsclient= boto3.client('sns')
 ddbresource = boto3.resource('dynamodb')
-ddbclient = boto3.client('dynamodb')
 
 
 """
@@ -30,6 +32,10 @@ This function receives a scheduled event and it searches for new Cost and Usage
 """
 
 
+HANDLER_TIMEOUT_MARGIN_SECONDS = 10 #time reserved to write errors and send the SNS notification before the function times out
+POLL_INTERVAL_SECONDS = 0.1
+
+
 def handler(event, context):
 
     log.info("Received event {}".format(json.dumps(event, indent=4)))
@@ -41,106 +47,19 @@ def handler(event, context):
     log.info("Looking for AwsAccountMetadata items processed before [{}] in table [{}]".format(lastProcessedIncludeTs, consts.AWS_ACCOUNT_METADATA_DDB_TABLE))
 
     metadatatable = ddbresource.Table(consts.AWS_ACCOUNT_METADATA_DDB_TABLE)
-    response = metadatatable.scan(
-            Select='ALL_ATTRIBUTES',
-            FilterExpression=boto3.dynamodb.conditions.Attr('lastProcessedTimestamp').lt(lastProcessedIncludeTs) &
-                             boto3.dynamodb.conditions.Attr('dataCollectionStatus').eq(consts.DATA_COLLECTION_STATUS_ACTIVE),
-            ReturnConsumedCapacity='TOTAL'
-    )
-    log.info(json.dumps(response, indent=4))
-
-    sfn_executionlinks = ""
-    execnames = []
-
-    #Get metadata for each of those accounts and prepare args for CostUsageProcessor
-    for item in response['Items']:
-
-        #Prepare args for CostUsageProcessor
-        kwargs = {}
-        now = datetime.datetime.now(pytz.utc)
-        kwargs['startTimestamp'] = now.strftime(consts.TIMESTAMP_FORMAT)
-        year = now.strftime("%Y")
-        month = now.strftime("%m")
-        kwargs['year'] = year
-        kwargs['month'] = month
-        kwargs['sourceBucket'] = item['curBucket']
-        kwargs['sourcePrefix'] = "{}{}/".format(item['curPrefix'],item['curName']) #TODO: move to a common function
-        kwargs['destBucket'] = consts.CUR_PROCESSOR_DEST_S3_BUCKET
-        kwargs['destPrefix']= consts.CUR_PROCESSOR_DEST_S3_PREFIX
-        kwargs['accountId'] = item['awsPayerAccountId']
-        kwargs['xAccountSource']=True
-        kwargs['roleArn'] = item['roleArn']
-
-        #See how old is the latest CUR manifest in S3 and compare it against the lastProcessedTimestamp in the AWSAccountMetadata DDB table
-        #If the CUR manifest is newer, then start processing
-        try:
-            log.info("Starting new CUR evaluation for account [{}]".format(kwargs['accountId']))
-            lastProcessedTs = datetime.datetime.strptime(item.get('lastProcessedTimestamp',consts.EPOCH_TS), consts.TIMESTAMP_FORMAT).replace(tzinfo=pytz.utc)
-            minutesSinceLastCurProcessed = int((now - lastProcessedTs).total_seconds() / 60)
-            log.info("minutesSinceLastCurProcessed [{}] - lastProcessedTimestamp [{}]".format(minutesSinceLastCurProcessed, item.get('lastProcessedTimestamp',consts.EPOCH_TS)))
-            curprocessorStatus = consts.CUR_PROCESSOR_STATUS_OK
-            curprocessorStatusDetails = '-'
-
-            curprocessor = cur.CostUsageProcessor(**kwargs)
-            cur_manifest_lastmodified_ts = curprocessor.aws_manifest_lastmodified_ts
-
-            log.info("Found manifest for awsAccountId:[{}] - cur_manifest_lastmodified_ts:[{}] - lastProcessedTimestamp:[{}]".format(curprocessor.accountId, cur_manifest_lastmodified_ts, item['lastProcessedTimestamp']))
-            if cur_manifest_lastmodified_ts > lastProcessedTs:
-                #Start execution
-                period = utils.get_period_prefix(year,month).replace('/','')
-                execname = "{}-{}-{}".format(curprocessor.accountId, period, hashlib.md5(str(time.time()).encode("utf-8")).hexdigest()[:8])
-                sfnresponse = sfnclient.start_execution(stateMachineArn=consts.STEP_FUNCTION_PREPARE_CUR_ATHENA,
-                                                     name=execname,
-                                                     input=json.dumps(kwargs))
-
-                #Prepare SNS notification
-                sfn_executionarn = sfnresponse['executionArn']
-                sfn_executionlink = "https://console.aws.amazon.com/states/home?region={}#/executions/details/{}\n".format(consts.AWS_DEFAULT_REGION, sfn_executionarn)
-                sfn_executionlinks += sfn_executionlink
-                execnames.append(execname)
-                log.info("Started execution - executionArn: {}".format(sfn_executionarn))
-
-        except CurBucketNotFoundError as e:
-            log.error("CurBucketNotFoundError [{}]".format(e.message))
-            curprocessorStatus = consts.CUR_PROCESSOR_STATUS_ERROR
-            curprocessorStatusDetails = e.message
-
-        except ManifestNotFoundError as e:
-            log.error("ManifestNotFoundError [{}]".format(e.message))
-            curprocessorStatus = consts.CUR_PROCESSOR_STATUS_ERROR
-            curprocessorStatusDetails = e.message
-
-        except BotoClientError as be:
-            errorType = ''
-            if be.response['Error']['Code'] == 'AccessDenied':
-                errorType = 'BotoAccessDenied'
-            else:
-                errorType = 'BotoClientError_'+be.response['Error']['Code']
-            log.error("{} awsPayerAccountId [{}] roleArn [{}] [{}]".format(errorType, kwargs['accountId'], kwargs['roleArn'], be.message))
-            curprocessorStatus = consts.CUR_PROCESSOR_STATUS_ERROR
-            curprocessorStatusDetails = errorType
-
-        except Exception as e:
-            log.error("xAcctStepFunctionStarterException awsPayerAccountId [{}] roleArn [{}] [{}]".format(kwargs['accountId'], kwargs['roleArn'], e))
-            traceback.print_exc()
-            curprocessorStatus = consts.CUR_PROCESSOR_STATUS_ERROR
-            curprocessorStatusDetails = e.message
-
-
-        #If there were errors, update Metadata table with details
-        if curprocessorStatus == consts.CUR_PROCESSOR_STATUS_ERROR:
-            log.info("Updating DDB table [{}]".format(consts.AWS_ACCOUNT_METADATA_DDB_TABLE))
-            ddbclient.update_item(TableName=consts.AWS_ACCOUNT_METADATA_DDB_TABLE,
-                Key = {'awsPayerAccountId': {'S': item['awsPayerAccountId']}},
-                AttributeUpdates={
-                    'status':{'Value': {'S': curprocessorStatus}},
-                    'statusDetails':{'Value': {'S': curprocessorStatusDetails}},
-                    'lastUpdateTimestamp':{'Value': {'S': kwargs['startTimestamp']}}
-                }
-            )
+    items = get_ready_accounts(metadatatable, lastProcessedIncludeTs)
+    log.info("Found [{}] accounts ready for CUR evaluation: {}".format(len(items), [i['awsPayerAccountId'] for i in items]))
 
+    results = evaluate_accounts(items, get_handler_deadline(context))
 
+    sfn_executionlinks = "".join([r['executionLink'] for r in results if r['execname']])
+    execnames = [r['execname'] for r in results if r['execname']]
 
+    #If there were errors, update Metadata table with details
+    errors = [r for r in results if r['status'] == consts.CUR_PROCESSOR_STATUS_ERROR]
+    if errors:
+        log.info("Updating [{}] items in DDB table [{}]".format(len(errors), consts.AWS_ACCOUNT_METADATA_DDB_TABLE))
+        update_error_statuses(errors)
 
     if sfn_executionlinks:
         snsclient.publish(TopicArn=consts.SNS_TOPIC,
@@ -150,3 +69,217 @@ def handler(event, context):
     log.info("Started executions: [{}]".format(execnames))
 
     return execnames
+
+
+"""
+Only the status attributes are updated: items were read from an eventually consistent query or scan, and Step Function executions
+that are running can update the same items (i.e. lastProcessedTimestamp, curManifestKey) at the same time.
+Updates are sent in parallel, boto3 clients are thread-safe.
+"""
+def update_error_statuses(results):
+    ddbclient = clients.get_client('dynamodb')
+    def update_status(r):
+        ddbclient.update_item(TableName=consts.AWS_ACCOUNT_METADATA_DDB_TABLE,
+            Key = {'awsPayerAccountId': {'S': r['item']['awsPayerAccountId']}},
+            AttributeUpdates={
+                'status':{'Value': {'S': r['status']}},
+                'statusDetails':{'Value': {'S': r['statusDetails']}},
+                'lastUpdateTimestamp':{'Value': {'S': r['startTimestamp']}}
+            }
+        )
+    pool = ThreadPool(max(1, min(consts.XACCT_STARTER_WORKERS, len(results))))
+    try:
+        pool.map(update_status, results)
+    finally:
+        pool.close()
+
+
+"""
+Returns the active accounts processed before lastProcessedIncludeTs. They're read from the (dataCollectionStatus, lastProcessedTimestamp)
+index when it's configured, which only reads the matching items. Otherwise (or if the index doesn't exist yet) the table is scanned
+in parallel segments. Both follow LastEvaluatedKey, so accounts are not skipped when results don't fit in a single 1 MB page.
+"""
+def get_ready_accounts(metadatatable, lastProcessedIncludeTs):
+    if consts.AWS_ACCOUNT_METADATA_DDB_STATUS_INDEX:
+        try:
+            return query_ready_accounts(metadatatable, lastProcessedIncludeTs)
+        except BotoClientError as be:
+            if be.response['Error']['Code'] not in ('ValidationException', 'ResourceNotFoundException'): raise
+            log.error("Could not query index [{}], scanning table instead [{}]".format(consts.AWS_ACCOUNT_METADATA_DDB_STATUS_INDEX, be.message))
+    return scan_ready_accounts(lastProcessedIncludeTs)
+
+
+def query_ready_accounts(metadatatable, lastProcessedIncludeTs):
+    items = []
+    kwargs = {'IndexName':consts.AWS_ACCOUNT_METADATA_DDB_STATUS_INDEX,
+              'KeyConditionExpression':boto3.dynamodb.conditions.Key('dataCollectionStatus').eq(consts.DATA_COLLECTION_STATUS_ACTIVE) &
+                                       boto3.dynamodb.conditions.Key('lastProcessedTimestamp').lt(lastProcessedIncludeTs),
+              'ReturnConsumedCapacity':'TOTAL'}
+    while True:
+        response = metadatatable.query(**kwargs)
+        items.extend(response.get('Items',[]))
+        log.info("Queried [{}] accounts - ConsumedCapacity [{}]".format(response.get('Count',0), response.get('ConsumedCapacity',{})))
+        if 'LastEvaluatedKey' not in response: break
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    return items
+
+
+def scan_ready_accounts(lastProcessedIncludeTs):
+    segments = max(1, consts.AWS_ACCOUNT_METADATA_DDB_SCAN_SEGMENTS)
+    pool = ThreadPool(segments)
+    try:
+        pages = pool.map(lambda segment: scan_segment(segment, segments, lastProcessedIncludeTs), range(segments))
+    finally:
+        pool.close()
+    return [item for page in pages for item in page]
+
+
+def scan_segment(segment, segments, lastProcessedIncludeTs):
+    #boto3 resources are not thread-safe, each segment uses its own
+    metadatatable = clients.get_resource('dynamodb').Table(consts.AWS_ACCOUNT_METADATA_DDB_TABLE)
+    items = []
+    kwargs = {'Select':'ALL_ATTRIBUTES', 'Segment':segment, 'TotalSegments':segments,
+              'FilterExpression':boto3.dynamodb.conditions.Attr('lastProcessedTimestamp').lt(lastProcessedIncludeTs) &
+                                 boto3.dynamodb.conditions.Attr('dataCollectionStatus').eq(consts.DATA_COLLECTION_STATUS_ACTIVE),
+              'ReturnConsumedCapacity':'TOTAL'}
+    while True:
+        response = metadatatable.scan(**kwargs)
+        items.extend(response.get('Items',[]))
+        if 'LastEvaluatedKey' not in response: break
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    return items
+
+
+"""
+Accounts are evaluated concurrently, by up to XACCT_STARTER_WORKERS threads, so the time it takes to evaluate all of them depends on
+the slowest account and not on the sum of them. Each account has XACCT_STARTER_ACCOUNT_TIMEOUT_SECONDS from the moment its evaluation
+starts; accounts that don't finish in time (or before the function's own deadline) are reported as errors. Their threads can't be
+stopped, but they're flagged as cancelled so they don't start an execution after the account was reported.
+Results are returned in the same order as items.
+"""
+def evaluate_accounts(items, handlerDeadline):
+    if not items: return []
+    pool = ThreadPool(max(1, min(consts.XACCT_STARTER_WORKERS, len(items))))
+    evaluations = []
+    for item in items:
+        evaluation = {'item':item, 'started':None, 'cancelled':threading.Event()}
+        evaluation['async'] = pool.apply_async(evaluate_account, (item, evaluation))
+        evaluations.append(evaluation)
+    pool.close()
+
+    results = [None] * len(evaluations)
+    while True:
+        pending = 0
+        for i, evaluation in enumerate(evaluations):
+            if results[i]: continue
+            if evaluation['async'].ready():
+                results[i] = evaluation['async'].get()
+                continue
+            now = time.time()
+            accountExpired = evaluation['started'] and now > evaluation['started'] + consts.XACCT_STARTER_ACCOUNT_TIMEOUT_SECONDS
+            if accountExpired or now > handlerDeadline:
+                evaluation['cancelled'].set()
+                log.error("Timed out evaluating awsPayerAccountId [{}]".format(evaluation['item']['awsPayerAccountId']))
+                results[i] = get_evaluation_result(evaluation['item'], consts.CUR_PROCESSOR_STATUS_ERROR, consts.CUR_PROCESSOR_STATUS_DETAILS_TIMEOUT)
+                continue
+            pending += 1
+        if not pending: break
+        time.sleep(POLL_INTERVAL_SECONDS)
+
+    if all([e['async'].ready() for e in evaluations]): pool.join()
+    return results
+
+
+"""
+See how old is the latest CUR manifest in S3 and compare it against the lastProcessedTimestamp in the AWSAccountMetadata DDB table.
+If the CUR manifest is newer, then start processing. Errors are returned in the result, not raised.
+"""
+def evaluate_account(item, evaluation):
+    evaluation['started'] = time.time()
+
+    #Prepare args for CostUsageProcessor
+    kwargs = {}
+    now = datetime.datetime.now(pytz.utc)
+    kwargs['startTimestamp'] = now.strftime(consts.TIMESTAMP_FORMAT)
+    year = now.strftime("%Y")
+    month = now.strftime("%m")
+    kwargs['year'] = year
+    kwargs['month'] = month
+    kwargs['sourceBucket'] = item['curBucket']
+    kwargs['sourcePrefix'] = "{}{}/".format(item['curPrefix'],item['curName']) #TODO: move to a common function
+    kwargs['destBucket'] = consts.CUR_PROCESSOR_DEST_S3_BUCKET
+    kwargs['destPrefix']= consts.CUR_PROCESSOR_DEST_S3_PREFIX
+    kwargs['accountId'] = item['awsPayerAccountId']
+    kwargs['xAccountSource']=True
+    kwargs['roleArn'] = item['roleArn']
+
+    result = get_evaluation_result(item, consts.CUR_PROCESSOR_STATUS_OK, '-', kwargs['startTimestamp'])
+    try:
+        log.info("Starting new CUR evaluation for account [{}]".format(kwargs['accountId']))
+        lastProcessedTs = datetime.datetime.strptime(item.get('lastProcessedTimestamp',consts.EPOCH_TS), consts.TIMESTAMP_FORMAT).replace(tzinfo=pytz.utc)
+        minutesSinceLastCurProcessed = int((now - lastProcessedTs).total_seconds() / 60)
+        log.info("minutesSinceLastCurProcessed [{}] - lastProcessedTimestamp [{}]".format(minutesSinceLastCurProcessed, item.get('lastProcessedTimestamp',consts.EPOCH_TS)))
+
+        #Most of the time the manifest didn't change: if its key is known, a conditional request is enough to find out
+        s3sourceclient = clients.get_client('s3', roleArn=kwargs['roleArn'])
+        manifestModified = cur.is_manifest_modified(s3sourceclient, kwargs['sourceBucket'], kwargs['sourcePrefix'], year, month,
+                                                    item.get('curManifestKey',''), lastProcessedTs)
+        if manifestModified is None:
+            curprocessor = cur.CostUsageProcessor(**kwargs)
+            cur_manifest_lastmodified_ts = curprocessor.aws_manifest_lastmodified_ts
+            manifestModified = cur_manifest_lastmodified_ts > lastProcessedTs
+            log.info("Found manifest for awsAccountId:[{}] - cur_manifest_lastmodified_ts:[{}] - lastProcessedTimestamp:[{}]".format(curprocessor.accountId, cur_manifest_lastmodified_ts, item.get('lastProcessedTimestamp',consts.EPOCH_TS)))
+        else:
+            log.info("Manifest [{}] modified for awsAccountId:[{}]: [{}] - lastProcessedTimestamp:[{}]".format(item['curManifestKey'], kwargs['accountId'], manifestModified, item.get('lastProcessedTimestamp',consts.EPOCH_TS)))
+
+        if manifestModified:
+            if evaluation['cancelled'].is_set():
+                log.info("Evaluation for awsPayerAccountId [{}] timed out, not starting execution".format(kwargs['accountId']))
+                return result
+            #Start execution
+            period = utils.get_period_prefix(year,month).replace('/','')
+            execname = "{}-{}-{}".format(kwargs['accountId'], period, hashlib.md5(str(time.time()).encode("utf-8")).hexdigest()[:8])
+            sfnresponse = sfnclient.start_execution(stateMachineArn=consts.STEP_FUNCTION_PREPARE_CUR_ATHENA,
+                                                 name=execname,
+                                                 input=json.dumps(kwargs))
+
+            #Prepare SNS notification
+            sfn_executionarn = sfnresponse['executionArn']
+            result['executionLink'] = "https://console.aws.amazon.com/states/home?region={}#/executions/details/{}\n".format(consts.AWS_DEFAULT_REGION, sfn_executionarn)
+            result['execname'] = execname
+            log.info("Started execution - executionArn: {}".format(sfn_executionarn))
+
+    except CurBucketNotFoundError as e:
+        log.error("CurBucketNotFoundError [{}]".format(e.message))
+        result.update({'status':consts.CUR_PROCESSOR_STATUS_ERROR, 'statusDetails':e.message})
+
+    except ManifestNotFoundError as e:
+        log.error("ManifestNotFoundError [{}]".format(e.message))
+        result.update({'status':consts.CUR_PROCESSOR_STATUS_ERROR, 'statusDetails':e.message})
+
+    except BotoClientError as be:
+        errorType = ''
+        if be.response['Error']['Code'] == 'AccessDenied':
+            errorType = 'BotoAccessDenied'
+        else:
+            errorType = 'BotoClientError_'+be.response['Error']['Code']
+        log.error("{} awsPayerAccountId [{}] roleArn [{}] [{}]".format(errorType, kwargs['accountId'], kwargs['roleArn'], be.message))
+        result.update({'status':consts.CUR_PROCESSOR_STATUS_ERROR, 'statusDetails':errorType})
+
+    except Exception as e:
+        log.error("xAcctStepFunctionStarterException awsPayerAccountId [{}] roleArn [{}] [{}]".format(kwargs['accountId'], kwargs['roleArn'], e))
+        traceback.print_exc()
+        result.update({'status':consts.CUR_PROCESSOR_STATUS_ERROR, 'statusDetails':str(e.message or e)})
+
+    return result
+
+
+def get_evaluation_result(item, status, statusDetails, startTimestamp=None):
+    if not startTimestamp: startTimestamp = datetime.datetime.now(pytz.utc).strftime(consts.TIMESTAMP_FORMAT)
+    return {'item':item, 'status':status, 'statusDetails':statusDetails, 'startTimestamp':startTimestamp, 'execname':'', 'executionLink':''}
+
+
+def get_handler_deadline(context):
+    remaining = context.get_remaining_time_in_millis() / 1000.0 if hasattr(context, 'get_remaining_time_in_millis') else 0
+    if not remaining: return float('inf')
+    return time.time() + remaining - HANDLER_TIMEOUT_MARGIN_SECONDS
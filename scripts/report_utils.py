@@ -28,6 +28,17 @@ def main(argv):
   parser.add_argument('--role-arn', help='', required=False)
   parser.add_argument('--xacct-source', help='', required=False)
   parser.add_argument('--xacct-dest', help='', required=False)
+  parser.add_argument('--processing-mode', help='stream (default) or local', required=False)
+  parser.add_argument('--workers', help='Number of report files processed concurrently', required=False)
+  parser.add_argument('--worker-type', help='thread (default) or process', required=False)
+  parser.add_argument('--typed-schema', help='Create typed (double, timestamp, bigint) columns in Athena instead of strings', required=False)
+  parser.add_argument('--shard-size-mb', help='Uncompressed size of each Athena file (default 128), 0 means no sharding', required=False)
+  parser.add_argument('--partition-by-usage-date', help='Place Athena files in usage_date=YYYY-MM-DD partitions within each month', required=False)
+  parser.add_argument('--table-layout', help='monthly (one Athena table per month, default) or account (one table per account, partitioned by billing period)', required=False)
+  parser.add_argument('--include-columns', help='Comma-separated categories (i.e. lineItem) or columns (i.e. resourceTags/user:Name) to include in Athena files', required=False)
+  parser.add_argument('--exclude-columns', help='Comma-separated categories or columns to exclude from Athena files', required=False)
+  parser.add_argument('--exclude-zero-cost-tax', help='Remove zero-cost Tax line items from Athena files', required=False)
+  parser.add_argument('--reprocess-all', help='Process all report files, including the ones that did not change since they were last processed', required=False)
 
 
   if len(sys.argv) == 1:
@@ -55,6 +66,16 @@ def main(argv):
   if args.role_arn: kwargs['roleArn'] = args.role_arn
   if args.xacct_source: kwargs['xAccountSource'] = True
   if args.xacct_dest: kwargs['xAccountDest'] = True
+  if args.processing_mode: kwargs['processingMode'] = args.processing_mode
+  if args.workers: kwargs['workers'] = int(args.workers)
+  if args.worker_type: kwargs['workerType'] = args.worker_type
+  if args.typed_schema: kwargs['typedSchema'] = True
+  if args.shard_size_mb: kwargs['shardSizeMB'] = int(args.shard_size_mb)
+  if args.partition_by_usage_date: kwargs['partitionByUsageDate'] = True
+  if args.reprocess_all: kwargs['incremental'] = False
+  if args.include_columns: kwargs['includeColumns'] = args.include_columns
+  if args.exclude_columns: kwargs['excludeColumns'] = args.exclude_columns
+  if args.exclude_zero_cost_tax: kwargs['excludeRows'] = [consts.ROW_FILTER_ZERO_COST_TAX]
 
 
   try:
@@ -68,17 +89,20 @@ def main(argv):
 
     curprocessor = cur.CostUsageProcessor(**kwargs)
 
-    if action in (consts.ACTION_PREPARE_ATHENA, consts.ACTION_PREPARE_QUICKSIGHT):
+    if action in (consts.ACTION_PREPARE_ATHENA, consts.ACTION_PREPARE_ATHENA_PARQUET, consts.ACTION_PREPARE_QUICKSIGHT):
+      #fail before processing any files if the table can't be created
+      ath.validate_table_layout(args.table_layout or consts.ATHENA_TABLE_LAYOUT, curutils.get_storage_format(action))
+
       #Process Cost and Usage Report
       destS3keys = curprocessor.process_latest_aws_cur(action)
 
       #Then create Athena table for the current month
-      athena = ath.AthenaQueryMgr("s3://"+curprocessor.destBucket, curprocessor.accountId, curprocessor.year, curprocessor.month)
-      athena.create_database()
-      athena.drop_table()#drops the table for the current month (before creating a new one)
+      athena = ath.AthenaQueryMgr("s3://"+curprocessor.destBucket, curprocessor.accountId, curprocessor.year, curprocessor.month, typedSchema=curprocessor.typedSchema,
+                                partitionByUsageDate=curprocessor.partitionByUsageDate, tableLayout=args.table_layout or consts.ATHENA_TABLE_LAYOUT)
       curS3Prefix = curprocessor.destPrefix + curprocessor.accountId + "/" + curutils.get_period_prefix(curprocessor.year, curprocessor.month)
       print ("Creating Athena table for S3 location [s3://{}/{}]".format(curprocessor.destBucket,curS3Prefix))
-      athena.create_table(curprocessor.curManifestJson, curprocessor.destBucket, curS3Prefix)
+      #the monthly layout drops the table for the current month before creating a new one
+      athena.create_resources(curprocessor.outputManifestJson, curprocessor.destBucket, curS3Prefix, curutils.get_storage_format(action))
 
 
       if action == consts.ACTION_PREPARE_QUICKSIGHT:
@@ -0,0 +1,216 @@
+import io
+import csv
+import zlib
+import unittest
+
+import awscostusageprocessor.s3stream as s3stream
+
+
+"""
+In-memory stand-in for the S3 client calls used by S3MultipartUploadWriter. Completed objects are kept in objects: key -> bytes.
+"""
+
+class InMemoryS3Client():
+
+    def __init__(self):
+        self.objects = {}
+        self.uploads = {}
+        self.aborted = []
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.objects[Key] = Body
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        uploadid = 'upload-{}'.format(len(self.uploads) + 1)
+        self.uploads[uploadid] = {}
+        return {'UploadId':uploadid}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.uploads[UploadId][PartNumber] = Body
+        return {'ETag':'etag-{}'.format(PartNumber)}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = self.uploads.pop(UploadId)
+        self.objects[Key] = b''.join([parts[p['PartNumber']] for p in MultipartUpload['Parts']])
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.uploads.pop(UploadId)
+        self.aborted.append(Key)
+
+
+def gzip_bytes(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, s3stream.GZIP_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+def gunzip_bytes(data):
+    return b''.join(s3stream.GzipStreamReader(io.BytesIO(data)).iter_chunks())
+
+def csv_bytes(rows):
+    out = io.BytesIO()
+    csv.writer(out, lineterminator='\n').writerows(rows)
+    return out.getvalue()
+
+def iter_pieces(data, size):
+    for i in range(0, len(data), size):
+        yield data[i:i+size]
+
+#rows with quoted fields that contain line breaks, quotes and commas
+ROWS = [['id', 'description', 'cost']] + \
+       [[str(i), 'line one\nline "two"\n, three' if i % 3 == 0 else 'plain {}'.format(i), '{}.25'.format(i)] for i in range(60)]
+
+
+class TestGzipStreamReader(unittest.TestCase):
+
+    def test_reads_all_gzip_members(self):
+        data = csv_bytes(ROWS)
+        body = gzip_bytes(data[:100]) + gzip_bytes(data[100:])
+        reader = s3stream.GzipStreamReader(io.BytesIO(body), chunk_size=7)
+        self.assertEqual(b''.join(reader.iter_chunks()), data)
+        self.assertEqual(reader.compressed_bytes, len(body))
+        self.assertEqual(reader.uncompressed_bytes, len(data))
+
+    def test_quoted_newlines_across_chunk_boundaries(self):
+        data = csv_bytes(ROWS)
+        for chunk_size in (1, 5, 64):
+            reader = s3stream.GzipStreamReader(io.BytesIO(gzip_bytes(data)), chunk_size=chunk_size)
+            self.assertEqual(list(csv.reader(reader.iter_lines())), ROWS)
+
+    def test_skip_first_line(self):
+        data = csv_bytes(ROWS)
+        self.assertEqual(b''.join(s3stream.skip_first_line(iter_pieces(data, 3))), csv_bytes(ROWS[1:]))
+
+
+class TestShardedGzipWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.s3client = InMemoryS3Client()
+
+    def get_writer(self, target_shard_bytes):
+        return s3stream.ShardedGzipWriter(self.s3client, 'bucket', 'prefix/part-{shard:04d}.csv.gz', target_shard_bytes)
+
+    def read_shards(self, writer):
+        return [gunzip_bytes(self.s3client.objects[k]) for k in writer.keys]
+
+    def test_single_shard(self):
+        writer = self.get_writer(0)
+        for piece in iter_pieces(csv_bytes(ROWS), 10): writer.write(piece)
+        writer.close()
+        self.assertEqual(writer.keys, ['prefix/part-0001.csv.gz'])
+        self.assertEqual(self.read_shards(writer), [csv_bytes(ROWS)])
+
+    def test_shard_rollover(self):
+        data = csv_bytes(ROWS)
+        writer = self.get_writer(200)
+        writer.write(data)
+        writer.close()
+        shards = self.read_shards(writer)
+        self.assertTrue(len(shards) > 1)
+        self.assertEqual(writer.keys, ['prefix/part-{:04d}.csv.gz'.format(i+1) for i in range(len(shards))])
+        self.assertEqual(b''.join(shards), data)
+        self.assertEqual(writer.uncompressed_bytes, len(data))
+        #a shard is closed once the record that crosses the target size is complete
+        for shard in shards[:-1]:
+            self.assertTrue(len(shard) >= 200)
+
+    def test_quoted_newlines_across_chunk_boundaries(self):
+        data = csv_bytes(ROWS)
+        for piece_size in (1, 7, 50):
+            self.s3client = InMemoryS3Client()
+            writer = self.get_writer(40)
+            for piece in iter_pieces(data, piece_size): writer.write(piece)
+            writer.close()
+            shards = self.read_shards(writer)
+            self.assertTrue(len(shards) > 1)
+            #every shard has complete records, no quoted field is split between shards
+            self.assertEqual([r for s in shards for r in csv.reader(io.BytesIO(s))], ROWS)
+
+    def test_write_row(self):
+        writer = self.get_writer(100)
+        for row in ROWS: writer.write_row(row)
+        writer.close()
+        self.assertEqual([r for s in self.read_shards(writer) for r in csv.reader(io.BytesIO(s))], ROWS)
+
+    def test_abort(self):
+        writer = s3stream.ShardedGzipWriter(self.s3client, 'bucket', 'prefix/part-{shard:04d}.csv.gz', 0,
+                                            part_size=s3stream.MIN_MULTIPART_PART_SIZE)
+        writer.write(b'a,b\n')
+        writer.abort()
+        self.assertEqual(self.s3client.objects, {})
+
+
+class TestPartitionedWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.s3client = InMemoryS3Client()
+
+    def get_writer(self, max_open_writers, target_shard_bytes=0):
+        factory = lambda partition: s3stream.ShardedGzipWriter(self.s3client, 'bucket', 'usage_date=' + partition + '/part-{shard:04d}.csv.gz',
+                                                               target_shard_bytes)
+        return s3stream.PartitionedWriter(factory, max_open_writers)
+
+    def read_partition(self, partition):
+        keys = sorted([k for k in self.s3client.objects if k.startswith('usage_date=' + partition + '/')])
+        return [r for k in keys for r in csv.reader(io.BytesIO(gunzip_bytes(self.s3client.objects[k])))]
+
+    def write_interleaved(self, writer, partitions, rows_per_partition):
+        expected = dict([(p, []) for p in partitions])
+        for i in range(rows_per_partition):
+            for p in partitions:
+                row = [p, str(i), 'quoted\n"value"']
+                writer.write_partition_row(p, row)
+                expected[p].append(row)
+        writer.close()
+        return expected
+
+    def test_interleaved_partitions(self):
+        partitions = ['2017-06-0{}'.format(d) for d in range(1, 6)]
+        writer = self.get_writer(2)
+        expected = self.write_interleaved(writer, partitions, 300)
+        #one file per partition, even though only two writers are open at a time
+        self.assertEqual(writer.keys, ['usage_date={}/part-0001.csv.gz'.format(p) for p in partitions])
+        self.assertEqual(sorted(self.s3client.objects.keys()), writer.keys)
+        for p in partitions:
+            self.assertEqual(self.read_partition(p), expected[p])
+        self.assertEqual(writer.spills, {})
+
+    def test_interleaved_partitions_shard_rollover(self):
+        partitions = ['2017-06-01', '2017-06-02', '2017-06-03']
+        writer = self.get_writer(1, target_shard_bytes=2000)
+        expected = self.write_interleaved(writer, partitions, 400)
+        for p in partitions:
+            keys = [k for k in writer.keys if k.startswith('usage_date=' + p + '/')]
+            self.assertTrue(len(keys) > 1)
+            self.assertEqual(keys, ['usage_date={}/part-{:04d}.csv.gz'.format(p, i+1) for i in range(len(keys))])
+            self.assertEqual(self.read_partition(p), expected[p])
+
+    def test_no_limit(self):
+        partitions = ['2017-06-01', '2017-06-02', '2017-06-03']
+        writer = self.get_writer(0)
+        expected = self.write_interleaved(writer, partitions, 10)
+        self.assertEqual(writer.spills, {})
+        for p in partitions:
+            self.assertEqual(self.read_partition(p), expected[p])
+
+    def test_abort(self):
+        writer = self.get_writer(1)
+        writer.write_partition_row('2017-06-01', ['a'])
+        writer.write_partition_row('2017-06-02', ['b'])
+        writer.abort()
+        self.assertEqual(writer.writers, {})
+        self.assertEqual(writer.spills, {})
+        self.assertEqual(self.s3client.objects, {})
+
+
+class TestRowSpill(unittest.TestCase):
+
+    def test_rows_are_read_back_in_order(self):
+        spill = s3stream.RowSpill(batch_rows=7)
+        rows = [[str(i), 'value\n{}'.format(i), None] for i in range(50)]
+        for row in rows: spill.write_row(row)
+        self.assertEqual(list(spill.iter_rows()), rows)
+        self.assertEqual(spill.rows, 50)
+        spill.close()
+
+
+if __name__ == '__main__':
+    unittest.main()